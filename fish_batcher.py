@@ -0,0 +1,106 @@
+'''
+Dynamic micro-batching for concurrent /detect/ requests.
+
+Requests that arrive within a short window (or until max_batch requests
+are waiting) are coalesced into one batch, processed with a single call
+(one batched YOLO forward, shared segmentation passes) and the results are
+fanned back out to the waiting requests.
+
+Configuration (environment variables read by batcher_from_env):
+
+    FISH_BATCH_WINDOW_MS  how long the first request waits for others (default 10)
+    FISH_MAX_BATCH        max images per batch, 1 disables batching   (default 8)
+'''
+
+import asyncio
+import os
+
+
+class MicroBatcher:
+    '''
+    Coalesce single-item submissions into batches.
+
+        process_batch : async callable, list of items -> list of results in
+                        the same order. A result that is an Exception is
+                        raised to the request that submitted that item.
+        max_batch     : max items per batch
+        window_ms     : max time the oldest item waits for a batch to fill
+    '''
+    def __init__(self, process_batch, max_batch=8, window_ms=10):
+        self.process_batch = process_batch
+        self.max_batch = max(1, max_batch)
+        self.window = window_ms / 1000.0
+        self.queue = None
+        self.task = None
+        self.dispatched = set()
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self._collect())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @property
+    def queue_depth(self):
+        return 0 if self.queue is None else self.queue.qsize()
+
+    async def submit(self, item):
+        '''Queue one item and wait for its result.'''
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+
+            while len(batch) < self.max_batch:
+                # take whatever is already waiting without sleeping
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # keep collecting the next batch while this one is processed
+            task = loop.create_task(self._dispatch(batch))
+            self.dispatched.add(task)
+            task.add_done_callback(self.dispatched.discard)
+
+    async def _dispatch(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = await self.process_batch(items)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                # request was cancelled (client went away)
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def batcher_from_env(process_batch):
+    '''Build a MicroBatcher configured by the FISH_* environment variables.'''
+    return MicroBatcher(
+        process_batch,
+        max_batch=int(os.environ.get('FISH_MAX_BATCH', 8)),
+        window_ms=float(os.environ.get('FISH_BATCH_WINDOW_MS', 10)),
+    )
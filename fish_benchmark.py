@@ -0,0 +1,396 @@
+'''
+Offline, reproducible benchmark of the measurement pipeline.
+
+No network and no model downloads: synthetic fish-on-tray JPEGs are
+measured by the real FishPipeline (decode, batched detection, batched
+segmentation, geometry, weight regression) with stand-in TorchScript
+models that have the I/O signatures of the real ones:
+
+    detector     : StandInDetector.predict(list of RGB images) -> boxes per
+                   image (x1, y1, x2, y2, get_mask_BGR), as YOLOInference
+    segmentation : (B, 3, H, W) -> (B, 1, H, W) mask logits, loaded by
+                   BatchSegmentator like models/segmentation/model.ts
+    classifier   : (B, 3, 224, 224) -> (embeddings, logits), run through
+                   EmbeddingClassifier.batch_inference (needs torchvision)
+    weight model : WeightNet (random weights)
+
+Stand-in outputs follow the synthetic fish (dark on a light tray) so the
+downstream stages see realistic fish counts and crop sizes. Per-stage
+latency (fish_metrics.StageTimer) and end-to-end throughput are reported
+for every image size x fish count x batch size, written as JSON and
+optionally compared with a stored baseline (exit code 1 on regression):
+
+    python fish_benchmark.py --output bench.json --save_baseline bench_baseline.json
+    python fish_benchmark.py --output bench.json --baseline bench_baseline.json --tolerance 0.15
+'''
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from PIL import Image
+
+from fish_metrics import StageTimer
+from fish_pipeline import BatchSegmentator, FishPipeline
+from fish_weight_model import WeightNet
+
+
+class StandInDetectorNet(nn.Module):
+    '''Conv backbone (stride 8) + objectness map of dark regions.'''
+    def __init__(self, width=32):
+        super(StandInDetectorNet, self).__init__()
+        self.backbone = nn.Sequential(
+            nn.Conv2d(3, width, 3, stride=2, padding=1), nn.ReLU(),
+            nn.Conv2d(width, width * 2, 3, stride=2, padding=1), nn.ReLU(),
+            nn.Conv2d(width * 2, width * 4, 3, stride=2, padding=1), nn.ReLU(),
+            nn.Conv2d(width * 4, 1, 1),
+        )
+
+    def forward(self, x):
+        darkness = F.avg_pool2d(1.0 - x.mean(dim=1, keepdim=True), 8)
+        # backbone runs for its cost, the map follows the synthetic fish
+        # (darker than the tray and the grey letterbox padding)
+        return torch.sigmoid((darkness - 0.65) * 20.0 + 0.0 * self.backbone(x))
+
+
+class StandInSegmentationNet(nn.Module):
+    '''Encoder / decoder returning mask logits of dark regions.'''
+    def __init__(self, width=32, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        super(StandInSegmentationNet, self).__init__()
+        self.encoder = nn.Sequential(
+            nn.Conv2d(3, width, 3, stride=2, padding=1), nn.ReLU(),
+            nn.Conv2d(width, width * 2, 3, stride=2, padding=1), nn.ReLU(),
+            nn.Conv2d(width * 2, width * 2, 3, padding=1), nn.ReLU(),
+        )
+        self.decoder = nn.Conv2d(width * 2, 1, 1)
+        self.register_buffer('mean', torch.tensor(mean).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor(std).view(1, 3, 1, 1))
+
+    def forward(self, x):
+        decoded = F.interpolate(self.decoder(self.encoder(x)), size=x.shape[2:], mode='bilinear', align_corners=False)
+        image = (x * self.std + self.mean).mean(dim=1, keepdim=True)
+        # black letterbox padding is background
+        darkness = torch.where(image < 0.05, torch.zeros_like(image), 1.0 - image)
+        return (darkness - 0.5) * 20.0 + 0.0 * decoded
+
+
+class StandInClassifierNet(nn.Module):
+    '''Backbone + global pooling returning (embeddings, class logits).'''
+    def __init__(self, width=32, embedding_size=256, num_classes=100):
+        super(StandInClassifierNet, self).__init__()
+        self.backbone = nn.Sequential(
+            nn.Conv2d(3, width, 3, stride=2, padding=1), nn.ReLU(),
+            nn.Conv2d(width, width * 2, 3, stride=2, padding=1), nn.ReLU(),
+            nn.Conv2d(width * 2, width * 4, 3, stride=2, padding=1), nn.ReLU(),
+        )
+        self.embedding = nn.Linear(width * 4, embedding_size)
+        self.fc = nn.Linear(embedding_size, num_classes)
+
+    def forward(self, x):
+        features = F.adaptive_avg_pool2d(self.backbone(x), 1).flatten(1)
+        embeddings = self.embedding(features)
+        return embeddings, self.fc(embeddings)
+
+
+class StandInBox:
+    '''Detector box with the attributes of a YOLOInference box.'''
+    def __init__(self, image_rgb, x1, y1, x2, y2, score):
+        self.x1, self.y1, self.x2, self.y2 = x1, y1, x2, y2
+        self.score = score
+        self.image_rgb = image_rgb
+
+    def get_mask_RGB(self):
+        return self.image_rgb[self.y1:self.y2, self.x1:self.x2]
+
+    def get_mask_BGR(self):
+        return cv2.cvtColor(self.get_mask_RGB(), cv2.COLOR_RGB2BGR)
+
+
+class StandInDetector:
+    '''YOLOInference stand-in: letterbox, one batched forward, boxes per image.'''
+    def __init__(self, model_path, imsz=(640, 640), conf_threshold=0.5, stride=8):
+        self.model = torch.jit.load(model_path, map_location='cpu')
+        self.model.eval()
+        self.imsz = imsz
+        self.conf_threshold = conf_threshold
+        self.stride = stride
+
+    def predict(self, images_rgb):
+        size = self.imsz[0]
+        canvases, letterbox = [], []
+        for image in images_rgb:
+            h, w = image.shape[:2]
+            scale = size / max(h, w)
+            new_w, new_h = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+            canvas = np.full((size, size, 3), 114, dtype=np.uint8)
+            canvas[:new_h, :new_w] = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+            canvases.append(canvas)
+            letterbox.append(scale)
+
+        batch = torch.from_numpy(np.stack(canvases)).permute(0, 3, 1, 2).float().div_(255.0)
+        with torch.no_grad():
+            objectness = self.model(batch)[:, 0].numpy()
+
+        results = []
+        for image, scale, score_map in zip(images_rgb, letterbox, objectness):
+            mask = (score_map > self.conf_threshold).astype(np.uint8)
+            # thin tails can fall below the threshold at stride 8
+            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+            count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+            h, w = image.shape[:2]
+            boxes = []
+            for x, y, bw, bh, area in stats[1:count]:
+                if area < 2:
+                    continue
+                # grid cells (+1 cell margin) -> image pixels
+                x1 = int(max(0, (x - 1) * self.stride / scale))
+                y1 = int(max(0, (y - 1) * self.stride / scale))
+                x2 = int(min(w, (x + bw + 1) * self.stride / scale))
+                y2 = int(min(h, (y + bh + 1) * self.stride / scale))
+                boxes.append(StandInBox(image, x1, y1, x2, y2, float(score_map[y:y + bh, x:x + bw].max())))
+            results.append(boxes)
+        return results
+
+
+def save_stand_in_models(model_dir, seed=0):
+    '''Script and save the stand-in networks. Return their paths.'''
+    torch.manual_seed(seed)
+    os.makedirs(model_dir, exist_ok=True)
+    paths = {}
+    for name, model in (('detection', StandInDetectorNet()), ('segmentation', StandInSegmentationNet()),
+                        ('classification', StandInClassifierNet())):
+        paths[name] = os.path.join(model_dir, f'{name}.ts')
+        torch.jit.script(model.eval()).save(paths[name])
+    return paths
+
+
+def synthetic_tray(width, height, fish_count, rng):
+    '''
+    RGB image of a light tray with fish_count dark fish (elliptic body and
+    tail) laid out on a jittered grid so they do not touch.
+    '''
+    gradient = np.linspace(0, 20, width, dtype=np.float32)[None, :, None]
+    image = np.full((height, width, 3), (196, 200, 190), dtype=np.float32) - gradient
+    image = np.clip(image + rng.normal(0, 4, (height, width, 1)), 0, 255).astype(np.uint8)
+
+    cols = int(np.ceil(np.sqrt(fish_count * width / float(height))))
+    rows = int(np.ceil(fish_count / float(cols)))
+    cell_w, cell_h = width / float(cols), height / float(rows)
+    for idx in range(fish_count):
+        cx = (idx % cols + 0.5) * cell_w + rng.uniform(-0.1, 0.1) * cell_w
+        cy = (idx // cols + 0.5) * cell_h + rng.uniform(-0.1, 0.1) * cell_h
+        length = 0.6 * min(cell_w, cell_h) * rng.uniform(0.7, 1.0)
+        angle = rng.uniform(0, 180)
+        color = tuple(int(v) for v in rng.integers(30, 90, 3))
+
+        cv2.ellipse(image, (int(cx), int(cy)), (int(length * 0.4), int(length * 0.12)), angle, 0, 360, color, -1)
+        theta = np.deg2rad(angle)
+        direction, normal = np.array([np.cos(theta), np.sin(theta)]), np.array([-np.sin(theta), np.cos(theta)])
+        base = np.array([cx, cy]) + direction * length * 0.34
+        tail = np.array([base, base + direction * length * 0.16 + normal * length * 0.1,
+                         base + direction * length * 0.16 - normal * length * 0.1])
+        cv2.fillPoly(image, [tail.astype(np.int32)], color)
+    return image
+
+
+def encode_jpeg(image, quality=90):
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def summarize(values):
+    values = np.asarray(values, dtype=np.float64) * 1000
+    if len(values) == 0:
+        return {'mean_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'count': 0}
+    return {'mean_ms': float(values.mean()), 'p50_ms': float(np.percentile(values, 50)),
+            'p95_ms': float(np.percentile(values, 95)), 'count': int(len(values))}
+
+
+def bench_pipeline(pipeline, uploads, batch_size, repeat):
+    '''
+    Measure all uploads in batches of batch_size, repeat times. Return
+    end-to-end and per-stage statistics.
+    '''
+    pipeline.timer.drain()
+    batch_times, fish_found = [], []
+    for _ in range(repeat):
+        for start in range(0, len(uploads), batch_size):
+            batch = uploads[start:start + batch_size]
+            begin = time.perf_counter()
+            results = pipeline.measure_uploads(batch)
+            batch_times.append((time.perf_counter() - begin, len(batch)))
+            fish_found.extend(len(fish) for fish in results)
+
+    stages = {}
+    for kind, stage, seconds in pipeline.timer.drain():
+        if kind == 'stage':
+            stages.setdefault(stage, []).append(seconds)
+
+    total_seconds = sum(seconds for seconds, _ in batch_times)
+    total_images = sum(count for _, count in batch_times)
+    return {
+        'images_per_second': total_images / total_seconds,
+        'ms_per_image': total_seconds / total_images * 1000,
+        'batch': summarize([seconds for seconds, _ in batch_times]),
+        'fish_found_mean': float(np.mean(fish_found)),
+        'stages': {stage: summarize(values) for stage, values in sorted(stages.items())},
+    }
+
+
+def bench_classifier(model_path, crops, database_size, repeat, seed=0):
+    '''EmbeddingClassifier over fish crops with a random reference database.'''
+    try:
+        from module.classification_package.interpreter_classifier import EmbeddingClassifier
+    except ImportError as e:
+        return {'skipped': f'classifier unavailable: {e}'}
+
+    rng = np.random.default_rng(seed)
+    num_classes = 100
+    database_path = os.path.join(os.path.dirname(model_path), f'database_{database_size}.pt')
+    torch.save(torch.from_numpy(rng.normal(0, 1, (database_size, 256)).astype(np.float32)), database_path)
+    indexes_of_elements = {
+        'list_of_ids': [[int(rng.integers(num_classes)), idx, idx, 0] for idx in range(database_size)],
+        'categories': {str(c): {'name': f'species_{c}', 'species_id': c} for c in range(num_classes)},
+    }
+    classifier = EmbeddingClassifier(model_path, database_path, indexes_of_elements)
+
+    crops_rgb = [cv2.cvtColor(crop, cv2.COLOR_BGR2RGB) for crop in crops]
+    classifier.batch_inference(crops_rgb)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        classifier.batch_inference(crops_rgb)
+        times.append(time.perf_counter() - start)
+    return {'crops': len(crops), 'database_size': database_size, 'batch': summarize(times),
+            'ms_per_crop': float(np.mean(times)) / max(len(crops), 1) * 1000}
+
+
+def config_key(result):
+    return f"{result['image_size'][0]}x{result['image_size'][1]}/fish{result['fish']}/batch{result['batch_size']}"
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Compare ms_per_image of every configuration with the baseline. Return
+    one row per configuration found in both, flagged when slower than
+    (1 + tolerance) x baseline.
+    '''
+    previous = {config_key(result): result for result in baseline['results']}
+    rows = []
+    for result in results:
+        key = config_key(result)
+        if key not in previous:
+            continue
+        ratio = result['ms_per_image'] / previous[key]['ms_per_image']
+        rows.append({'config': key, 'baseline_ms_per_image': previous[key]['ms_per_image'],
+                     'ms_per_image': result['ms_per_image'], 'ratio': ratio, 'regression': ratio > 1 + tolerance})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark with synthetic images and stand-in models.')
+    parser.add_argument('--sizes', type=str, nargs='+', default=['1280x960', '4000x3000', '6000x4000'])
+    parser.add_argument('--fish', type=int, nargs='+', default=[1, 4, 12])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--images', type=int, default=8, help='distinct synthetic images per configuration')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--optimize', type=str, default='', help="CPU optimize mode ('freeze')")
+    parser.add_argument('--classifier_db', type=int, default=20000, help='reference embeddings (0: skip classifier)')
+    parser.add_argument('--torch_threads', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--model_dir', type=str, default='', help='keep stand-in models here (default: temp dir)')
+    parser.add_argument('--output', type=str, default='fish_benchmark.json')
+    parser.add_argument('--baseline', type=str, default='', help='compare with this earlier output')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed slowdown vs baseline')
+    parser.add_argument('--save_baseline', type=str, default='', help='also write the results as a baseline')
+    args = parser.parse_args()
+
+    if args.torch_threads:
+        torch.set_num_threads(args.torch_threads)
+    torch.set_grad_enabled(False)
+    rng = np.random.default_rng(args.seed)
+
+    model_dir = args.model_dir if len(args.model_dir) else tempfile.mkdtemp(prefix='fish_benchmark_')
+    paths = save_stand_in_models(model_dir, args.seed)
+
+    torch.manual_seed(args.seed)
+    pipeline = FishPipeline(
+        StandInDetector(paths['detection']),
+        BatchSegmentator(paths['segmentation'], image_size=416),
+        WeightNet().eval(),
+        'cpu',
+        timer=StageTimer(),
+    )
+    if len(args.optimize):
+        from fish_cpu_optimize import optimize_pipeline
+        optimize_pipeline(pipeline, args.optimize)
+    pipeline.warm_up()
+
+    results = []
+    crops = []
+    for size, fish_count in itertools.product(args.sizes, args.fish):
+        width, height = [int(v) for v in size.split('x')]
+        images = [synthetic_tray(width, height, fish_count, rng) for _ in range(args.images)]
+        uploads = [(encode_jpeg(image), 0.0039) for image in images]
+        if len(crops) < 64:
+            crops.extend(box.get_mask_BGR() for box in pipeline.detector.predict(images[:1])[0])
+        del images
+
+        for batch_size in args.batch_sizes:
+            # one untimed pass, then the timed repeats
+            bench_pipeline(pipeline, uploads[:batch_size], batch_size, 1)
+            result = bench_pipeline(pipeline, uploads, batch_size, args.repeat)
+            result.update({'image_size': [width, height], 'fish': fish_count, 'batch_size': batch_size})
+            results.append(result)
+            print(f"{config_key(result):>28}: {result['ms_per_image']:8.1f} ms/image, "
+                  f"{result['images_per_second']:6.2f} images/s, {result['fish_found_mean']:.1f} fish found")
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'optimize': args.optimize,
+            'seed': args.seed,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        },
+        'results': results,
+    }
+    if args.classifier_db > 0 and len(crops):
+        report['classification'] = bench_classifier(paths['classification'], crops[:64], args.classifier_db,
+                                                    args.repeat, args.seed)
+
+    regressions = []
+    if len(args.baseline):
+        with open(args.baseline, 'r') as f:
+            report['comparison'] = compare(results, json.load(f), args.tolerance)
+        for row in report['comparison']:
+            print(f"{row['config']:>28}: {row['ratio']:.2f}x baseline" + ('  REGRESSION' if row['regression'] else ''))
+        regressions = [row for row in report['comparison'] if row['regression']]
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if len(args.save_baseline):
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if len(regressions):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
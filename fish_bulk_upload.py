@@ -0,0 +1,115 @@
+'''
+Bulk measurement of many images in one request (/detect/batch).
+
+The uploaded images (multipart files, zip archives are expanded) are read
+one at a time; at most `in_flight` of them are submitted to the micro-batcher
+at once, so the inference workers stay busy without the whole upload being
+held in memory, and every image's result is yielded as soon as it is
+measured (completion order, `index` is the upload order):
+
+    {"index": 3, "image_name": "IMG_0004.JPG", "fish_count": 2, "fish": [...], ...}
+    {"index": 0, "image_name": "IMG_0001.JPG", "error": "cannot identify image file ..."}
+'''
+
+import asyncio
+import os
+import zipfile
+
+from fish_worker_pool import PoolFull
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+ZIP_CONTENT_TYPES = ('application/zip', 'application/x-zip-compressed')
+
+
+def is_zip(upload):
+    return (upload.filename or '').lower().endswith('.zip') or upload.content_type in ZIP_CONTENT_TYPES
+
+
+def zip_image_names(archive):
+    '''Image entries of an archive in name order (folders and macOS metadata skipped).'''
+    names = []
+    for info in archive.infolist():
+        name = info.filename
+        if info.is_dir() or name.startswith('__MACOSX/') or os.path.basename(name).startswith('.'):
+            continue
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            names.append(name)
+    return sorted(names)
+
+
+async def upload_images(uploads):
+    '''
+    Yield (image name, bytes) of every uploaded image, reading each one only
+    when it is requested. An unreadable archive yields (name, exception).
+    '''
+    loop = asyncio.get_running_loop()
+    for upload in uploads:
+        if not is_zip(upload):
+            yield upload.filename, await upload.read()
+            continue
+
+        try:
+            archive = zipfile.ZipFile(upload.file)
+        except zipfile.BadZipFile as e:
+            yield upload.filename, e
+            continue
+        with archive:
+            for name in zip_image_names(archive):
+                # inflating is CPU work, keep it off the event loop
+                yield name, await loop.run_in_executor(None, archive.read, name)
+
+
+async def measure_retrying(measure, contents, retry_s=0.05, max_retry_s=1.0):
+    '''
+    measure(contents), waiting for room when the inference queue is full: a
+    bulk upload slows down instead of failing while other clients are served.
+    '''
+    delay = retry_s
+    while True:
+        try:
+            return await measure(contents)
+        except PoolFull:
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, max_retry_s)
+
+
+async def measure_stream(images, measure, in_flight=16):
+    '''
+    Measure an async iterable of (name, bytes) with at most in_flight
+    measure() calls running. Yield (index, name, result) as each finishes;
+    result is the exception when the image failed.
+    '''
+    loop = asyncio.get_running_loop()
+    images = images.__aiter__()
+    running = {}
+    index = 0
+    exhausted = False
+
+    try:
+        while True:
+            while not exhausted and len(running) < in_flight:
+                try:
+                    name, contents = await images.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                if isinstance(contents, Exception):
+                    yield index, name, contents
+                else:
+                    running[loop.create_task(measure_retrying(measure, contents))] = (index, name)
+                index += 1
+
+            if len(running) == 0:
+                if exhausted:
+                    return
+                continue
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda task: running[task][0]):
+                task_index, name = running.pop(task)
+                yield task_index, name, task.exception() or task.result()
+    finally:
+        # client went away: drop the images still waiting for a worker
+        for task in running:
+            task.cancel()
@@ -0,0 +1,171 @@
+'''
+Automatic (headless) pixel size calibration from the 1.27 cm reference dot.
+
+No GUI and no denoising of the full image: the dot is searched on a
+downsampled grey image (coarse), then its edge is located with sub-pixel
+accuracy along radial rays in a small full resolution ROI and a circle is
+least-squares fitted to the edge points (fine).
+
+    result = find_calibration_dot(image)
+    result['diameter']    # pixel
+    result['pixel_size']  # cm/pixel = 1.27 / diameter
+    result['confidence']  # 0..1, how circular and well supported the fit is
+
+Check calibration images from the command line:
+
+    python fish_pixelsize_compute.py '/data/fish/Growth Study Day 4 [12-30-24]/Calibration Dot.JPG'
+'''
+
+import cv2
+import numpy as np
+
+# diameter of the reference dot
+DOT_DIAMETER_CM = 1.27
+
+
+def to_gray(image, bgr=False):
+    if image.ndim == 2:
+        return image
+    if image.shape[2] == 4:
+        image = image[:, :, :3]
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY if bgr else cv2.COLOR_RGB2GRAY)
+
+
+def coarse_candidates(gray, coarse_size=1024, min_radius=0.002, max_radius=0.08, top=3):
+    '''
+    Round blob candidates on a downsampled image.
+
+        min_radius, max_radius : dot radius range, fraction of the long side
+
+    Both dark-on-light and light-on-dark blobs are considered. Return up to
+    top candidates (centre, radius in full resolution pixels, score) with
+    score = circularity * fill ratio of the enclosing circle, best first.
+    '''
+    scale = min(1.0, coarse_size / float(max(gray.shape[:2])))
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    small = cv2.GaussianBlur(small, (5, 5), 0)
+
+    long_side = max(small.shape[:2])
+    r_min, r_max = max(2.0, min_radius * long_side), max_radius * long_side
+
+    candidates = []
+    for polarity in (cv2.THRESH_BINARY_INV, cv2.THRESH_BINARY):
+        _, mask = cv2.threshold(small, 0, 255, polarity + cv2.THRESH_OTSU)
+        contours, _ = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+        for contour in contours:
+            area = cv2.contourArea(contour)
+            if area < np.pi * r_min ** 2 or area > np.pi * r_max ** 2:
+                continue
+            perimeter = cv2.arcLength(contour, True)
+            (x, y), radius = cv2.minEnclosingCircle(contour)
+            if perimeter == 0 or radius < r_min:
+                continue
+            circularity = min(1.0, 4 * np.pi * area / perimeter ** 2)
+            fill = min(1.0, area / (np.pi * radius ** 2))
+            candidates.append(((x / scale, y / scale), radius / scale, circularity * fill))
+
+    candidates.sort(key=lambda c: c[2], reverse=True)
+    return candidates[:top]
+
+
+def fit_circle(points):
+    '''Algebraic least-squares circle fit. Return (cx, cy), radius.'''
+    x, y = points[:, 0], points[:, 1]
+    a = np.stack([x, y, np.ones_like(x)], axis=1)
+    b = -(x ** 2 + y ** 2)
+    (d, e, f), _, _, _ = np.linalg.lstsq(a, b, rcond=None)
+    cx, cy = -d / 2, -e / 2
+    return (cx, cy), float(np.sqrt(max(cx ** 2 + cy ** 2 - f, 0.0)))
+
+
+def radial_edge_points(gray, centre, radius, rays=180, width=0.3, step=0.25):
+    '''
+    Sub-pixel edge point along each of rays radial lines around centre:
+    the strongest intensity step between (1 - width) and (1 + width) radius,
+    refined by a parabola through the gradient peak. Only a ROI around the
+    dot is sampled (bilinear, cv2.remap).
+    '''
+    angles = np.linspace(0, 2 * np.pi, rays, endpoint=False).astype(np.float32)
+    radii = np.arange((1 - width) * radius, (1 + width) * radius, step, dtype=np.float32)
+
+    map_x = (centre[0] + np.cos(angles)[:, None] * radii[None, :]).astype(np.float32)
+    map_y = (centre[1] + np.sin(angles)[:, None] * radii[None, :]).astype(np.float32)
+    profiles = cv2.remap(gray.astype(np.float32), map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+    gradient = np.abs(np.diff(profiles, axis=1))
+    peak = np.clip(np.argmax(gradient, axis=1), 1, gradient.shape[1] - 2)
+    rows = np.arange(rays)
+    left, mid, right = gradient[rows, peak - 1], gradient[rows, peak], gradient[rows, peak + 1]
+    denominator = left - 2 * mid + right
+    offset = np.where(np.abs(denominator) > 1e-6, 0.5 * (left - right) / np.where(denominator == 0, 1, denominator), 0.0)
+
+    # gradient sample i lies between radii i and i + 1
+    edge_radius = radii[0] + (peak + 0.5 + np.clip(offset, -0.5, 0.5)) * step
+    points = np.stack([centre[0] + np.cos(angles) * edge_radius, centre[1] + np.sin(angles) * edge_radius], axis=1)
+    return points, mid
+
+
+def refine_circle(gray, centre, radius, rays=180, iterations=2):
+    '''
+    Sub-pixel circle fit around a coarse detection. Return (centre, radius,
+    inlier fraction, rms residual) of the final fit.
+    '''
+    inliers = np.ones(rays, dtype=bool)
+    rms = float('inf')
+    for _ in range(iterations):
+        points, strength = radial_edge_points(gray, centre, radius, rays)
+        # weak edges (occlusions, glare) and outliers do not vote
+        inliers = strength > 0.25 * np.median(strength)
+        if inliers.sum() < 8:
+            return centre, radius, 0.0, float('inf')
+        centre, radius = fit_circle(points[inliers])
+
+        residuals = np.abs(np.linalg.norm(points - np.array(centre), axis=1) - radius)
+        mad = np.median(residuals[inliers]) + 1e-6
+        inliers &= residuals < max(3 * 1.4826 * mad, 0.5)
+        if inliers.sum() >= 8:
+            centre, radius = fit_circle(points[inliers])
+            residuals = np.abs(np.linalg.norm(points - np.array(centre), axis=1) - radius)
+        rms = float(np.sqrt(np.mean(residuals[inliers] ** 2)))
+    return centre, radius, inliers.mean(), rms
+
+
+def find_calibration_dot(image, bgr=False, roi=None, coarse_size=1024, min_radius=0.002, max_radius=0.08,
+                         rays=180, dot_diameter=DOT_DIAMETER_CM):
+    '''
+    Find the reference dot in an image (RGB, or BGR with bgr=True).
+
+        roi : optional (x, y, w, h) to restrict the search
+
+    Return dict with diameter (pixel), centre, pixel_size (cm/pixel) and
+    confidence, or None if no round blob was found.
+    '''
+    gray = to_gray(np.asarray(image), bgr)
+    x0, y0 = 0, 0
+    if roi is not None:
+        x0, y0, w, h = [int(v) for v in roi]
+        gray = gray[y0:y0 + h, x0:x0 + w]
+
+    best = None
+    for centre, radius, score in coarse_candidates(gray, coarse_size, min_radius, max_radius):
+        centre, radius, inlier_fraction, rms = refine_circle(gray, centre, radius, rays)
+        if radius <= 0 or not np.isfinite(rms):
+            continue
+        confidence = float(score * inlier_fraction * max(0.0, 1.0 - rms / (0.05 * radius)))
+        if best is None or confidence > best['confidence']:
+            best = {
+                'diameter': 2 * radius,
+                'centre': [float(centre[0] + x0), float(centre[1] + y0)],
+                'pixel_size': dot_diameter / (2 * radius),
+                'confidence': confidence,
+            }
+    return best
+
+
+def draw_calibration(image, result, color=(0, 255, 0), thickness=4):
+    '''Copy of image with the fitted dot outline drawn.'''
+    output_image = np.ascontiguousarray(image).copy()
+    if result is not None:
+        centre = (int(round(result['centre'][0])), int(round(result['centre'][1])))
+        cv2.circle(output_image, centre, int(round(result['diameter'] / 2)), color, thickness)
+    return output_image
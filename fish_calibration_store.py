@@ -0,0 +1,213 @@
+'''
+Persistent calibration store shared by all API workers.
+
+Every calibration (cm/pixel) is recorded with the station that took it, an
+optional session (e.g. study day '12-11-24') and its time, in a small SQLite
+database (WAL mode, so worker processes read while one writes):
+
+    station, session, pixel_size, diameter, confidence, image_name, calibrated_at
+
+/detect/ asks for the latest calibration of its station through a short
+in-process cache, so a second station never overwrites the first one's
+scale and a restart keeps it. Batch re-processing asks which scale applied
+to a station at a given time:
+
+    # record the per-day pixel sizes used by fish_weight_dataset.py
+    python fish_calibration_store.py add --station growth-study --session 12-11-24 \\
+        --pixel_size 0.0038845388570005477 --at 2024-12-11
+
+    # which scale applied at this time
+    python fish_calibration_store.py lookup --station growth-study --at '2024-12-12 10:30'
+
+    # latest scale of every session, as JSON for fish_measurement_store.py export --pixel_size_json
+    python fish_calibration_store.py sessions --output pixel_size.json
+'''
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+
+COLUMNS = ('station', 'session', 'pixel_size', 'diameter', 'confidence', 'image_name', 'calibrated_at')
+
+
+class CalibrationStore:
+    '''
+    SQLite store of calibrations keyed by (station, session, time).
+
+        cache_seconds : how long lookup() serves a station's calibration from
+                        memory; calibrations made by other worker processes
+                        are seen after at most this delay
+    '''
+    def __init__(self, db_path='fish_calibration.db', cache_seconds=5.0):
+        self.db_path = db_path
+        self.cache_seconds = cache_seconds
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS calibrations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                station TEXT NOT NULL,
+                session TEXT NOT NULL DEFAULT '',
+                pixel_size REAL NOT NULL,
+                diameter REAL,
+                confidence REAL,
+                image_name TEXT,
+                calibrated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS calibrations_station_time ON calibrations (station, calibrated_at);
+            CREATE INDEX IF NOT EXISTS calibrations_session_time ON calibrations (session, calibrated_at);
+        ''')
+        self.conn.commit()
+
+    def add(self, station, pixel_size, session='', diameter=None, confidence=None, image_name=None,
+            calibrated_at=None):
+        '''Record a calibration. Return it as a dict.'''
+        record = dict(zip(COLUMNS, (station, session or '', float(pixel_size), diameter, confidence, image_name,
+                                    time.time() if calibrated_at is None else float(calibrated_at))))
+        with self.lock, self.conn:
+            self.conn.execute(f'INSERT INTO calibrations ({", ".join(COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              tuple(record[name] for name in COLUMNS))
+            self.cache.pop(station, None)
+        return record
+
+    def at(self, station, at=None, session=None):
+        '''
+        Calibration of a station in effect at time `at` (latest one made at
+        or before it; now when None), optionally within one session. None if
+        the station was never calibrated by then.
+        '''
+        query = f'SELECT {", ".join(COLUMNS)} FROM calibrations WHERE station = ? AND calibrated_at <= ?'
+        params = [station, time.time() if at is None else float(at)]
+        if session is not None:
+            query += ' AND session = ?'
+            params.append(session)
+        query += ' ORDER BY calibrated_at DESC, id DESC LIMIT 1'
+
+        with self.lock:
+            row = self.conn.execute(query, params).fetchone()
+        return None if row is None else dict(zip(COLUMNS, row))
+
+    def lookup(self, station):
+        '''Current calibration of a station, cached for cache_seconds.'''
+        now = time.monotonic()
+        cached = self.cache.get(station)
+        if cached is not None and now - cached[1] < self.cache_seconds:
+            return cached[0]
+
+        record = self.at(station)
+        self.cache[station] = (record, now)
+        return record
+
+    def pixel_sizes_at(self, station, times):
+        '''
+        Pixel size in effect for each of many times (seconds since epoch) of
+        one station, in a single query. NaN before the first calibration.
+        '''
+        with self.lock:
+            rows = self.conn.execute('SELECT calibrated_at, pixel_size FROM calibrations WHERE station = ? '
+                                     'ORDER BY calibrated_at, id', (station,)).fetchall()
+        times = np.asarray(times, dtype=np.float64)
+        if len(rows) == 0:
+            return np.full(times.shape, np.nan)
+
+        calibrated_at, pixel_size = np.array(rows, dtype=np.float64).T
+        idx = np.searchsorted(calibrated_at, times, side='right') - 1
+        return np.where(idx >= 0, pixel_size[np.clip(idx, 0, None)], np.nan)
+
+    def sessions(self, station=None):
+        '''Latest pixel size of every session: {session: cm/pixel}.'''
+        query = 'SELECT session, pixel_size FROM calibrations WHERE session != ?'
+        params = ['']
+        if station is not None:
+            query += ' AND station = ?'
+            params.append(station)
+        query += ' ORDER BY calibrated_at, id'
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        # later rows overwrite earlier ones
+        return dict(rows)
+
+    def history(self, station=None):
+        query = f'SELECT {", ".join(COLUMNS)} FROM calibrations'
+        params = ()
+        if station is not None:
+            query += ' WHERE station = ?'
+            params = (station,)
+        query += ' ORDER BY calibrated_at, id'
+
+        with self.lock:
+            return [dict(zip(COLUMNS, row)) for row in self.conn.execute(query, params)]
+
+    def close(self):
+        self.conn.close()
+
+
+def store_from_env():
+    '''CalibrationStore at FISH_CALIBRATION_DB (default fish_calibration.db).'''
+    return CalibrationStore(os.environ.get('FISH_CALIBRATION_DB', 'fish_calibration.db'),
+                            cache_seconds=float(os.environ.get('FISH_CALIBRATION_CACHE_S', 5)))
+
+
+def parse_time(value):
+    '''Seconds since epoch from a number or an ISO date/time string.'''
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibration (cm/pixel) store per station and session.')
+    parser.add_argument('--db', type=str, default='fish_calibration.db')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_add = subparsers.add_parser('add', help='record a calibration')
+    parser_add.add_argument('--station', type=str, required=True)
+    parser_add.add_argument('--session', type=str, default='')
+    parser_add.add_argument('--pixel_size', type=float, required=True, help='cm/pixel')
+    parser_add.add_argument('--at', type=str, default=None, help='time (ISO or epoch seconds), default now')
+
+    parser_lookup = subparsers.add_parser('lookup', help='calibration in effect at a time')
+    parser_lookup.add_argument('--station', type=str, required=True)
+    parser_lookup.add_argument('--session', type=str, default=None)
+    parser_lookup.add_argument('--at', type=str, default=None, help='time (ISO or epoch seconds), default now')
+
+    parser_history = subparsers.add_parser('history', help='all calibrations')
+    parser_history.add_argument('--station', type=str, default=None)
+
+    parser_sessions = subparsers.add_parser('sessions', help='latest pixel size of every session as JSON')
+    parser_sessions.add_argument('--station', type=str, default=None)
+    parser_sessions.add_argument('--output', type=str, default='')
+
+    args = parser.parse_args()
+    store = CalibrationStore(args.db)
+
+    if args.command == 'add':
+        result = store.add(args.station, args.pixel_size, args.session, calibrated_at=parse_time(args.at))
+    elif args.command == 'lookup':
+        result = store.at(args.station, parse_time(args.at), args.session)
+    elif args.command == 'history':
+        result = store.history(args.station)
+    else:
+        result = store.sessions(args.station)
+        if len(args.output):
+            with open(args.output, 'w') as f:
+                json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+'''
+Optimized CPU inference mode (opt-in).
+
+Measurement stations have no GPU. With FISH_CPU_OPTIMIZE=freeze, the
+TorchScript detector, segmentator and species classifier of every worker are
+frozen right after loading (torch.jit.freeze folds weights in as constants
+and fuses conv + batchnorm) and run through torch.jit.optimize_for_inference.
+
+The networks only ship as TorchScript files, which eager-mode int8
+quantization cannot rewrite, so there is no int8 mode: quantizing the few
+Linear layers of WeightNet alone saved nothing measurable (the NumPy
+evaluator of fish_weight_numpy.py is the fast weight model on CPU).
+
+Check a mode against the float32 path on held-out images before turning it
+on at the stations (exit code 1 when a tolerance is exceeded):
+
+    python fish_cpu_optimize.py --images /data/fish/heldout --mode freeze --tolerance 0.01
+'''
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+
+OPTIMIZE_MODES = ('', 'freeze')
+
+
+def optimize_script_module(module):
+    '''Frozen and inference-optimized copy of a TorchScript module.'''
+    module = module.eval()
+    try:
+        frozen = torch.jit.freeze(module)
+        return torch.jit.optimize_for_inference(frozen)
+    except Exception as e:
+        # e.g. scripted methods other than forward that freezing would drop
+        logging.warning(f"[OPTIMIZE] Cannot freeze TorchScript module, kept as is: {e}")
+        return module
+
+
+def optimize_model_attribute(owner, attribute='model'):
+    '''Replace owner.<attribute> by its optimized version if it is TorchScript.'''
+    module = getattr(owner, attribute, None)
+    if isinstance(module, torch.jit.ScriptModule):
+        setattr(owner, attribute, optimize_script_module(module))
+        return True
+    return False
+
+
+def check_mode(mode):
+    if mode not in OPTIMIZE_MODES:
+        raise ValueError(f'Unknown CPU optimize mode: {mode} (one of {OPTIMIZE_MODES[1:]})')
+
+
+def optimize_pipeline(pipeline, mode):
+    '''
+    Apply an optimize mode ('' or 'freeze') to the models of a FishPipeline
+    in place. GPU pipelines are left untouched.
+    '''
+    check_mode(mode)
+    if mode == '':
+        return pipeline
+    if torch.device(pipeline.device).type != 'cpu':
+        logging.warning(f"[OPTIMIZE] {mode} mode is for CPU inference, pipeline on {pipeline.device} unchanged")
+        return pipeline
+
+    # CropSegmentator keeps its TorchScript model in the shipped Inference
+    segmentator = getattr(pipeline.segmentator, 'inference', pipeline.segmentator)
+    for name, owner in (('segmentator', segmentator), ('detector', pipeline.detector)):
+        if not optimize_model_attribute(owner):
+            logging.warning(f"[OPTIMIZE] {name} has no TorchScript model to freeze")
+
+    # frozen graphs may move detections slightly: keep their cache entries apart
+    pipeline.versions = dict(pipeline.versions, optimize=mode)
+    return pipeline
+
+
+def optimize_classifier(classifier, mode, device='cpu'):
+    '''Apply an optimize mode to the TorchScript model of an EmbeddingClassifier in place.'''
+    check_mode(mode)
+    if mode == '':
+        return classifier
+    if torch.device(device).type != 'cpu':
+        logging.warning(f"[OPTIMIZE] {mode} mode is for CPU inference, classifier on {device} unchanged")
+        return classifier
+
+    if not optimize_model_attribute(classifier):
+        logging.warning("[OPTIMIZE] classifier has no TorchScript model to freeze")
+    return classifier
+
+
+def mode_from_env():
+    return os.environ.get('FISH_CPU_OPTIMIZE', '')
+
+
+def match_fish(reference, candidate):
+    '''
+    Pair fish of the same image by nearest rotated box centre. Return a
+    list of (reference record, candidate record).
+    '''
+    def centre(fish):
+        return np.asarray(fish['bounding_box'], dtype=np.float64).reshape(-1, 2).mean(axis=0)
+
+    remaining = list(range(len(candidate)))
+    pairs = []
+    for ref in reference:
+        if len(remaining) == 0:
+            break
+        distances = [np.linalg.norm(centre(ref) - centre(candidate[idx])) for idx in remaining]
+        pairs.append((ref, candidate[remaining.pop(int(np.argmin(distances)))]))
+    return pairs
+
+
+def relative_error(a, b):
+    return abs(a - b) / max(abs(a), 1e-6)
+
+
+def compare_pipelines(reference, candidate, images, calibration_factor):
+    '''
+    Measure every image with both pipelines. Return the accuracy report:
+    relative errors of length (fish_width), area and mass of matched fish,
+    images whose fish count differs, and mean latency of both pipelines.
+    '''
+    errors = {'length': [], 'area': [], 'mass': []}
+    count_mismatch = 0
+    times = {'reference': 0.0, 'candidate': 0.0}
+
+    for image in images:
+        start = time.perf_counter()
+        ref_fish = reference.measure(image, calibration_factor)
+        times['reference'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        cand_fish = candidate.measure(image, calibration_factor)
+        times['candidate'] += time.perf_counter() - start
+
+        if len(ref_fish) != len(cand_fish):
+            count_mismatch += 1
+        for ref, cand in match_fish(ref_fish, cand_fish):
+            errors['length'].append(relative_error(ref['fish_width'], cand['fish_width']))
+            errors['area'].append(relative_error(ref['fish_area'], cand['fish_area']))
+            errors['mass'].append(relative_error(ref['fish_mass'], cand['fish_mass']))
+
+    report = {
+        'images': len(images),
+        'fish_compared': len(errors['length']),
+        'count_mismatch_images': count_mismatch,
+        'reference_ms_per_image': times['reference'] / max(len(images), 1) * 1000,
+        'candidate_ms_per_image': times['candidate'] / max(len(images), 1) * 1000,
+    }
+    report['speedup'] = report['reference_ms_per_image'] / max(report['candidate_ms_per_image'], 1e-9)
+    for name, values in errors.items():
+        values = np.asarray(values) if len(values) else np.zeros(1)
+        report[f'{name}_rel_error_mean'] = float(values.mean())
+        report[f'{name}_rel_error_p95'] = float(np.percentile(values, 95))
+        report[f'{name}_rel_error_max'] = float(values.max())
+    return report
+
+
+def passes(report, tolerance, max_count_mismatch=0):
+    '''True when the 95th percentile error of every output is within tolerance.'''
+    return report['count_mismatch_images'] <= max_count_mismatch and \
+        all(report[f'{name}_rel_error_p95'] <= tolerance for name in ('length', 'area', 'mass'))
+
+
+def main():
+    from fish_pipeline import decode_image
+    from fish_weight_model import WeightNet
+    from fish_widthheight_area_dataset_generator import build_pipeline, download_models, list_images, read_bytes
+
+    parser = argparse.ArgumentParser(description='Accuracy guard: optimized CPU mode vs float32 on held-out images.')
+    parser.add_argument('--images', type=str, nargs='+', required=True, help='held-out image folders')
+    parser.add_argument('--mode', type=str, default='freeze', choices=[mode for mode in OPTIMIZE_MODES if mode])
+    parser.add_argument('--max_images', type=int, default=100)
+    parser.add_argument('--conf_threshold', type=float, default=0.9, help='detector confidence threshold (API uses 0.9)')
+    parser.add_argument('--pixel_size', type=float, default=0.0039, help='cm/pixel applied to both pipelines')
+    parser.add_argument('--weight_model', type=str, default='fish_saved_weights/model_epoch80_0.15009590983390808.pth')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='max p95 relative error of length, area and mass')
+    parser.add_argument('--output', type=str, default='', help='write the report as JSON')
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    download_models()
+
+    def load_pipeline():
+        pipeline = build_pipeline(args.conf_threshold)
+        weight_model = WeightNet()
+        weight_model.load_state_dict(torch.load(args.weight_model, map_location='cpu'))
+        pipeline.weight_model = weight_model.eval()
+        return pipeline
+
+    reference = load_pipeline()
+    candidate = optimize_pipeline(load_pipeline(), args.mode)
+    reference.warm_up()
+    candidate.warm_up()
+
+    images = [decode_image(read_bytes(path)) for path in list_images(args.images)[:args.max_images]]
+    report = compare_pipelines(reference, candidate, images, args.pixel_size)
+    report.update({'mode': args.mode, 'tolerance': args.tolerance, 'passed': passes(report, args.tolerance)})
+
+    print(json.dumps(report, indent=2))
+    if len(args.output):
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if not report['passed']:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+'''
+Fish shape measurements computed directly from the segmentation polygon.
+
+The old path filled the polygon into a full-size crop mask, converted it to
+grey, ran findContours to get the same outline back and only then called
+minAreaRect. Every descriptor here is computed from the polygon points, so
+no image-sized buffer is allocated. UNIT: PIXEL SIZE.
+
+    measure_polygon : rotated box, width (fish length), height, area,
+                      perimeter and other shape descriptors
+
+Compare with the raster path on stored polygons (JSONL from
+fish_widthheight_area_dataset_generator.py):
+
+    python fish_geometry.py bbox_area_dataset.jsonl
+'''
+
+import argparse
+import json
+
+import cv2
+import numpy as np
+
+# bump when the measurement record changes, so cached measurements are redone
+MEASUREMENT_VERSION = 2
+
+
+def rotated_box_size(boxx):
+    '''
+    Width (longer side, fish length) and height of the 4 rotated box points,
+    measured exactly as the original dataset generator did.
+    '''
+    fish_height = np.sqrt((boxx[0, 0] - boxx[1, 0])**2 + (boxx[0, 1] - boxx[1, 1])**2)
+    fish_width = np.sqrt((boxx[2, 0] - boxx[1, 0])**2 + (boxx[2, 1] - boxx[1, 1])**2)
+    if fish_height > fish_width:
+        fish_height, fish_width = fish_width, fish_height
+    return float(fish_width), float(fish_height)
+
+
+def measure_polygon(points, offset=(0, 0)):
+    '''
+    Measure a fish outline.
+
+        points : (N, 2) polygon in crop coordinates
+        offset : (x, y) of the crop in the image; box and polygon are returned
+                 in image coordinates
+
+    Return dict with bounding_box (4 rotated box points), width, height,
+    area, perimeter, convex_area, solidity, aspect_ratio, equivalent_diameter,
+    centroid and angle (of the rotated box, degrees) plus the polygon.
+    '''
+    contour = np.asarray(points, dtype=np.int32).reshape(-1, 1, 2)
+
+    # Compute the minimum area rotated bounding rectangle
+    rect = cv2.minAreaRect(contour)
+    boxx = cv2.boxPoints(rect)
+
+    # return location to origon image:
+    boxx[:, 0] += offset[0]
+    boxx[:, 1] += offset[1]
+    boxx = np.intp(boxx)
+
+    fish_width, fish_height = rotated_box_size(boxx)
+
+    area = float(cv2.contourArea(contour))
+    perimeter = float(cv2.arcLength(contour, True))
+    convex_area = float(cv2.contourArea(cv2.convexHull(contour)))
+
+    moments = cv2.moments(contour)
+    if moments['m00'] != 0:
+        centroid = [moments['m10'] / moments['m00'] + offset[0], moments['m01'] / moments['m00'] + offset[1]]
+    else:
+        centroid = [float(rect[0][0] + offset[0]), float(rect[0][1] + offset[1])]
+
+    return {
+        'bounding_box': boxx.tolist(),
+        'width': fish_width,
+        'height': fish_height,
+        'area': area,
+        'perimeter': perimeter,
+        'convex_area': convex_area,
+        'solidity': area / convex_area if convex_area > 0 else 0.0,
+        'aspect_ratio': fish_width / fish_height if fish_height > 0 else 0.0,
+        'equivalent_diameter': float(np.sqrt(4 * area / np.pi)),
+        'centroid': centroid,
+        'angle': float(rect[2]),
+        'polygon': (contour.reshape(-1, 2) + np.array(offset, dtype=np.int32)).tolist(),
+    }
+
+
+def measure_polygon_raster(points, shape):
+    '''
+    Original mask based measurement (fillPoly -> findContours ->
+    minAreaRect) on a crop of the given shape. Kept to check measure_polygon.
+    '''
+    mask = np.zeros(shape[:2], dtype=np.uint8)
+    cv2.fillPoly(mask, [np.asarray(points, dtype=np.int32)], 255)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contour = max(contours, key=cv2.contourArea)
+
+    boxx = np.intp(cv2.boxPoints(cv2.minAreaRect(contour)))
+    fish_width, fish_height = rotated_box_size(boxx)
+    return {'width': fish_width, 'height': fish_height}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare polygon and raster measurements on stored polygons.')
+    parser.add_argument('jsonl', type=str, help='generator output with polygons')
+    args = parser.parse_args()
+
+    diffs = []
+    with open(args.jsonl, 'r') as f:
+        for line in f:
+            for fish in json.loads(line)['fish']:
+                points = np.asarray(fish.get('polygon', []), dtype=np.int32)
+                if len(points) < 3:
+                    continue
+                # shift into a tight crop
+                points = points - points.min(axis=0)
+                shape = tuple(points.max(axis=0)[::-1] + 1)
+
+                fast = measure_polygon(points)
+                slow = measure_polygon_raster(points, shape)
+                diffs.append([abs(fast['width'] - slow['width']), abs(fast['height'] - slow['height'])])
+
+    diffs = np.array(diffs).reshape(-1, 2)
+    if len(diffs) == 0:
+        print('No polygons found.')
+        return
+    print(f'{len(diffs)} fish compared')
+    print(f'Width  diff [pixel]: mean {diffs[:, 0].mean():.3f}, max {diffs[:, 0].max():.3f}')
+    print(f'Height diff [pixel]: mean {diffs[:, 1].mean():.3f}, max {diffs[:, 1].max():.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+'''
+Persistent pixel-space measurement store.
+
+Detector and segmentation outputs do not depend on calibration or on the
+weight model, so they are measured once per image and kept in a SQLite
+database (UNIT: PIXEL SIZE):
+
+    image_path, fish_idx, width, height, area, bounding_box, polygon
+
+Calibration (cm/pixel) and weight regression are then cheap vectorized
+passes over the stored arrays, instead of re-running the CNNs over every
+image when a pixel size or WeightNet changes.
+
+    # fill the store from the generator output
+    python fish_measurement_store.py import bbox_area_dataset.jsonl --db fish_measurements.db
+
+    # apply calibration + weight model to every stored fish
+    python fish_measurement_store.py export --db fish_measurements.db --pixel_size 0.0039 \\
+        --weight_model fish_saved_weights/model_epoch80_0.15009590983390808.pth --output fish_real_size.csv
+'''
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+class MeasurementStore:
+    '''
+    SQLite store of pixel measurements keyed by (image_path, fish_idx).
+
+    Safe to share between the threads of one process; several processes may
+    open the same file (SQLite WAL mode).
+    '''
+    def __init__(self, db_path='fish_measurements.db'):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS images (
+                image_path TEXT PRIMARY KEY,
+                fish_count INTEGER NOT NULL,
+                versions TEXT,
+                measured_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS fish (
+                image_path TEXT NOT NULL,
+                fish_idx INTEGER NOT NULL,
+                width REAL NOT NULL,
+                height REAL NOT NULL,
+                area REAL NOT NULL,
+                bounding_box TEXT,
+                polygon TEXT,
+                PRIMARY KEY (image_path, fish_idx)
+            );
+        ''')
+        self.conn.commit()
+
+    def add_image(self, image_path, measurements, versions=None):
+        '''Replace the stored measurements of one image.'''
+        rows = [(image_path, idx, m['width'], m['height'], m['area'],
+                 json.dumps(m.get('bounding_box', [])), json.dumps(m.get('polygon', [])))
+                for idx, m in enumerate(measurements)]
+
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM fish WHERE image_path = ?', (image_path,))
+            self.conn.executemany('INSERT INTO fish VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.conn.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)',
+                              (image_path, len(rows), json.dumps(versions or {}), time.time()))
+
+    def measured_paths(self):
+        with self.lock:
+            return set(row[0] for row in self.conn.execute('SELECT image_path FROM images'))
+
+    def get_image(self, image_path):
+        '''Stored measurements of one image, or None if it was never measured.'''
+        with self.lock:
+            if self.conn.execute('SELECT 1 FROM images WHERE image_path = ?', (image_path,)).fetchone() is None:
+                return None
+            rows = self.conn.execute('SELECT width, height, area, bounding_box, polygon FROM fish '
+                                     'WHERE image_path = ? ORDER BY fish_idx', (image_path,)).fetchall()
+        return [{'width': w, 'height': h, 'area': a,
+                 'bounding_box': json.loads(bbox), 'polygon': json.loads(poly)} for w, h, a, bbox, poly in rows]
+
+    def arrays(self, path_like=None):
+        '''
+        All stored fish as column arrays (polygons are not loaded):
+
+            image_path (object), fish_idx (int64), width, height, area (float64)
+
+        path_like : optional SQL LIKE pattern on image_path, e.g. '%12-11-24%'
+        '''
+        query = 'SELECT image_path, fish_idx, width, height, area FROM fish'
+        params = ()
+        if path_like is not None:
+            query += ' WHERE image_path LIKE ?'
+            params = (path_like,)
+        query += ' ORDER BY image_path, fish_idx'
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+
+        columns = list(zip(*rows)) if len(rows) else [[]] * 5
+        return {
+            'image_path': np.array(columns[0], dtype=object),
+            'fish_idx': np.array(columns[1], dtype=np.int64),
+            'width': np.array(columns[2], dtype=np.float64),
+            'height': np.array(columns[3], dtype=np.float64),
+            'area': np.array(columns[4], dtype=np.float64),
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+def pixel_sizes_for(image_paths, pixel_size_by_key, default=np.nan):
+    '''
+    Pixel size (cm/pixel) of every image path, picked by the first key of
+    pixel_size_by_key contained in the path (e.g. study date '12-11-24').
+
+    Matching is done once per unique directory, not once per fish.
+    '''
+    dirs = np.array([os.path.dirname(path) for path in image_paths], dtype=object)
+    unique_dirs, inverse = np.unique(dirs, return_inverse=True) if len(dirs) else (dirs, np.zeros(0, int))
+
+    dir_sizes = np.full(len(unique_dirs), default, dtype=np.float64)
+    for i, directory in enumerate(unique_dirs):
+        for key, pixel_size in pixel_size_by_key.items():
+            if key in directory:
+                dir_sizes[i] = pixel_size
+                break
+    return dir_sizes[inverse]
+
+
+def calibrate(arrays, pixel_size):
+    '''
+    Convert stored pixel arrays to real size in one vectorized pass.
+
+        pixel_size : scalar or per-fish array (cm/pixel)
+
+    Return (N, 3) float32 feature matrix [width, height, area] in cm / cm^2.
+    '''
+    pixel_size = np.asarray(pixel_size, dtype=np.float64)
+    return np.stack([arrays['width'] * pixel_size,
+                     arrays['height'] * pixel_size,
+                     arrays['area'] * pixel_size ** 2], axis=1).astype(np.float32)
+
+
+def predict_weights(weight_model, features, device='cpu', batch_size=65536):
+    '''Run the weight model over an (N, 3) feature matrix in large batches.'''
+    if hasattr(weight_model, 'predict'):
+        # NumPy evaluator (fish_weight_numpy.py): no torch needed
+        return weight_model.predict(features)
+
+    import torch
+
+    weights = []
+    with torch.no_grad():
+        for start in range(0, len(features), batch_size):
+            batch = torch.from_numpy(features[start:start + batch_size]).to(device)
+            weights.append(weight_model(batch).view(-1).cpu().numpy())
+    return np.concatenate(weights) if len(weights) else np.zeros(0, dtype=np.float32)
+
+
+def import_jsonl(store, jsonl_path):
+    '''Load generator output (one JSON line per image) into the store.'''
+    count = 0
+    with open(jsonl_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            store.add_image(record['image_path'], record['fish'])
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pixel-space fish measurement store.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_import = subparsers.add_parser('import', help='import generator JSONL output')
+    parser_import.add_argument('jsonl', type=str)
+    parser_import.add_argument('--db', type=str, default='fish_measurements.db')
+
+    parser_export = subparsers.add_parser('export', help='calibrate (+ weigh) all stored fish into a CSV')
+    parser_export.add_argument('--db', type=str, default='fish_measurements.db')
+    parser_export.add_argument('--pixel_size', type=float, default=0, help='cm/pixel for every image')
+    parser_export.add_argument('--pixel_size_json', type=str, default='', help='JSON {path key: cm/pixel}, e.g. per study date')
+    parser_export.add_argument('--calibration_db', type=str, default='', help='calibration store: latest pixel size of every session found in the path')
+    parser_export.add_argument('--weight_model', type=str, default='', help='WeightNet state dict or exported .npz evaluator (optional)')
+    parser_export.add_argument('--output', type=str, default='fish_real_size.csv')
+
+    args = parser.parse_args()
+    store = MeasurementStore(args.db)
+
+    if args.command == 'import':
+        print(f'{import_jsonl(store, args.jsonl)} images imported into {args.db}')
+        return
+
+    import pandas as pd
+
+    arrays = store.arrays()
+    if len(args.pixel_size_json):
+        with open(args.pixel_size_json, 'r') as f:
+            pixel_size = pixel_sizes_for(arrays['image_path'], json.load(f))
+    elif len(args.calibration_db):
+        from fish_calibration_store import CalibrationStore
+        pixel_size = pixel_sizes_for(arrays['image_path'], CalibrationStore(args.calibration_db).sessions())
+    else:
+        pixel_size = args.pixel_size
+    features = calibrate(arrays, pixel_size)
+
+    table = pd.DataFrame({
+        'image_path': arrays['image_path'],
+        'fish_idx': arrays['fish_idx'],
+        'length': features[:, 0],
+        'height': features[:, 1],
+        'area': features[:, 2],
+    })
+
+    if args.weight_model.endswith('.npz'):
+        from fish_weight_numpy import load_evaluator
+
+        table['weight'] = predict_weights(load_evaluator(args.weight_model), features)
+    elif len(args.weight_model):
+        import torch
+        from fish_weight_model import WeightNet
+
+        weight_model = WeightNet()
+        weight_model.load_state_dict(torch.load(args.weight_model, map_location='cpu'))
+        weight_model.eval()
+        table['weight'] = predict_weights(weight_model, features)
+
+    table.to_csv(args.output, index=False)
+    print(f'{len(table)} fish written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+'''
+Per-stage instrumentation of the measurement pipeline.
+
+Inference workers (threads or processes) time their stages into a
+StageTimer owned by their FishPipeline; every job ships the collected
+observations back with its results and the API process adds them to the
+Metrics registry, which /metrics renders in the Prometheus text format:
+
+    fish_stage_seconds{stage=...}   histogram: decode, detection,
+                                    segmentation, segmentation_per_fish,
+                                    geometry, weight, request (end to end)
+    fish_per_image                  histogram of detected fish per image
+    fish_batch_images               histogram of images per batched job
+    fish_model_load_seconds{model=} gauge: model load / warm-up times
+    fish_inference_pending, ...     gauges read when scraped (queue depth)
+
+With FISH_METRICS_LOG=1 every batched job is also logged as one JSON line.
+'''
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds, from a cached lookup to a 24MP image on a slow CPU
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class StageTimer:
+    '''
+    Observations recorded inside one worker, drained with every job:
+
+        ('stage', stage, seconds) and ('model_load', model, seconds)
+    '''
+    def __init__(self):
+        self.observations = []
+
+    def add(self, stage, seconds):
+        self.observations.append(('stage', stage, seconds))
+
+    def model_loaded(self, model, seconds):
+        self.observations.append(('model_load', model, seconds))
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def drain(self):
+        observations, self.observations = self.observations, []
+        return observations
+
+
+@contextmanager
+def timed(timer, stage):
+    '''timer.time(stage), or nothing when the pipeline is not instrumented.'''
+    if timer is None:
+        yield
+    else:
+        with timer.time(stage):
+            yield
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Histogram:
+    '''Cumulative-bucket histogram family, one series per label value.'''
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label = label
+        self.series = {}
+
+    def observe(self, value, label_value=None):
+        series = self.series.get(label_value)
+        if series is None:
+            series = self.series[label_value] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                series['counts'][idx] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label_value, series in sorted(self.series.items(), key=lambda item: str(item[0])):
+            labels = [] if self.label is None else [(self.label, label_value)]
+            for bound, count in zip(self.buckets, series['counts']):
+                lines.append(f'{self.name}_bucket{format_labels(labels + [("le", bound)])} {count}')
+            lines.append(f'{self.name}_bucket{format_labels(labels + [("le", "+Inf")])} {series["count"]}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {series["sum"]}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {series["count"]}')
+        return lines
+
+
+class Gauge:
+    '''Gauge family; values are set, or read from callbacks when rendered.'''
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.callbacks = {}
+
+    def set(self, value, label_value=None):
+        self.values[label_value] = value
+
+    def set_function(self, function, label_value=None):
+        self.callbacks[label_value] = function
+
+    def render(self):
+        values = dict(self.values)
+        for label_value, function in self.callbacks.items():
+            try:
+                values[label_value] = function()
+            except Exception:
+                continue
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        for label_value, value in sorted(values.items(), key=lambda item: str(item[0])):
+            labels = [] if self.label is None else [(self.label, label_value)]
+            lines.append(f'{self.name}{format_labels(labels)} {float(value)}')
+        return lines
+
+
+class Metrics:
+    '''Metrics of the API process.'''
+    def __init__(self, log=False):
+        self.lock = threading.Lock()
+        self.log = log
+        self.stage_seconds = Histogram('fish_stage_seconds', 'Pipeline stage latency in seconds.', label='stage')
+        self.fish_per_image = Histogram('fish_per_image', 'Fish detected per image.', COUNT_BUCKETS)
+        self.batch_images = Histogram('fish_batch_images', 'Images per batched inference job.', COUNT_BUCKETS)
+        self.model_load_seconds = Gauge('fish_model_load_seconds', 'Model load and warm-up time in seconds.',
+                                        label='model')
+        self.gauges = {}
+
+    def gauge(self, name, help, function):
+        '''Register a gauge read from function() at every scrape.'''
+        gauge = self.gauges.get(name)
+        if gauge is None:
+            gauge = self.gauges[name] = Gauge(name, help)
+        gauge.set_function(function)
+
+    def observe_stage(self, stage, seconds):
+        with self.lock:
+            self.stage_seconds.observe(seconds, stage)
+
+    def apply(self, observations):
+        '''Add observations drained from a worker's StageTimer.'''
+        with self.lock:
+            for kind, label, value in observations:
+                if kind == 'stage':
+                    self.stage_seconds.observe(value, label)
+                elif kind == 'model_load':
+                    self.model_load_seconds.set(value, label)
+
+    def record_batch(self, observations, fish_counts):
+        '''One batched job: worker observations and fish count of every image.'''
+        self.apply(observations)
+        with self.lock:
+            self.batch_images.observe(len(fish_counts))
+            for count in fish_counts:
+                self.fish_per_image.observe(count)
+
+        if self.log:
+            stages = {}
+            for kind, label, value in observations:
+                if kind == 'stage':
+                    stages[label] = stages.get(label, 0.0) + value
+            logging.info(json.dumps({'event': 'inference_batch', 'images': len(fish_counts),
+                                     'fish': list(fish_counts), 'stage_seconds': stages}))
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for metric in [self.stage_seconds, self.fish_per_image, self.batch_images, self.model_load_seconds] + \
+                    list(self.gauges.values()):
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,131 @@
+'''
+Lazy model registry for the API server and the scripts.
+
+Nothing is downloaded or loaded at import time. A model's zip is fetched the
+first time one of its files is asked for, and only models that a route
+actually uses are ever fetched (the face detector is never needed by the
+measurement pipeline, so it is never downloaded).
+
+    registry = ModelRegistry()
+    registry.register('detection', load_detector)   # loader(registry) -> model
+    detector = registry.load('detection')            # new instance, e.g. per worker
+    classifier = registry.get('classification')      # shared instance, loaded once
+
+Load times of every model are kept in registry.load_times (seconds).
+'''
+
+import logging
+import os
+import threading
+import time
+from zipfile import ZipFile
+
+import requests
+
+
+# Links to models
+MODEL_URLS = {
+    'classification': 'https://storage.googleapis.com/fishial-ml-resources/classification_rectangle_v7-1.zip',
+    'segmentation': 'https://storage.googleapis.com/fishial-ml-resources/segmentator_fpn_res18_416_1.zip',
+    'detection': 'https://storage.googleapis.com/fishial-ml-resources/detector_v10_m3.zip',
+    'face': 'https://storage.googleapis.com/fishial-ml-resources/face_yolo.zip'
+}
+
+# Model directories
+MODEL_DIRS = {
+    'classification': "models/classification",
+    'segmentation': "models/segmentation",
+    'detection': "models/detection",
+    'face': "models/face_detector"
+}
+
+
+def download_and_unzip(url, save_path, extract_dir):
+    print("Downloading assets...")
+    file = requests.get(url)
+
+    open(save_path, "wb").write(file.content)
+    print("Download completed.")
+
+    try:
+        if save_path.endswith(".zip"):
+            with ZipFile(save_path, 'r') as zip_ref:
+                zip_ref.extractall(extract_dir)
+            print("Extraction Done")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
+def get_basename(path):
+  return os.path.basename(path)
+
+
+def download_model(url, model_dir):
+    '''Download and unzip one model unless its directory already exists.'''
+    if os.path.exists(model_dir):
+        return
+
+    zip_path = os.path.join(os.getcwd(), get_basename(url))
+    os.makedirs(model_dir, exist_ok=True)  # Create directory if it doesn't exist
+    download_and_unzip(url, zip_path, model_dir)  # Download and unzip the model
+
+    # Remove the zip file after extraction
+    try:
+        os.remove(zip_path)
+        logging.info(f"Removed zip file {zip_path}")
+    except Exception as e:
+        logging.error(f"Failed to remove zip file {zip_path}: {e}")
+
+
+class ModelRegistry:
+    '''
+    Named model loaders, downloaded and loaded on first use.
+
+        model_urls : name -> zip url of models that are downloaded
+        model_dirs : name -> directory the zip is extracted to
+    '''
+    def __init__(self, model_urls=MODEL_URLS, model_dirs=MODEL_DIRS):
+        self.model_urls = model_urls
+        self.model_dirs = model_dirs
+        self.loaders = {}
+        self.shared = {}
+        self.load_times = {}
+        # downloads and shared loads happen once, even with many worker threads
+        self.lock = threading.RLock()
+
+    def register(self, name, loader):
+        '''loader(registry) builds and returns a new instance of the model.'''
+        self.loaders[name] = loader
+
+    def ensure_files(self, name):
+        '''Download the files of a model if they are not on disk yet.'''
+        if name not in self.model_urls:
+            return
+        with self.lock:
+            download_model(self.model_urls[name], self.model_dirs[name])
+
+    def path(self, name, filename='model.ts'):
+        '''Path of a model file, downloading the model first if needed.'''
+        self.ensure_files(name)
+        return os.path.join(self.model_dirs[name], filename)
+
+    def load(self, name):
+        '''Build a new instance of a registered model.'''
+        if name not in self.loaders:
+            raise KeyError(f'No loader registered for model: {name}')
+
+        start = time.perf_counter()
+        model = self.loaders[name](self)
+        self.load_times[name] = time.perf_counter() - start
+        logging.info(f"[INIT][{name.upper()}] loaded in {self.load_times[name]:.2f} s")
+        return model
+
+    def get(self, name):
+        '''Instance of a model shared by every caller, loaded on first use.'''
+        with self.lock:
+            if name not in self.shared:
+                self.shared[name] = self.load(name)
+            return self.shared[name]
+
+    def is_loaded(self, name):
+        return name in self.shared
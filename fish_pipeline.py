@@ -0,0 +1,378 @@
+'''
+Shared fish measurement pipeline pieces used by the API (main.py) and the
+dataset generator scripts.
+
+    CropSegmentator  : the shipped segmentation Inference, one call per fish
+                       crop (default)
+    BatchSegmentator : run the segmentation TorchScript model once over all
+                       fish crops of an image (letterboxed into one tensor);
+                       opt-in until its parity with Inference is confirmed
+                       (fish_segmentation_parity.py)
+    measure_fish     : rotated box, width, height and area of one fish (pixel)
+    estimate_weights : calibrate pixel measurements and run the weight model
+                       once over all fish of an image.
+    FishPipeline     : detector + segmentator + weight model of one worker.
+'''
+
+import io
+import time
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from fish_result_cache import content_key, file_version
+from fish_geometry import measure_polygon, MEASUREMENT_VERSION
+from fish_metrics import timed
+
+
+class ImageDecodeError(ValueError):
+    '''Uploaded bytes are not a readable image (returned in the image's batch slot).'''
+
+
+class SegmentedPolygon:
+    '''
+    Fish outline predicted for one crop.
+
+        points : (N, 2) int32 polygon in crop coordinates
+        area   : polygon area in pixel^2
+    '''
+    def __init__(self, points):
+        self.points = np.asarray(points, dtype=np.int32).reshape(-1, 2)
+        self.area = float(cv2.contourArea(self.points)) if len(self.points) >= 3 else 0.0
+
+    def move_to(self, x, y):
+        self.points = self.points + np.array([int(x), int(y)], dtype=np.int32)
+
+    def mask_polygon(self, image):
+        mask = np.zeros(image.shape[:2], dtype=np.uint8)
+        cv2.fillPoly(mask, [self.points], 255)
+        return cv2.bitwise_and(image, image, mask=mask)
+
+    def draw_polygon(self, image, color=(0, 255, 0), thickness=2):
+        cv2.polylines(image, [self.points], True, color, thickness)
+
+    def to_dict(self):
+        return {'points': self.points.tolist(), 'area': self.area}
+
+
+class BatchSegmentator:
+    '''
+    Batched version of the fish segmentator.
+
+    Every crop is letterboxed (aspect preserving resize + constant padding)
+    into an image_size x image_size canvas, all canvases are stacked into a
+    single tensor and the TorchScript model is called once per batch. The
+    largest contour of every predicted mask is mapped back from the canvas
+    into the coordinates of its own crop.
+
+        model_path : segmentation TorchScript file (models/segmentation/model.ts)
+        image_size : network input size
+        threshold  : mask probability threshold
+        batch_size : max crops per forward pass (bounds peak memory)
+    '''
+    def __init__(self, model_path, image_size=416, threshold=0.5, batch_size=16, device='cpu',
+                 mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), pad_value=0):
+        self.device = device
+        self.image_size = image_size
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.pad_value = pad_value
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+
+        self.model = torch.jit.load(model_path, map_location=device)
+        self.model.eval()
+
+    def letterbox(self, image_bgr):
+        '''
+        Resize crop into the square network canvas keeping its aspect ratio.
+
+        Return canvas (RGB, uint8), scale and (pad_x, pad_y) offsets.
+        '''
+        h, w = image_bgr.shape[:2]
+        scale = self.image_size / max(h, w)
+        new_w, new_h = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+        pad_x, pad_y = (self.image_size - new_w) // 2, (self.image_size - new_h) // 2
+
+        canvas = np.full((self.image_size, self.image_size, 3), self.pad_value, dtype=np.uint8)
+        resized = cv2.resize(image_bgr, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+        canvas[pad_y:pad_y + new_h, pad_x:pad_x + new_w] = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+        return canvas, scale, (pad_x, pad_y)
+
+    def _forward(self, canvases):
+        batch = torch.from_numpy(np.stack(canvases)).permute(0, 3, 1, 2).float().div_(255.0)
+        batch = ((batch - self.mean) / self.std).to(self.device)
+
+        with torch.no_grad():
+            output = self.model(batch)
+        if isinstance(output, (list, tuple)):
+            output = output[0]
+        if output.dim() == 4:
+            output = output[:, 0]
+        return torch.sigmoid(output).cpu().numpy()
+
+    def _mask_to_polygon(self, prob, scale, pad, crop_shape):
+        mask = (prob > self.threshold).astype(np.uint8)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        if len(contours) == 0:
+            return None
+
+        # map the largest contour from canvas back into crop coordinates
+        contour = max(contours, key=cv2.contourArea).reshape(-1, 2).astype(np.float32)
+        contour = (contour - np.array(pad, dtype=np.float32)) / scale
+        h, w = crop_shape[:2]
+        contour[:, 0] = np.clip(contour[:, 0], 0, w - 1)
+        contour[:, 1] = np.clip(contour[:, 1], 0, h - 1)
+        return SegmentedPolygon(np.round(contour))
+
+    def predict(self, crops_bgr):
+        '''
+        Segment a list of BGR crops. Return one SegmentedPolygon (or None if
+        nothing was found) per crop, in input order.
+        '''
+        results = []
+        for start in range(0, len(crops_bgr), self.batch_size):
+            chunk = crops_bgr[start:start + self.batch_size]
+            letterboxed = [self.letterbox(crop) for crop in chunk]
+            probs = self._forward([canvas for canvas, _, _ in letterboxed])
+
+            for prob, (_, scale, pad), crop in zip(probs, letterboxed, chunk):
+                results.append(self._mask_to_polygon(prob, scale, pad, crop.shape))
+        return results
+
+
+class CropSegmentator:
+    '''
+    The shipped models/segmentation/inference.Inference behind the
+    BatchSegmentator interface: one Inference.predict call per crop.
+    '''
+    def __init__(self, model_path, image_size=416):
+        from models.segmentation.inference import Inference
+
+        self.inference = Inference(model_path=model_path, image_size=image_size)
+
+    def predict(self, crops_bgr):
+        '''One polygon (or None if nothing was found) per BGR crop, in input order.'''
+        results = []
+        for crop in crops_bgr:
+            polygons = self.inference.predict(crop)
+            results.append(polygons[0] if len(polygons) else None)
+        return results
+
+
+def build_segmentator(model_path, image_size=416, batched=False):
+    '''Segmentator of the measurement pipeline: the shipped Inference, or BatchSegmentator if batched.'''
+    if batched:
+        return BatchSegmentator(model_path=model_path, image_size=image_size)
+    return CropSegmentator(model_path=model_path, image_size=image_size)
+
+
+def segmentator_version(model_path, image_size=416, batched=False):
+    '''Cache version of a build_segmentator segmentator: both paths may draw different polygons.'''
+    return file_version(model_path) + f'@{image_size}' + ('-batch' if batched else '')
+
+
+def measure_fish(box, segmented_polygons):
+    '''
+    Measure a single segmented fish in pixel units.
+
+        box                : detector box (x1, y1 offset of the crop)
+        segmented_polygons : polygon predicted for the crop of this box
+
+    Return the fish_geometry.measure_polygon dict: rotated bounding box (4
+    points in image coordinates), fish width (length along the fish), fish
+    height, polygon area, shape descriptors and the raw polygon (image
+    coordinates). Computed from the polygon only, no mask is rasterized.
+    '''
+    return measure_polygon(segmented_polygons.points, offset=(box.x1, box.y1))
+
+
+def estimate_weights(weight_model, measurements, calibration_factor, device='cpu'):
+    '''
+    Convert pixel measurements to real size and predict fish mass.
+
+    The weight model runs once on a (N, 3) tensor of [width, height, area]
+    for all fish. Return one record per measurement with the keys used by
+    the /detect/ response.
+    '''
+    if len(measurements) == 0:
+        return []
+
+    features = np.array([[m['width'] * calibration_factor,
+                          m['height'] * calibration_factor,
+                          m['area'] * calibration_factor * calibration_factor] for m in measurements],
+                        dtype=np.float32)
+
+    if hasattr(weight_model, 'predict'):
+        # torch-free evaluator exported by fish_weight_numpy.py
+        fish_weights = weight_model.predict(features)
+    else:
+        with torch.no_grad():
+            fish_weights = weight_model(torch.from_numpy(features).to(device)).view(-1).cpu().numpy()
+
+    return [{
+        'bounding_box': m['bounding_box'],
+        'fish_width': float(feature[0]),
+        'fish_height': float(feature[1]),
+        'fish_area': float(feature[2]),
+        'fish_mass': float(weight),
+    } for m, feature, weight in zip(measurements, features, fish_weights)]
+
+
+# cache version of decode_image: PIL keeps RGB order and ignores EXIF orientation
+DECODE_IMAGE_VERSION = 'pil-rgb'
+
+
+def decode_image(contents):
+    '''Decode uploaded image bytes into an RGB array.'''
+    return np.array(Image.open(io.BytesIO(contents)))
+
+
+class FishPipeline:
+    '''
+    Models needed to measure fish in one image: detect -> segment -> measure
+    -> weigh. Every inference worker owns one instance.
+
+        cache       : optional fish_result_cache.ResultCache of pixel measurements
+        versions    : model versions the cache key depends on, e.g.
+                      {'detector': ..., 'segmentator': ...}
+        timer       : optional fish_metrics.StageTimer recording stage latency
+    '''
+    def __init__(self, detector, segmentator, weight_model=None, device='cpu', cache=None, versions=None,
+                 timer=None):
+        self.detector = detector
+        self.segmentator = segmentator
+        self.weight_model = weight_model
+        self.device = device
+        self.cache = cache
+        self.versions = versions if versions is not None else {}
+        self.timer = timer
+
+    def warm_up(self, image_size=640, runs=2):
+        '''
+        Run every model on blank inputs so the first request does not pay
+        for TorchScript graph profiling and allocator growth.
+        '''
+        image = np.zeros((image_size, image_size, 3), dtype=np.uint8)
+        crop = image[:image_size // 2, :image_size // 4]
+        for _ in range(runs):
+            self.detector.predict([image])
+            self.segmentator.predict([crop])
+            if self.weight_model is not None:
+                estimate_weights(self.weight_model, [{'bounding_box': [], 'width': 1.0, 'height': 1.0, 'area': 1.0}],
+                                 1.0, self.device)
+
+    def detect_boxes(self, images):
+        '''Detector boxes of several decoded images (decode_image output), one list per image.'''
+        with timed(self.timer, 'detection'):
+            visulize_imgs_rgb = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in images]
+            return self.detector.predict(visulize_imgs_rgb)
+
+    def measure_pixels_batch(self, images):
+        '''
+        Measure all fish of several image arrays in pixel units.
+
+        The detector runs once over the whole list, and all fish crops of
+        all images share segmentation forward passes. Return one list of
+        measure_fish records per image.
+        '''
+        if len(images) == 0:
+            return []
+
+        batch_boxes = self.detect_boxes(images)
+
+        # segment every detected fish of every image at once
+        crops = [box.get_mask_BGR() for boxes in batch_boxes for box in boxes]
+        start = time.perf_counter()
+        polygons = iter(self.segmentator.predict(crops))
+        if self.timer is not None and len(crops):
+            seconds = time.perf_counter() - start
+            self.timer.add('segmentation', seconds)
+            for _ in crops:
+                self.timer.add('segmentation_per_fish', seconds / len(crops))
+
+        results = []
+        with timed(self.timer, 'geometry'):
+            for boxes in batch_boxes:
+                # one pixel-space measurement per detected fish
+                measurements = []
+                for box in boxes:
+                    segmented_polygons = next(polygons)
+                    if segmented_polygons is not None:
+                        measurements.append(measure_fish(box, segmented_polygons))
+                results.append(measurements)
+        return results
+
+    def measure_batch(self, images, calibration_factors):
+        '''
+        Measure all fish of several RGB image arrays and predict their mass.
+        Return one list of fish records per image.
+        '''
+        results = []
+        for measurements, calibration_factor in zip(self.measure_pixels_batch(images), calibration_factors):
+            # convert to real size and predict all weights at once:
+            results.append(estimate_weights(self.weight_model, measurements, calibration_factor, self.device))
+        return results
+
+    def measure(self, image, calibration_factor):
+        '''
+        Measure all fish of an RGB image array. Return one record per fish.
+        '''
+        return self.measure_batch([image], [calibration_factor])[0]
+
+    def measure_bytes(self, contents, calibration_factor):
+        '''Decode uploaded image bytes and measure all fish.'''
+        return self.measure(decode_image(contents), calibration_factor)
+
+    def measure_pixels_contents(self, contents_list, decode=decode_image):
+        '''
+        Pixel measurements of encoded images, served from the cache when the
+        same bytes were already measured by the same models.
+
+        An image that fails to decode gets an ImageDecodeError in its result
+        slot instead of failing the other images of the batch.
+
+            decode : bytes -> image array
+        '''
+        results = [None] * len(contents_list)
+        keys = [None] * len(contents_list)
+        images, slots = [], []
+        for idx, contents in enumerate(contents_list):
+            if self.cache is not None:
+                keys[idx] = content_key(contents, dict(self.versions, geometry=MEASUREMENT_VERSION))
+                cached = self.cache.get(keys[idx])
+                if cached is not None:
+                    results[idx] = cached
+                    continue
+            try:
+                with timed(self.timer, 'decode'):
+                    images.append(decode(contents))
+            except Exception as e:
+                results[idx] = ImageDecodeError(f'Cannot decode image ({type(e).__name__})')
+                continue
+            slots.append(idx)
+
+        for idx, measurements in zip(slots, self.measure_pixels_batch(images)):
+            results[idx] = measurements
+            if self.cache is not None:
+                self.cache.put(keys[idx], measurements)
+        return results
+
+    def measure_uploads(self, uploads):
+        '''
+        Measure a batch of (image bytes, calibration factor) uploads. Return
+        one list of fish records (or the ImageDecodeError) per upload.
+        '''
+        measured = self.measure_pixels_contents([contents for contents, _ in uploads])
+
+        results = []
+        for measurements, (_, calibration_factor) in zip(measured, uploads):
+            if isinstance(measurements, Exception):
+                results.append(measurements)
+            else:
+                # convert to real size and predict all weights at once:
+                with timed(self.timer, 'weight'):
+                    results.append(estimate_weights(self.weight_model, measurements, calibration_factor, self.device))
+        return results
@@ -0,0 +1,163 @@
+'''
+On-disk, LRU-bounded cache of fish measurements keyed by image content.
+
+Stations often resend the same photo (operator retries, "re-measure",
+dataset regeneration). The cache stores the pixel-space measurements
+(rotated box, width, height, area) of an image under
+
+    sha256(image bytes) + detector version + segmentator version + decoder
+
+The decoder is part of the key because the API (PIL, RGB, no EXIF rotation)
+and the dataset generator (cv2, BGR, EXIF orientation applied) feed the
+detector different arrays for the same bytes.
+
+Calibration factor and weight model are applied after the lookup, so a new
+calibration or a retrained WeightNet still reuses every stored detection.
+
+Entries are small JSON files under cache_dir; when the total size exceeds
+max_bytes the least recently used entries are removed. Several processes may
+share one cache directory (writes are atomic renames); every process re-reads
+the directory every rescan_puts writes, so max_bytes bounds all of them
+together (up to rescan_puts entries per process in between).
+'''
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+def file_version(path, length=12):
+    '''Short content hash of a model file, used as its version.'''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()[:length]
+
+
+def content_key(contents, versions):
+    '''
+    Cache key of image bytes measured with the given model versions.
+
+        versions : dict, e.g. {'detector': ..., 'segmentator': ...}
+    '''
+    sha = hashlib.sha256(contents)
+    for name in sorted(versions):
+        sha.update(f'|{name}={versions[name]}'.encode())
+    return sha.hexdigest()
+
+
+class ResultCache:
+    '''
+    LRU cache of JSON values stored as files in cache_dir.
+
+        cache_dir   : directory holding the entries (created if missing)
+        max_bytes   : total size bound of all entries
+        rescan_puts : writes between two scans of the directory, which pick
+                      up the entries other processes wrote
+    '''
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024, rescan_puts=256):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.rescan_puts = rescan_puts
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        '''
+        Rebuild the LRU order from the directory: every entry, by access time
+        (get touches its file), whichever process wrote it.
+        '''
+        found = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.json'):
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except OSError:
+                        # removed by another process meanwhile
+                        continue
+                    found.append((stat.st_mtime, name[:-5], stat.st_size))
+
+        # key -> size, ordered from least to most recently used
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+        self.puts_since_scan = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        '''Return the cached value or None.'''
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        # touch so other processes sharing the directory see the access too
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        with self.lock:
+            self.hits += 1
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            else:
+                # written by another process
+                self.entries[key] = os.path.getsize(path)
+                self.total_bytes += self.entries[key]
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        data = json.dumps(value)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self.total_bytes += len(data)
+            self.puts_since_scan += 1
+            if self.puts_since_scan >= self.rescan_puts:
+                self._scan()
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+def cache_from_env():
+    '''
+    Build the measurement cache from FISH_CACHE_DIR (default 'fish_cache',
+    empty disables it) and FISH_CACHE_MB (default 512).
+    '''
+    cache_dir = os.environ.get('FISH_CACHE_DIR', 'fish_cache')
+    if len(cache_dir) == 0:
+        return None
+    return ResultCache(cache_dir, max_bytes=int(float(os.environ.get('FISH_CACHE_MB', 512)) * 1024 * 1024))
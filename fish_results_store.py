@@ -0,0 +1,159 @@
+'''
+Append-only store of saved detection results.
+
+/save_results/ used to read the whole detection_results.xlsx, append and
+rewrite it on every call (cost growing with the study, and two concurrent
+saves could lose rows). Saved records are now appended to a SQLite table
+(WAL mode) in one transaction per call; the Excel/CSV table is only built
+when it is exported:
+
+    saved_at, batch_id, image_name, fish_id, record (JSON of the saved row)
+
+    # bring an existing workbook into the store
+    python fish_results_store.py import detection_results.xlsx
+
+    # write the table
+    python fish_results_store.py export --output detection_results.xlsx
+'''
+
+import argparse
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class ResultsStore:
+    '''
+    Append-only SQLite store of result records (dicts, one per fish).
+
+    Safe to share between threads; several processes may append to the
+    same file (SQLite WAL mode).
+    '''
+    def __init__(self, db_path='detection_results.db'):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                saved_at REAL NOT NULL,
+                batch_id INTEGER NOT NULL,
+                image_name TEXT,
+                fish_id INTEGER,
+                record TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS results_image_name ON results (image_name);
+            -- the next batch id is MAX(batch_id) + 1: an index lookup, not a table scan
+            CREATE INDEX IF NOT EXISTS results_batch_id ON results (batch_id);
+        ''')
+        self.conn.commit()
+
+    def append(self, records):
+        '''
+        Append a batch of records in a single transaction. Return the batch
+        id and the number of records written.
+        '''
+        saved_at = time.time()
+        with self.lock, self.conn:
+            # take the write lock before reading MAX(batch_id): with the implicit
+            # transaction (opened at the INSERT) two processes could read the
+            # same MAX and write their rows under one batch id
+            self.conn.execute('BEGIN IMMEDIATE')
+            row = self.conn.execute('SELECT COALESCE(MAX(batch_id), 0) + 1 FROM results').fetchone()
+            batch_id = row[0]
+            self.conn.executemany(
+                'INSERT INTO results (saved_at, batch_id, image_name, fish_id, record) VALUES (?, ?, ?, ?, ?)',
+                [(saved_at, batch_id, record.get('image_name'), record.get('fish_id'), json.dumps(record, default=str))
+                 for record in records])
+        return batch_id, len(records)
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def records(self, image_name=None):
+        '''All saved records in save order.'''
+        query = 'SELECT record FROM results'
+        params = ()
+        if image_name is not None:
+            query += ' WHERE image_name = ?'
+            params = (image_name,)
+        query += ' ORDER BY id'
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def to_dataframe(self, image_name=None):
+        import pandas as pd
+
+        # columns in the order they were first saved, as the workbook had
+        return pd.DataFrame(self.records(image_name))
+
+    def export(self, file_format='xlsx', image_name=None):
+        '''Encoded export of all records: 'xlsx' or 'csv' bytes.'''
+        df = self.to_dataframe(image_name)
+        buffer = io.BytesIO()
+        if file_format == 'xlsx':
+            df.to_excel(buffer, index=False)
+        elif file_format == 'csv':
+            buffer.write(df.to_csv(index=False).encode('utf-8'))
+        else:
+            raise ValueError(f'Unknown export format: {file_format}')
+        return buffer.getvalue()
+
+    def close(self):
+        self.conn.close()
+
+
+EXPORT_MEDIA_TYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+}
+
+
+def store_from_env():
+    '''ResultsStore at FISH_RESULTS_DB (default detection_results.db).'''
+    return ResultsStore(os.environ.get('FISH_RESULTS_DB', 'detection_results.db'))
+
+
+def import_table(store, path):
+    '''Append the rows of an existing results workbook (or CSV).'''
+    import pandas as pd
+
+    df = pd.read_csv(path) if path.endswith('.csv') else pd.read_excel(path)
+    records = json.loads(df.to_json(orient='records'))
+    return store.append(records)[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Append-only detection results store.')
+    parser.add_argument('--db', type=str, default='detection_results.db')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_import = subparsers.add_parser('import', help='append an existing Excel/CSV results table')
+    parser_import.add_argument('path', type=str)
+
+    parser_export = subparsers.add_parser('export', help='write all records as Excel or CSV')
+    parser_export.add_argument('--output', type=str, default='detection_results.xlsx')
+
+    args = parser.parse_args()
+    store = ResultsStore(args.db)
+
+    if args.command == 'import':
+        print(f'{import_table(store, args.path)} records imported into {args.db}')
+        return
+
+    file_format = 'csv' if args.output.endswith('.csv') else 'xlsx'
+    with open(args.output, 'wb') as f:
+        f.write(store.export(file_format))
+    print(f'{store.count()} records written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
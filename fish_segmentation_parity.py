@@ -0,0 +1,166 @@
+'''
+Parity check: BatchSegmentator against the shipped segmentation Inference.
+
+BatchSegmentator re-implements the preprocessing of
+models/segmentation/inference.Inference (ImageNet mean/std, letterbox to
+416 x 416, sigmoid, channel 0, threshold) to segment all crops of an image in
+one forward pass. It stays opt-in (FISH_BATCH_SEGMENTATION=1, generator
+--batch_segmentation) until this check passes on the real weights. Both run
+on the crops /detect/ would segment (same decode and detector input as
+FishPipeline) and are compared fish by fish:
+
+    mask IoU                of the two polygons rasterized on the crop
+    width / height / area   relative error of the fish_geometry measurements
+    missing                 fish one segmentator finds and the other not
+
+Exit code 1 when the 5th percentile IoU is below --min_iou or the p95
+measurement error is above --tolerance:
+
+    python fish_segmentation_parity.py --images /data/fish/heldout --max_images 50
+'''
+
+import argparse
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from fish_geometry import measure_polygon
+
+
+def polygon_mask(polygon, shape):
+    '''
+    Binary mask of a segmentation result on a crop of the given shape. Both
+    segmentators' polygons implement mask_polygon (polygon-masked image).
+    '''
+    white = np.full((shape[0], shape[1], 3), 255, dtype=np.uint8)
+    return polygon.mask_polygon(white)[:, :, 0] > 0
+
+
+def mask_measurement(mask):
+    '''fish_geometry measurement of the largest outline of a mask, or None.'''
+    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    if len(contours) == 0:
+        return None
+    return measure_polygon(max(contours, key=cv2.contourArea))
+
+
+def relative_error(a, b):
+    return abs(a - b) / max(abs(a), 1e-6)
+
+
+def compare_crops(reference, candidate, crops_bgr):
+    '''
+    Segment crops with both segmentators. Return per-fish IoU and width,
+    height, area errors, the number of fish found by only one of them, and
+    the time spent in each.
+    '''
+    start = time.perf_counter()
+    ref_polygons = reference.predict(crops_bgr)
+    ref_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cand_polygons = candidate.predict(crops_bgr)
+    cand_time = time.perf_counter() - start
+
+    result = {'iou': [], 'width': [], 'height': [], 'area': [], 'missing': 0,
+              'reference_seconds': ref_time, 'candidate_seconds': cand_time}
+    for crop, ref, cand in zip(crops_bgr, ref_polygons, cand_polygons):
+        if ref is None or cand is None:
+            result['missing'] += int((ref is None) != (cand is None))
+            continue
+        ref_mask, cand_mask = polygon_mask(ref, crop.shape), polygon_mask(cand, crop.shape)
+        union = np.logical_or(ref_mask, cand_mask).sum()
+        result['iou'].append(float(np.logical_and(ref_mask, cand_mask).sum() / union) if union else 1.0)
+
+        ref_size, cand_size = mask_measurement(ref_mask), mask_measurement(cand_mask)
+        if ref_size is None or cand_size is None:
+            continue
+        for name in ('width', 'height', 'area'):
+            result[name].append(relative_error(ref_size[name], cand_size[name]))
+    return result
+
+
+def parity_report(results):
+    '''Aggregate compare_crops results of all images.'''
+    values = {name: np.concatenate([np.asarray(r[name], dtype=np.float64) for r in results] + [np.zeros(0)])
+              for name in ('iou', 'width', 'height', 'area')}
+    reference_seconds = sum(r['reference_seconds'] for r in results)
+    candidate_seconds = sum(r['candidate_seconds'] for r in results)
+    report = {
+        'images': len(results),
+        'fish_compared': len(values['iou']),
+        'missing_fish': sum(r['missing'] for r in results),
+        'reference_ms_per_image': reference_seconds / max(len(results), 1) * 1000,
+        'candidate_ms_per_image': candidate_seconds / max(len(results), 1) * 1000,
+    }
+    iou = values['iou'] if len(values['iou']) else np.ones(1)
+    report['iou_mean'] = float(iou.mean())
+    report['iou_p5'] = float(np.percentile(iou, 5))
+    report['iou_min'] = float(iou.min())
+    for name in ('width', 'height', 'area'):
+        errors = values[name] if len(values[name]) else np.zeros(1)
+        report[f'{name}_rel_error_mean'] = float(errors.mean())
+        report[f'{name}_rel_error_p95'] = float(np.percentile(errors, 95))
+        report[f'{name}_rel_error_max'] = float(errors.max())
+    return report
+
+
+def passes(report, min_iou, tolerance, max_missing=0):
+    return report['missing_fish'] <= max_missing and report['iou_p5'] >= min_iou and \
+        all(report[f'{name}_rel_error_p95'] <= tolerance for name in ('width', 'height', 'area'))
+
+
+def main():
+    from models.detection.inference import YOLOInference
+
+    from fish_pipeline import BatchSegmentator, CropSegmentator, FishPipeline, decode_image
+    from fish_widthheight_area_dataset_generator import MODEL_DIRS, download_models, list_images, read_bytes
+
+    parser = argparse.ArgumentParser(description='Compare BatchSegmentator masks with the shipped segmentation Inference.')
+    parser.add_argument('--images', type=str, nargs='+', required=True, help='sample image folders')
+    parser.add_argument('--max_images', type=int, default=50)
+    parser.add_argument('--conf_threshold', type=float, default=0.9, help='detector confidence threshold (API uses 0.9)')
+    parser.add_argument('--min_iou', type=float, default=0.98, help='min 5th percentile mask IoU')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='max p95 relative error of width, height and area')
+    parser.add_argument('--output', type=str, default='', help='write the report as JSON')
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    download_models()
+
+    model_path = os.path.join(MODEL_DIRS['segmentation'], 'model.ts')
+    reference = CropSegmentator(model_path=model_path, image_size=416)
+    candidate = BatchSegmentator(model_path=model_path, image_size=416)
+    detector = YOLOInference(
+        os.path.join(MODEL_DIRS['detection'], 'model.ts'),
+        imsz=(640, 640),
+        conf_threshold=args.conf_threshold,
+        nms_threshold=0.3,
+        yolo_ver='v10'
+    )
+    # the crops /detect/ segments: same decode and detector input as FishPipeline
+    pipeline = FishPipeline(detector, reference)
+
+    results = []
+    for image_path in list_images(args.images)[:args.max_images]:
+        boxes = pipeline.detect_boxes([decode_image(read_bytes(image_path))])[0]
+        results.append(compare_crops(reference, candidate, [box.get_mask_BGR() for box in boxes]))
+
+    report = parity_report(results)
+    report.update({'min_iou': args.min_iou, 'tolerance': args.tolerance,
+                   'passed': passes(report, args.min_iou, args.tolerance)})
+
+    print(json.dumps(report, indent=2))
+    if len(args.output):
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if not report['passed']:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
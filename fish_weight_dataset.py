@@ -1,6 +1,6 @@
 import torch
 import numpy as np
-from  torch.utils.data import Dataset, random_split
+from  torch.utils.data import Dataset
 import json
 import os
 import pandas as pd
@@ -11,6 +11,8 @@ from scipy import stats
 from sklearn.linear_model import LinearRegression
 from sklearn.metrics import r2_score, mean_squared_error
 
+from fish_weight_table import STUDY_DAYS, load_or_build
+
 
 
 plt.rcParams['text.usetex'] = True
@@ -78,184 +80,97 @@ class WeightData(Dataset):
 
     
     '''
-    def __init__(self,input_path, label_path,mode='train'):
+    def __init__(self,input_path, label_path,mode='train',dataset_path='weight_dataset'):
         '''
         Generate weight dataset for weight prediction.
         '''
 
         self.mode = mode
 
-        with open(input_path,'r') as f:
-            self.input_data = json.load(f)
-
-        self.dataset_path_train = 'weight_dataset_train.json'
-        self.dataset_path_test = 'weight_dataset_test.json'
+        # columnar dataset (fish_weight_table.py), built on the first run and
+        # memory-mapped afterwards; existing train/test JSON files are converted
+        self.dataset_path = dataset_path
+        self.dataset_path_train = dataset_path + '_train.json'
+        self.dataset_path_test = dataset_path + '_test.json'
 
-        # add extended data sheet here if you have:
-        self.dataset_dict = {'date':['12-11-24','12-18-24','12-30-24','Tk 4 - varied data','Tk 5 - varied data'],
-                        'sheet':["D2 Growth Study 12-11","D3 Growth Study 12-18","D4 Growth Study 12-30","Tank4","Tank5"],
-                        'pixel_size':[0.0038845388570005477,  
-                                      0.0039034090258904977, 
-                                      0.003898025573224454, 
-                                      0.0038995183904531544, 
-                                      0.0039154904929156725]}  
-                                    # 0.004005
+        # add extended data sheet here if you have (fish_weight_table.STUDY_DAYS):
+        self.dataset_dict = {'date':[date for date, _, _ in STUDY_DAYS],
+                        'sheet':[sheet for _, sheet, _ in STUDY_DAYS],
+                        'pixel_size':[pixel_size for _, _, pixel_size in STUDY_DAYS]}
 
         self.length_summary_data = {}
-        
-        if not os.path.exists(self.dataset_path_train):
-            print('\n Generating the dataset...')
-            
-            self.valid_dataset = []
-            for i in range(len(self.dataset_dict['date'])):  
-                date_data = self.dataset_dict['date'][i]
-                pixel_size = self.dataset_dict['pixel_size'][i]
-                self.label_data = pd.read_excel(label_path, sheet_name=self.dataset_dict['sheet'][i])
-                self.valid_num = 0
-
-                # only consider data with valid weight info:
-                while pd.notna(self.label_data.iloc[self.valid_num,1]):
-
-                    image_id = self.label_data.iloc[self.valid_num,0]
-
-
-                    # generate training/testing data as following format:
-                    #       RUNNING FOR THE FIRST TIME
-                    #    SAVED IN: 'weight_dataset.json'
-                    # ---------------------------------------------------
-                    #   image_path, w, h, area, true_weight, true_length 
-                    # ---------------------------------------------------
-                    image_name = '/' + str(image_id) + '.JPG'
-                    true_weightdata = self.label_data.iloc[self.valid_num,1]
-
-                    combined_data = [x for x in self.input_data if image_name in x[0] and date_data in x[0]]
-                    
-                    if len(combined_data) == 1:
-
-                        # pixel --> cm:
-                        combined_data[0][1] *= pixel_size
-                        combined_data[0][2] *= pixel_size
-                        combined_data[0][3] *= pixel_size**2
-
-
-                        combined_data[0].append(true_weightdata)
-
-                        # save length info
-                        if pd.notna(self.label_data.iloc[self.valid_num,3]):
-                            combined_data[0].append(self.label_data.iloc[self.valid_num,3])
-                        else:
-                            combined_data[0].append(0)
-
-                        self.valid_dataset.append(combined_data[0])
-                    else:
-                        print('No exact file/Multiple files are found for a single image name!')
-                        print(image_id,date_data,self.dataset_dict['sheet'][i])
-
-
-                    self.valid_num += 1
-
-            # save valid dataset for training/testing:
-            generator1 = torch.Generator().manual_seed(42)
-            train_list, test_list = random_split(self.valid_dataset,[0.9,0.1],generator=generator1)
-            
-            with open(self.dataset_path_train,'w') as f:
-                self.valid_dataset_train = [self.valid_dataset[x] for x in train_list.indices]
-                json.dump(self.valid_dataset_train,f)
-
-            with open(self.dataset_path_test,'w') as f:
-                self.valid_dataset_test = [self.valid_dataset[x] for x in test_list.indices]
-                json.dump(self.valid_dataset_test,f)
-
-        else:
-            print('\n Opening existing dataset ... ')
-
-            if self.mode == 'train':
-                with open(self.dataset_path_train,'r') as fp:
-                    self.valid_dataset_train = json.load(fp)
-            else:
-                with open(self.dataset_path_test,'r') as fp:
-                    self.valid_dataset_test = json.load(fp)
-
-        
-        # get max and min for normilization:
-        with open(self.dataset_path_train,'r') as fp:
-            self.valid_dataset_train = json.load(fp)
 
-        with open(self.dataset_path_test,'r') as fp:
-            self.valid_dataset_test = json.load(fp)
+        # ---------------------------------------------------
+        #   image_path, w, h, area, true_weight, true_length
+        # ---------------------------------------------------
+        self.table = load_or_build(dataset_path, input_path, label_path)
+        self.train_indices = self.table.split_indices('train')
+        self.test_indices = self.table.split_indices('test')
+        self.indices = self.train_indices if self.mode == 'train' else self.test_indices
+        # split as tensors, see tensors()
+        self.tensor_cache = None
 
-        self.dataset_total = np.concatenate((self.valid_dataset_train,self.valid_dataset_test),axis=0)
-        data_tmp = np.array(self.dataset_total)
-        self.max_vals = np.max(np.array(data_tmp[:,1:],np.float32),axis=0)
-        self.min_vals = np.min(np.array(data_tmp[:,1:],np.float32),axis=0)
+        # get max and min for normilization:
+        data_tmp = np.stack([self.table[name] for name in ('width', 'height', 'area', 'weight', 'length')],axis=1)
+        self.max_vals = np.max(np.array(data_tmp,np.float32),axis=0)
+        self.min_vals = np.min(np.array(data_tmp,np.float32),axis=0)
 
 
         print('\n Dataset is ready ... ')
-        print(f'Valid Training Set Number: {len(self.valid_dataset_train)}')
-        print(f'Valid Testing Set Number: {len(self.valid_dataset_test)}')
+        print(f'Valid Training Set Number: {len(self.train_indices)}')
+        print(f'Valid Testing Set Number: {len(self.test_indices)}')
         print(50*'=')            
          
     
     def __getitem__(self, index):
         # TO DO      :  in real case, we should open an image and do segmentation.
-        if self.mode == 'train':
-            data_idx = self.valid_dataset_train[index]
-        else:
-            data_idx = self.valid_dataset_test[index]
-        pixel_size = 0
-
-        for i,date in enumerate(self.dataset_dict['date']):
-            if date in data_idx[0]:        
-                pixel_size = self.dataset_dict['pixel_size'][i]
-        if pixel_size == 0:
-            print('Pixel Size Cannot be ZERO!')
+        row = self.indices[index]
+        image_path = str(self.table['image_path'][row])
 
         # input data : w, h, area
         # label      : true_weight
 
-        input_data = [data_idx[1],data_idx[2],data_idx[3]]
+        input_data = [self.table['width'][row],self.table['height'][row],self.table['area'][row]]
         
         # norm data
         # input_data = (np.array(input_data)-self.min_vals[:3])/(self.max_vals[:3]-self.min_vals[:3])
         # label = (data_idx[-2]-self.min_vals[-2])/(self.max_vals[-2]-self.min_vals[-2])
 
         # keep real data:
-        label = data_idx[-2]
+        label = self.table['weight'][row]
         
         # print('====================================')
         # print(data_idx[0])
         # print(input_data,label)
-        input_img_name = data_idx[0]
+        input_img_name = image_path
         input_data = torch.tensor(input_data,dtype=torch.float32)
         label = torch.tensor(label,dtype=torch.float32)
         return input_img_name, input_data, label
     
     def __len__(self,):
-        if self.mode == 'train':
-            return len(self.valid_dataset_train)
-        else:
-            return len(self.valid_dataset_test)
+        return len(self.indices)
+
+    def tensors(self, device='cpu'):
+        '''
+        Inputs (N, 3) and labels (N,) of this split as contiguous float32
+        tensors on the device, in split order. Built once and cached.
+        '''
+        if self.tensor_cache is None or self.tensor_cache[0].device != torch.device(device):
+            self.tensor_cache = (torch.from_numpy(self.table.features(self.indices)).to(device),
+                                 torch.from_numpy(self.table.labels(self.indices)).to(device))
+        return self.tensor_cache
         
-    def length_summary(self,):
+    def length_summary(self,topk=3,drop=3):
         # evaluate detected length vs real length
+        #   topk : largest errors printed, drop : largest errors left out of the fit
 
-        with open(self.dataset_path_train,'r') as fp:
-            valid_dataset_train = json.load(fp)
-
-        with open(self.dataset_path_test,'r') as fp:
-            valid_dataset_test = json.load(fp)
-
-        # ---------------------------------------------------
-        #   image_path, w, h, area, true_weight, true_length 
-        # ---------------------------------------------------
-        
-        total_dataset = np.concatenate((valid_dataset_train,valid_dataset_test),axis=0)
-        estimated_length = np.array(total_dataset[:,1:3],np.float32)
+        # training and testing rows, columns of the memory-mapped table
+        estimated_length = np.array(self.table.features()[:,:2],np.float32)
         estimated_length = np.max(estimated_length,axis=1)
-        real_length      = np.array(total_dataset[:,5],np.float32)
+        real_length      = np.array(self.table['length'],np.float32)
 
         valid_est_length = estimated_length[real_length > 0]
-        valid_image = total_dataset[real_length > 0]
+        valid_image = np.asarray(self.table['image_path'])[real_length > 0]
         valida_real_length = real_length[real_length > 0]
 
         error = np.abs(valida_real_length-valid_est_length)
@@ -267,14 +182,13 @@ class WeightData(Dataset):
               f'\nMediam: {np.median(error)} cm')
         
         img_name = valid_image[np.argsort(error)[::-1]]
-        topk = 3 # determine how many top error you want to delete
         print(f'Error for each image:\n {error[np.argsort(error)[::-1][:topk]]}')
-        print(f'Problem Image:\n {img_name[:topk,0]}')
+        print(f'Problem Image:\n {img_name[:topk]}')
 
 
         # show error with fit line: APPEAR IN PAPER!
-        valida_real_length = np.delete(valida_real_length,[np.argsort(error)[::-1][:topk]],None)
-        valid_est_length = np.delete(valid_est_length,[np.argsort(error)[::-1][:topk]],None)
+        valida_real_length = np.delete(valida_real_length,[np.argsort(error)[::-1][:drop]],None)
+        valid_est_length = np.delete(valid_est_length,[np.argsort(error)[::-1][:drop]],None)
         predict_label_error_fit(valida_real_length,valid_est_length)
 
         # shown error with bar graph
@@ -349,14 +263,7 @@ class WeightData(Dataset):
     def weight_summary(self,):
         # evaluate weights distribution
 
-        with open(self.dataset_path_train,'r') as fp:
-            valid_dataset_train = json.load(fp)
-
-        with open(self.dataset_path_test,'r') as fp:
-            valid_dataset_test = json.load(fp)
-        
-        total_dataset = np.concatenate((valid_dataset_train,valid_dataset_test),axis=0)
-        true_weight = np.array(total_dataset[:,4],np.float32).reshape(-1,1)
+        true_weight = np.array(self.table['weight'],np.float32).reshape(-1,1)
         
         print(f'Valid Weight Data Number: {true_weight.shape[0]} \n')
 
@@ -394,10 +301,49 @@ class WeightData(Dataset):
         plt.show()
 
 
-# '''
-from torch.utils.data import DataLoader
-data = WeightData(input_path='bbox_area_dataset_no_bbox_optimization.json',label_path='/media/anranli/DATA/data/fish/Growth Study Data 12-2024.xlsx',mode='train')
-data.length_summary()
-# data.weight_summary()
+class TensorBatches:
+    '''
+    (image names, inputs, targets) batches of a WeightData split sliced from
+    tensors materialized once on the device: DataLoader(data, batch_size,
+    shuffle) without per-item __getitem__, collation and .to(device).
+
+    Every epoch draws from the global torch RNG exactly like a DataLoader
+    iterator (base seed, then sampler seed), so training with either gives
+    identical batches, dropout masks and results.
+    '''
+    def __init__(self, dataset, batch_size=1, shuffle=False, device='cpu'):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.inputs, self.targets = dataset.tensors(device)
+        self.image_names = np.asarray(dataset.table['image_path'])[dataset.indices]
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.dataset)
+        # DataLoader iterator base seed
+        torch.empty((), dtype=torch.int64).random_()
+        if self.shuffle:
+            # RandomSampler permutation
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+            order = torch.randperm(n, generator=generator)
+
+        for start in range(0, n, self.batch_size):
+            if self.shuffle:
+                idx = order[start:start + self.batch_size]
+                yield (self.image_names[idx.numpy()], self.inputs[idx.to(self.inputs.device)],
+                       self.targets[idx.to(self.targets.device)])
+            else:
+                # contiguous views, the whole split when batch_size >= N
+                batch = slice(start, start + self.batch_size)
+                yield self.image_names[batch], self.inputs[batch], self.targets[batch]
+
 
-# '''
\ No newline at end of file
+if __name__ == '__main__':
+    data = WeightData(input_path='bbox_area_dataset_no_bbox_optimization.json',label_path='/media/anranli/DATA/data/fish/Growth Study Data 12-2024.xlsx',mode='train')
+    data.length_summary()
+    # data.weight_summary()
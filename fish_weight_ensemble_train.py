@@ -0,0 +1,312 @@
+'''
+Vectorized k-fold / hyperparameter sweep of the small weight regressors.
+
+Instead of running fish_weight_nn_train.py once per seed, learning rate and
+split, every replica of one architecture (folds x learning rates x weight
+decays x seeds) is trained at once: their parameters are stacked
+(torch.func.stack_module_state) and a single vmap-ed forward/backward pass
+updates all of them, with the same SGD (momentum, weight decay), per-batch
+cosine learning rate and gradient value clipping as the training script.
+
+Each replica is validated on its held-out fold every --eval_every epochs and
+keeps its best weights. The configuration with the lowest mean validation
+error over the folds wins; its best fold replica is saved as a regular
+state dict and scored on the test split.
+
+    python fish_weight_ensemble_train.py --models WeightNet WeightNet0 WeightNet_CPR \\
+        --lrs 0.00002 0.0001 --weight_decays 0.1 0.01 --seeds 0 1 --folds 5 --total_epoch 500
+'''
+
+import argparse
+import copy
+import itertools
+import json
+import math
+import os
+import time
+
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+
+import fish_weight_model
+from fish_weight_table import load_or_build
+
+
+MODELS = ('WeightNet', 'WeightNet0', 'WeightNet_CPR')
+
+
+def fold_masks(n, folds, seed=42):
+    '''(folds, n) boolean validation masks of a shuffled k-fold split.'''
+    fold_of_row = np.empty(n, dtype=np.int64)
+    fold_of_row[np.random.default_rng(seed).permutation(n)] = np.arange(n) % folds
+    return fold_of_row[None, :] == np.arange(folds)[:, None]
+
+
+def replica_grid(folds, lrs, weight_decays, seeds):
+    '''One dict per replica: every fold of every (lr, weight_decay, seed).'''
+    return [{'lr': lr, 'weight_decay': weight_decay, 'seed': seed, 'fold': fold}
+            for lr, weight_decay, seed, fold in itertools.product(lrs, weight_decays, seeds, range(folds))]
+
+
+def per_replica(values, like):
+    '''(R,) values shaped to broadcast against a stacked (R, ...) tensor.'''
+    return values.view(-1, *([1] * (like.dim() - 1)))
+
+
+class ReplicaSet:
+    '''
+    R replicas of one architecture trained together.
+
+        model_cls : WeightNet, WeightNet0 or WeightNet_CPR
+        replicas  : list of dicts with 'lr', 'weight_decay' and 'seed'
+    '''
+    def __init__(self, model_cls, replicas, momentum=0.9, clip_value=100, device='cpu'):
+        self.replicas = replicas
+        self.momentum = momentum
+        self.clip_value = clip_value
+
+        models = []
+        for replica in replicas:
+            torch.manual_seed(replica['seed'])
+            models.append(model_cls().to(device))
+        self.params, self.buffers = stack_module_state(models)
+        self.base = copy.deepcopy(models[0]).to('meta')
+
+        self.lr = torch.tensor([r['lr'] for r in replicas], dtype=torch.float32, device=device)
+        self.weight_decay = torch.tensor([r['weight_decay'] for r in replicas], dtype=torch.float32, device=device)
+        self.momentum_buffers = {}
+
+        self.best_params = {name: value.detach().clone() for name, value in self.params.items()}
+        self.best_error = torch.full((len(replicas),), math.inf, device=device)
+        self.best_epoch = torch.full((len(replicas),), -1, dtype=torch.int64, device=device)
+
+    def _call(self, params, buffers, inputs):
+        return functional_call(self.base, (params, buffers), (inputs,))
+
+    def forward(self, inputs, train=True):
+        '''(R, B) predictions of every replica for one shared (B, 3) batch.'''
+        self.base.train(train)
+        outputs = vmap(self._call, in_dims=(0, 0, None), randomness='different')(self.params, self.buffers, inputs)
+        return outputs[..., 0]
+
+    def step(self, inputs, targets, mask, lr_factor):
+        '''
+        One SGD step of every replica on its own rows of the batch (mask
+        (R, B)); loss is the summed squared error, as in the training script.
+        Return the (R,) losses.
+        '''
+        outputs = self.forward(inputs)
+        losses = ((outputs - targets[None, :]) ** 2 * mask).sum(dim=1)
+        # WeightNet0's batchnorm is defined but unused: no gradient, no update
+        grads = torch.autograd.grad(losses.sum(), list(self.params.values()), allow_unused=True)
+
+        with torch.no_grad():
+            lr = self.lr * lr_factor
+            for (name, param), grad in zip(self.params.items(), grads):
+                if grad is None:
+                    continue
+                grad = grad.clamp(-self.clip_value, self.clip_value)
+                grad = grad + per_replica(self.weight_decay, param) * param
+                buffer = self.momentum_buffers.get(name)
+                if buffer is None:
+                    buffer = self.momentum_buffers[name] = grad.clone()
+                else:
+                    buffer.mul_(self.momentum).add_(grad)
+                param.sub_(per_replica(lr, param) * buffer)
+        return losses.detach()
+
+    def evaluate(self, inputs, targets, mask):
+        '''Absolute errors (R, N) of every replica, masked rows set to 0.'''
+        with torch.no_grad():
+            outputs = self.forward(inputs, train=False)
+        return (outputs - targets[None, :]).abs() * mask
+
+    def keep_best(self, error, epoch):
+        improved = error < self.best_error
+        self.best_error = torch.where(improved, error, self.best_error)
+        self.best_epoch = torch.where(improved, torch.full_like(self.best_epoch, epoch), self.best_epoch)
+        with torch.no_grad():
+            for name, value in self.params.items():
+                self.best_params[name][improved] = value[improved]
+
+    def state_dict(self, replica, best=True):
+        '''Regular state dict of one replica, loadable by its model class.'''
+        params = self.best_params if best else self.params
+        state = {name: value[replica].detach().cpu().clone() for name, value in params.items()}
+        state.update({name: value[replica].detach().cpu().clone() for name, value in self.buffers.items()})
+        return state
+
+
+def cosine_factor(step, t_max, eta_min_ratio=0.1):
+    '''CosineAnnealingLR(T_max=t_max, eta_min=eta_min_ratio * lr) factor at a step.'''
+    return eta_min_ratio + (1 - eta_min_ratio) * (1 + math.cos(math.pi * step / t_max)) / 2
+
+
+def error_metrics(errors, mask):
+    '''Per replica mean, root mean square and max of the masked absolute errors.'''
+    count = mask.sum(dim=1).clamp(min=1)
+    return {
+        'mae': (errors.sum(dim=1) / count),
+        'rmse': ((errors ** 2).sum(dim=1) / count).sqrt(),
+        'max': errors.max(dim=1).values,
+    }
+
+
+def train_replicas(model_cls, replicas, inputs, targets, val_masks, total_epoch=500, batch_size=1024,
+                   momentum=0.9, eval_every=5, device='cpu', log_every=50):
+    '''
+    Train all replicas of one architecture; replica r trains on the rows
+    outside val_masks[r] and is validated on val_masks[r] (R, N).
+
+    Return the ReplicaSet (best weights kept) and one metrics dict per replica.
+    '''
+    inputs = torch.as_tensor(inputs, dtype=torch.float32, device=device)
+    targets = torch.as_tensor(targets, dtype=torch.float32, device=device)
+    val_masks = torch.as_tensor(val_masks, dtype=torch.float32, device=device)
+    train_masks = 1 - val_masks
+
+    replica_set = ReplicaSet(model_cls, replicas, momentum=momentum, device=device)
+    n = len(targets)
+    t_max = max(1, total_epoch // 5)
+    step = 0
+    for epoch in range(total_epoch):
+        order = torch.randperm(n, device=device)
+        for start in range(0, n, batch_size):
+            batch = order[start:start + batch_size]
+            losses = replica_set.step(inputs[batch], targets[batch], train_masks[:, batch], cosine_factor(step, t_max))
+            step += 1
+
+        if (epoch + 1) % eval_every == 0 or epoch == total_epoch - 1:
+            errors = replica_set.evaluate(inputs, targets, val_masks)
+            replica_set.keep_best(error_metrics(errors, val_masks)['mae'], epoch)
+        if log_every and (epoch + 1) % log_every == 0:
+            print(f'{model_cls.__name__} Epoch [{epoch+1}/{total_epoch}], '
+                  f'Loss: {losses.mean().item():.4f}, best val MAE: {replica_set.best_error.min().item():.4f} g')
+
+    # metrics of every replica's best weights
+    final_params = replica_set.params
+    replica_set.params = replica_set.best_params
+    errors = replica_set.evaluate(inputs, targets, val_masks)
+    replica_set.params = final_params
+    metrics = error_metrics(errors, val_masks)
+
+    results = []
+    for r, replica in enumerate(replicas):
+        results.append({**replica, 'model': model_cls.__name__, 'best_epoch': int(replica_set.best_epoch[r]),
+                        **{f'val_{name}': float(values[r]) for name, values in metrics.items()}})
+    return replica_set, results
+
+
+def config_key(result):
+    return (result['model'], result['lr'], result['weight_decay'], result['seed'])
+
+
+def summarize(results):
+    '''Mean/std of the fold metrics of every configuration, best first.'''
+    configs = {}
+    for result in results:
+        configs.setdefault(config_key(result), []).append(result)
+
+    summary = []
+    for (model, lr, weight_decay, seed), fold_results in configs.items():
+        mae = np.array([result['val_mae'] for result in fold_results])
+        rmse = np.array([result['val_rmse'] for result in fold_results])
+        summary.append({'model': model, 'lr': lr, 'weight_decay': weight_decay, 'seed': seed,
+                        'folds': len(fold_results), 'val_mae': float(mae.mean()), 'val_mae_std': float(mae.std()),
+                        'val_rmse': float(rmse.mean())})
+    return sorted(summary, key=lambda config: config['val_mae'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vectorized k-fold / grid training of the weight regressors.')
+    parser.add_argument('--input_path', type=str, default='bbox_area_dataset.json', help='file with input bbox info and areas')
+    parser.add_argument('--label_excel', type=str, default='/media/anranli/DATA/data/fish/Growth Study Data 12-2024.xlsx',
+                        help='Ground Truth Weight Label')
+    parser.add_argument('--dataset_path', type=str, default='weight_dataset', help='columnar weight dataset')
+    parser.add_argument('--models', type=str, nargs='+', default=list(MODELS), choices=MODELS)
+    parser.add_argument('--lrs', type=float, nargs='+', default=[0.00002])
+    parser.add_argument('--weight_decays', type=float, nargs='+', default=[0.1])
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--momentum', type=float, default=0.9)
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--fold_seed', type=int, default=42)
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--total_epoch', type=int, default=500)
+    parser.add_argument('--eval_every', type=int, default=5, help='epochs between validations')
+    parser.add_argument('--save_dir', type=str, default='weight_ensemble')
+    args = parser.parse_args()
+    print(args)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    # cross-validate on the training split, the test split stays held out
+    table = load_or_build(args.dataset_path, args.input_path, args.label_excel)
+    train_rows, test_rows = table.split_indices('train'), table.split_indices('test')
+    inputs, targets = table.features(train_rows), table.labels(train_rows)
+    masks = fold_masks(len(train_rows), args.folds, args.fold_seed)
+
+    replicas = replica_grid(args.folds, args.lrs, args.weight_decays, args.seeds)
+    val_masks = np.stack([masks[replica['fold']] for replica in replicas])
+
+    results = []
+    best = None
+    for name in args.models:
+        model_cls = getattr(fish_weight_model, name)
+        start = time.perf_counter()
+        replica_set, model_results = train_replicas(model_cls, replicas, inputs, targets, val_masks,
+                                                    args.total_epoch, args.batch_size, args.momentum,
+                                                    args.eval_every, device)
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {len(replicas)} replicas trained in {elapsed:.1f} s')
+        for result in model_results:
+            result['train_seconds'] = elapsed / len(replicas)
+        results.extend(model_results)
+
+        # keep only the replica set of the best configuration so far
+        config = summarize(model_results)[0]
+        if best is None or config['val_mae'] < best[0]['val_mae']:
+            best = (config, model_cls, replica_set, model_results)
+
+    print(f'\n{"fold":>4} {"model":>14} {"lr":>10} {"wd":>8} {"seed":>4} {"epoch":>5} {"val MAE":>9} {"val RMSE":>9}')
+    for result in sorted(results, key=lambda result: (config_key(result), result['fold'])):
+        print(f'{result["fold"]:>4} {result["model"]:>14} {result["lr"]:>10g} {result["weight_decay"]:>8g} '
+              f'{result["seed"]:>4} {result["best_epoch"]:>5} {result["val_mae"]:>9.4f} {result["val_rmse"]:>9.4f}')
+
+    summary = summarize(results)
+    print(f'\n{"model":>14} {"lr":>10} {"wd":>8} {"seed":>4} {"val MAE (mean +- std over folds)":>34}')
+    for config in summary:
+        print(f'{config["model"]:>14} {config["lr"]:>10g} {config["weight_decay"]:>8g} {config["seed"]:>4} '
+              f'{config["val_mae"]:>24.4f} +- {config["val_mae_std"]:.4f}')
+
+    # best checkpoint: best fold replica of the best configuration
+    config, model_cls, replica_set, model_results = best
+    replica = min((r for r, result in enumerate(model_results) if config_key(result) == config_key(config)),
+                  key=lambda r: model_results[r]['val_mae'])
+    model = model_cls().to(device)
+    model.load_state_dict(replica_set.state_dict(replica))
+    model.eval()
+
+    with torch.no_grad():
+        outputs = model(torch.from_numpy(table.features(test_rows)).to(device)).view(-1).cpu().numpy()
+    error = np.abs(table.labels(test_rows) - outputs)
+    print(f'\nBest: {config["model"]} lr={config["lr"]:g} weight_decay={config["weight_decay"]:g} '
+          f'seed={config["seed"]} fold={model_results[replica]["fold"]}')
+    print(f'\nWeight Error (test split):\nAverage: {np.mean(error)} g,',
+          f'\nMax : {np.max(error)} g,',
+          f'\nMin : {np.min(error)} g,',
+          f'\nMediam : {np.median(error)} g')
+
+    if not os.path.exists(args.save_dir):
+        os.mkdir(args.save_dir)
+    checkpoint = os.path.join(args.save_dir, '{}_lr{:g}_wd{:g}_seed{}_{}.pth'.format(
+        config['model'], config['lr'], config['weight_decay'], config['seed'], np.mean(error)))
+    torch.save(model.state_dict(), checkpoint)
+    with open(os.path.join(args.save_dir, 'folds.json'), 'w') as f:
+        json.dump({'folds': results, 'summary': summary, 'best': {**config, 'checkpoint': checkpoint,
+                                                                  'test_mae': float(np.mean(error))}}, f, indent=2)
+    print(f'Model Saved! {checkpoint}')
+
+
+if __name__ == '__main__':
+    main()
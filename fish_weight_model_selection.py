@@ -0,0 +1,235 @@
+'''
+Cross-validated comparison of the weight regressors in one run.
+
+Every candidate is scored with the same k folds of the training split of the
+columnar weight dataset (fish_weight_table.py); candidates run in parallel
+worker processes, each memory-mapping the dataset columns instead of
+receiving a copy of them:
+
+    power_law      W = a * L^b, fitted in log-log space on the length (width)
+    xgboost        XGBoost regressor, 'hist' tree method, multi-threaded
+    WeightNet, WeightNet0, WeightNet_CPR
+                   all folds of one architecture trained at once
+                   (fish_weight_ensemble_train.py), scored at the epoch with
+                   the best validation error
+
+One table is printed (and written as JSON) with the mean +- std over the
+folds of MAE, RMSE and R^2, and the fit / predict time per fold:
+
+    python fish_weight_model_selection.py --folds 5 --workers 3 --threads 2
+'''
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+
+import numpy as np
+
+from fish_weight_ensemble_train import fold_masks, train_replicas
+from fish_weight_table import WeightTable, load_or_build
+
+
+CANDIDATES = ('power_law', 'xgboost', 'WeightNet', 'WeightNet0', 'WeightNet_CPR')
+
+
+def fit_power_law(inputs, targets):
+    '''(a, b) of W = a * L^b, least squares on log W = log a + b log L.'''
+    valid = (inputs[:, 0] > 0) & (targets > 0)
+    b, log_a = np.polyfit(np.log(inputs[valid, 0]), np.log(targets[valid]), 1)
+    return np.exp(log_a), b
+
+
+def run_power_law(inputs, targets, masks, options):
+    predictions, fit_seconds, predict_seconds = [], [], []
+    for val in masks:
+        start = time.perf_counter()
+        a, b = fit_power_law(inputs[~val], targets[~val])
+        fit_seconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        predictions.append(a * inputs[val, 0] ** b)
+        predict_seconds.append(time.perf_counter() - start)
+    return predictions, fit_seconds, predict_seconds
+
+
+def run_xgboost(inputs, targets, masks, options):
+    import xgboost as xgb
+
+    params = {
+        "objective": "reg:squarederror",
+        "max_depth": options['xgb_max_depth'],
+        "eta": 0.1,
+        "alpha": 10,
+        "tree_method": "hist",
+        "nthread": options['threads'],
+        "eval_metric": "rmse",
+    }
+    predictions, fit_seconds, predict_seconds = [], [], []
+    for val in masks:
+        start = time.perf_counter()
+        booster = xgb.train(params, xgb.DMatrix(inputs[~val], label=targets[~val]),
+                            num_boost_round=options['xgb_rounds'])
+        fit_seconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        predictions.append(booster.predict(xgb.DMatrix(inputs[val])))
+        predict_seconds.append(time.perf_counter() - start)
+    return predictions, fit_seconds, predict_seconds
+
+
+def run_weight_net(name, inputs, targets, masks, options):
+    import torch
+
+    import fish_weight_model
+
+    torch.manual_seed(options['seed'])
+    replicas = [{'lr': options['nn_lr'], 'weight_decay': options['nn_weight_decay'], 'seed': options['seed'],
+                 'fold': fold} for fold in range(len(masks))]
+    start = time.perf_counter()
+    replica_set, _ = train_replicas(getattr(fish_weight_model, name), replicas, inputs, targets, masks,
+                                    total_epoch=options['nn_epochs'], batch_size=options['nn_batch_size'],
+                                    log_every=0)
+    # the folds are trained together: report the share of each
+    fit_seconds = [(time.perf_counter() - start) / len(masks)] * len(masks)
+
+    start = time.perf_counter()
+    replica_set.params = replica_set.best_params
+    with torch.no_grad():
+        outputs = replica_set.forward(torch.from_numpy(inputs), train=False).numpy()
+    predict_seconds = [(time.perf_counter() - start) / len(masks)] * len(masks)
+    return [outputs[fold][val] for fold, val in enumerate(masks)], fit_seconds, predict_seconds
+
+
+def run_candidate(name, dataset_path, folds, fold_seed, options):
+    '''
+    Cross-validate one candidate in a worker process. Return its per-fold
+    validation predictions and timings, or the error that stopped it.
+    '''
+    if options['threads']:
+        import torch
+
+        torch.set_num_threads(options['threads'])
+
+    table = WeightTable.load(dataset_path)
+    rows = table.split_indices('train')
+    inputs, targets = table.features(rows), table.labels(rows)
+    masks = fold_masks(len(rows), folds, fold_seed)
+
+    start = time.perf_counter()
+    try:
+        if name == 'power_law':
+            predictions, fit_seconds, predict_seconds = run_power_law(inputs, targets, masks, options)
+        elif name == 'xgboost':
+            predictions, fit_seconds, predict_seconds = run_xgboost(inputs, targets, masks, options)
+        else:
+            predictions, fit_seconds, predict_seconds = run_weight_net(name, inputs, targets, masks, options)
+    except ImportError as e:
+        return {'model': name, 'error': f'skipped: {e}'}
+
+    return {'model': name, 'predictions': predictions, 'fit_seconds': fit_seconds,
+            'predict_seconds': predict_seconds, 'wall_seconds': time.perf_counter() - start}
+
+
+def fold_metrics(predictions, targets):
+    error = np.asarray(predictions, dtype=np.float64) - targets
+    total = ((targets - targets.mean()) ** 2).sum()
+    return {
+        'mae': float(np.abs(error).mean()),
+        'rmse': float(np.sqrt((error ** 2).mean())),
+        'r2': float(1 - (error ** 2).sum() / total) if total > 0 else float('nan'),
+    }
+
+
+def comparison_table(results, targets, masks):
+    '''One row per candidate: mean/std of the fold metrics and timings, best MAE first.'''
+    rows = []
+    for result in results:
+        if 'error' in result:
+            rows.append({'model': result['model'], 'error': result['error']})
+            continue
+        folds = [fold_metrics(predictions, targets[val]) for predictions, val in zip(result['predictions'], masks)]
+        row = {'model': result['model'], 'folds': len(folds)}
+        for name in ('mae', 'rmse', 'r2'):
+            values = np.array([fold[name] for fold in folds])
+            row[name] = float(values.mean())
+            row[f'{name}_std'] = float(values.std())
+        row['fit_seconds'] = float(np.mean(result['fit_seconds']))
+        row['predict_seconds'] = float(np.mean(result['predict_seconds']))
+        row['wall_seconds'] = result['wall_seconds']
+        rows.append(row)
+    return sorted(rows, key=lambda row: row.get('mae', float('inf')))
+
+
+def print_table(rows):
+    print(f'\n{"model":>14} {"MAE [g]":>17} {"RMSE [g]":>17} {"R^2":>15} {"fit/fold [s]":>13} '
+          f'{"predict/fold [s]":>17} {"wall [s]":>9}')
+    for row in rows:
+        if 'error' in row:
+            print(f'{row["model"]:>14} {row["error"]}')
+            continue
+        print(f'{row["model"]:>14} {row["mae"]:>8.4f} +- {row["mae_std"]:<6.4f} {row["rmse"]:>8.4f} +- '
+              f'{row["rmse_std"]:<6.4f} {row["r2"]:>6.4f} +- {row["r2_std"]:<6.4f} {row["fit_seconds"]:>13.3f} '
+              f'{row["predict_seconds"]:>17.5f} {row["wall_seconds"]:>9.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cross-validated model selection for weight prediction.')
+    parser.add_argument('--input_path', type=str, default='bbox_area_dataset.json', help='file with input bbox info and areas')
+    parser.add_argument('--label_excel', type=str, default='/media/anranli/DATA/data/fish/Growth Study Data 12-2024.xlsx',
+                        help='Ground Truth Weight Label')
+    parser.add_argument('--dataset_path', type=str, default='weight_dataset', help='columnar weight dataset')
+    parser.add_argument('--models', type=str, nargs='+', default=list(CANDIDATES), choices=CANDIDATES)
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--fold_seed', type=int, default=42)
+    parser.add_argument('--workers', type=int, default=min(len(CANDIDATES), os.cpu_count() or 1),
+                        help='candidates cross-validated in parallel')
+    parser.add_argument('--threads', type=int, default=0, help='torch/XGBoost threads per worker (0: library default)')
+    parser.add_argument('--xgb_rounds', type=int, default=100)
+    parser.add_argument('--xgb_max_depth', type=int, default=3)
+    parser.add_argument('--nn_epochs', type=int, default=500)
+    parser.add_argument('--nn_lr', type=float, default=0.00002)
+    parser.add_argument('--nn_weight_decay', type=float, default=0.1)
+    parser.add_argument('--nn_batch_size', type=int, default=1024)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='weight_model_selection.json')
+    args = parser.parse_args()
+    print(args)
+
+    # built (or converted) once here, memory-mapped by every worker
+    table = load_or_build(args.dataset_path, args.input_path, args.label_excel)
+    rows = table.split_indices('train')
+    targets = table.labels(rows).astype(np.float64)
+    masks = fold_masks(len(rows), args.folds, args.fold_seed)
+    options = {name: getattr(args, name) for name in ('threads', 'xgb_rounds', 'xgb_max_depth', 'nn_epochs', 'nn_lr',
+                                                       'nn_weight_decay', 'nn_batch_size', 'seed')}
+    if options['threads'] == 0 and args.workers > 1:
+        # share the cores between the workers
+        options['threads'] = max(1, (os.cpu_count() or 1) // args.workers)
+
+    start = time.perf_counter()
+    results = []
+    # spawn: workers start without the parent's torch/OpenMP state
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(run_candidate, name, args.dataset_path, args.folds, args.fold_seed, options)
+                   for name in args.models]
+        for future in as_completed(futures):
+            result = future.result()
+            print(f'{result["model"]}: ' + (result['error'] if 'error' in result else
+                                             f'{result["wall_seconds"]:.2f} s'))
+            results.append(result)
+
+    table_rows = comparison_table(results, targets, masks)
+    print_table(table_rows)
+    print(f'\n{len(rows)} training rows, {args.folds} folds, {args.workers} workers, '
+          f'{time.perf_counter() - start:.1f} s in total')
+
+    with open(args.output, 'w') as f:
+        json.dump({'args': vars(args), 'models': table_rows}, f, indent=2)
+    print(f'Comparison written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,7 @@ from tqdm import tqdm
 import os
 import argparse
 
-from fish_weight_dataset import WeightData
+from fish_weight_dataset import WeightData, TensorBatches
 from fish_weight_model import WeightNet, WeightNet_CPR
 
 
@@ -28,6 +28,8 @@ parser.add_argument('--lr',type=float, default=0.00002, help='learning rate')
 parser.add_argument('--batch_size',type=int, default=1024, help='batch size')
 parser.add_argument('--total_epoch',type=int, default=500, help='batch size')
 parser.add_argument('--pre_trained', type=str, default='',help='input your pretrained weight path if you want')
+parser.add_argument('--loader', type=str, default='tensor', choices=['tensor', 'dataloader'],
+                    help='tensor: batches sliced from tensors kept on the device (same results, no per-item collation)')
 
 args = parser.parse_args()
 
@@ -45,8 +47,12 @@ data_train = WeightData(input_path=args.input_path,label_path=args.label_excel,m
 data_test = WeightData(input_path=args.input_path,label_path=args.label_excel,mode='test')
 
 
-train_loader = DataLoader(data_train,batch_size=args.batch_size,shuffle=True)
-test_loader = DataLoader(data_test,batch_size=args.batch_size,shuffle=False)
+if args.loader == 'tensor':
+    train_loader = TensorBatches(data_train,batch_size=args.batch_size,shuffle=True,device=device)
+    test_loader = TensorBatches(data_test,batch_size=args.batch_size,shuffle=False,device=device)
+else:
+    train_loader = DataLoader(data_train,batch_size=args.batch_size,shuffle=True)
+    test_loader = DataLoader(data_test,batch_size=args.batch_size,shuffle=False)
 
 
 save_path = f'fish_cpr_saved_weights'
@@ -94,7 +100,7 @@ def test(model, test_loader,epoch):
 
 
     outputs = outputs.cpu().detach().numpy()
-    targets = targets.numpy()
+    targets = targets.cpu().numpy()
 
     # Predict using the loaded best model
     y_pred = outputs.copy()
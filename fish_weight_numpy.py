@@ -0,0 +1,246 @@
+'''
+Torch-free weight regression.
+
+A trained weight model (WeightNet, WeightNet0, WeightNet_CPR state dict) or
+an XGBoost booster is exported once to a small .npz file; the evaluator
+loaded from it needs only NumPy and predicts all fish of a batch with one
+vectorized call:
+
+    evaluator = load_evaluator('weight_model.npz')
+    weights = evaluator.predict(features)     # (N, 3) [width, height, area] -> (N,) g
+
+Exporting needs torch (or xgboost); evaluation does not. The networks run in
+eval mode (no dropout); trees compare float32 features with `<` and follow
+the default branch for NaN, as XGBoost does.
+
+    python fish_weight_numpy.py export --weight_model fish_saved_weights/model_epoch80_0.15009590983390808.pth \\
+        --arch WeightNet --output weight_model.npz
+    python fish_weight_numpy.py export --xgboost weight_xgboost/best_xgboost_model.bin --output weight_xgboost.npz
+
+    # largest difference to the torch / xgboost prediction
+    python fish_weight_numpy.py check weight_model.npz --weight_model fish_saved_weights/model_epoch80_0.15009590983390808.pth
+'''
+
+import argparse
+import json
+
+import numpy as np
+
+
+ARCHITECTURES = ('WeightNet', 'WeightNet0', 'WeightNet_CPR')
+
+
+def relu(x):
+    return np.maximum(x, 0)
+
+
+class NumpyWeightNet:
+    '''Eval-mode forward pass of the weight networks on NumPy arrays.'''
+    def __init__(self, kind, params):
+        if kind not in ARCHITECTURES:
+            raise ValueError(f'Unknown weight model: {kind}')
+        self.kind = kind
+        # (in, out) weights, so a layer is one x @ W + b
+        self.layers = {name[:-len('.weight')]: (np.ascontiguousarray(params[name].T, dtype=np.float32),
+                                                 np.asarray(params[name[:-len('.weight')] + '.bias'], dtype=np.float32))
+                       for name in params if name.endswith('.weight') and name[:-len('.weight')] + '.bias' in params}
+
+    def linear(self, name, x):
+        weight, bias = self.layers[name]
+        return x @ weight + bias
+
+    def predict(self, features):
+        '''(N, 3) [width, height, area] in cm, cm^2 -> (N,) weights in g.'''
+        x = np.asarray(features, dtype=np.float32).reshape(len(features), -1)
+
+        if self.kind == 'WeightNet_CPR':
+            return self.linear('fc3', relu(self.linear('fc1', x)))[:, 0]
+
+        if self.kind == 'WeightNet0':
+            for name in ('fc1', 'fc2', 'fc2_1', 'fc2_1_1', 'fc2_1_2', 'fc2_2'):
+                x = relu(self.linear(name, x))
+            return self.linear('fc3', x)[:, 0]
+
+        # WeightNet: the skip blocks' adaptive pooling keeps the size, i.e. is the identity
+        x_tmp1 = relu(self.linear('skip_connection1.0', x))
+        x = relu(self.linear('fc1', x))
+        x = relu(self.linear('fc2', x))
+        x = np.concatenate((x, x_tmp1), axis=1)
+        x_tmp2 = relu(self.linear('skip_connection2.0', x))
+        x = relu(self.linear('fc3', x))
+        x = relu(self.linear('fc4', x))
+        x = relu(self.linear('fc5', np.concatenate((x, x_tmp2), axis=1)))
+        return relu(self.linear('fc6', x))[:, 0]
+
+    def arrays(self):
+        arrays = {'kind': np.array(self.kind)}
+        for name, (weight, bias) in self.layers.items():
+            arrays[name + '.weight'] = weight.T
+            arrays[name + '.bias'] = bias
+        return arrays
+
+
+class NumpyTrees:
+    '''
+    Sum of regression trees stored as padded (trees, nodes) arrays; all rows
+    descend all trees together, one tree level per step.
+    '''
+    def __init__(self, left, right, feature, threshold, default_left, value, base_score):
+        self.left = left
+        self.right = right
+        self.feature = feature
+        self.threshold = threshold
+        self.default_left = default_left
+        self.value = value
+        self.base_score = float(base_score)
+
+    @classmethod
+    def from_xgboost_json(cls, model):
+        '''From XGBoost's JSON model (dict, as saved by save_model('*.json')).'''
+        learner = model['learner']
+        objective = learner['objective']['name']
+        if objective not in ('reg:squarederror', 'reg:linear', 'reg:absoluteerror', 'reg:pseudohubererror'):
+            raise ValueError(f'Only identity-link regression boosters are supported, not {objective}')
+
+        trees = learner['gradient_booster']['model']['trees']
+        nodes = max(len(tree['left_children']) for tree in trees)
+        shape = (len(trees), nodes)
+        left = np.full(shape, -1, dtype=np.int32)
+        right = np.full(shape, -1, dtype=np.int32)
+        feature = np.zeros(shape, dtype=np.int32)
+        threshold = np.zeros(shape, dtype=np.float32)
+        default_left = np.zeros(shape, dtype=bool)
+        value = np.zeros(shape, dtype=np.float32)
+        for t, tree in enumerate(trees):
+            n = len(tree['left_children'])
+            left[t, :n] = tree['left_children']
+            right[t, :n] = tree['right_children']
+            feature[t, :n] = tree['split_indices']
+            threshold[t, :n] = tree['split_conditions']
+            default_left[t, :n] = np.asarray(tree['default_left'], dtype=bool)
+            # leaves keep their value in split_conditions
+            value[t, :n] = np.where(np.asarray(tree['left_children']) == -1, tree['split_conditions'], 0)
+
+        # e.g. '5E-1' or, in newer versions, '[5E-1]'
+        base_score = float(learner['learner_model_param']['base_score'].strip('[]'))
+        return cls(left, right, feature, threshold, default_left, value, base_score)
+
+    def predict(self, features):
+        '''(N, F) features -> (N,) predictions.'''
+        x = np.asarray(features, dtype=np.float32).reshape(len(features), -1)
+        rows = np.arange(len(x))[:, None]
+        trees = np.arange(self.left.shape[0])[None, :]
+        node = np.zeros((len(x), self.left.shape[0]), dtype=np.int32)
+
+        while True:
+            leaf = self.left[trees, node] == -1
+            if leaf.all():
+                break
+            fvalue = x[rows, self.feature[trees, node]]
+            go_left = np.where(np.isnan(fvalue), self.default_left[trees, node], fvalue < self.threshold[trees, node])
+            node = np.where(leaf, node, np.where(go_left, self.left[trees, node], self.right[trees, node]))
+
+        return self.base_score + self.value[trees, node].sum(axis=1, dtype=np.float64).astype(np.float32)
+
+    def arrays(self):
+        return {'kind': np.array('xgboost'), 'left': self.left, 'right': self.right, 'feature': self.feature,
+                'threshold': self.threshold, 'default_left': self.default_left, 'value': self.value,
+                'base_score': np.array(self.base_score)}
+
+
+def save_evaluator(evaluator, path):
+    np.savez(path, **evaluator.arrays())
+
+
+def load_evaluator(path):
+    '''NumpyWeightNet or NumpyTrees from an exported .npz file.'''
+    with np.load(path) as data:
+        arrays = {name: data[name] for name in data.files}
+    kind = str(arrays.pop('kind'))
+    if kind == 'xgboost':
+        return NumpyTrees(arrays['left'], arrays['right'], arrays['feature'], arrays['threshold'],
+                          arrays['default_left'], arrays['value'], arrays['base_score'])
+    return NumpyWeightNet(kind, arrays)
+
+
+def from_torch(model):
+    '''NumpyWeightNet of a WeightNet / WeightNet0 / WeightNet_CPR module.'''
+    return NumpyWeightNet(type(model).__name__, {name: value.detach().cpu().numpy()
+                                                  for name, value in model.state_dict().items()})
+
+
+def load_torch_model(weight_model_path, arch='WeightNet'):
+    import torch
+
+    import fish_weight_model
+
+    model = getattr(fish_weight_model, arch)()
+    model.load_state_dict(torch.load(weight_model_path, map_location='cpu'))
+    return model.eval()
+
+
+def from_booster(booster):
+    '''NumpyTrees of an xgboost.Booster.'''
+    return NumpyTrees.from_xgboost_json(json.loads(booster.save_raw('json')))
+
+
+def load_booster(model_path):
+    import xgboost as xgb
+
+    booster = xgb.Booster()
+    booster.load_model(model_path)
+    return booster
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export weight models to NumPy-only evaluators.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for name in ('export', 'check'):
+        subparser = subparsers.add_parser(name, help='write an evaluator' if name == 'export'
+                                          else 'compare an evaluator with its source model')
+        if name == 'check':
+            subparser.add_argument('evaluator', type=str)
+        subparser.add_argument('--weight_model', type=str, default='', help='state dict (.pth)')
+        subparser.add_argument('--arch', type=str, default='WeightNet', choices=ARCHITECTURES)
+        subparser.add_argument('--xgboost', type=str, default='', help='XGBoost model file')
+        if name == 'export':
+            subparser.add_argument('--output', type=str, default='weight_model.npz')
+        else:
+            subparser.add_argument('--samples', type=int, default=10000)
+
+    args = parser.parse_args()
+    if (len(args.weight_model) == 0) == (len(args.xgboost) == 0):
+        parser.error('give either --weight_model or --xgboost')
+
+    if len(args.weight_model):
+        model = load_torch_model(args.weight_model, args.arch)
+    else:
+        model = load_booster(args.xgboost)
+
+    if args.command == 'export':
+        evaluator = from_torch(model) if len(args.weight_model) else from_booster(model)
+        save_evaluator(evaluator, args.output)
+        print(f'{args.output} written')
+        return
+
+    # length [cm], height [cm], area [cm^2] of the size range of the studies
+    rng = np.random.default_rng(0)
+    features = np.stack([rng.uniform(2, 15, args.samples), rng.uniform(0.5, 4, args.samples),
+                         rng.uniform(1, 40, args.samples)], axis=1).astype(np.float32)
+    if len(args.weight_model):
+        import torch
+
+        with torch.no_grad():
+            expected = model(torch.from_numpy(features)).view(-1).numpy()
+    else:
+        import xgboost as xgb
+
+        expected = model.predict(xgb.DMatrix(features))
+
+    predicted = load_evaluator(args.evaluator).predict(features)
+    print(f'Max difference over {args.samples} samples: {np.max(np.abs(predicted - expected))} g')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+'''
+Columnar weight dataset: measured fish joined with their Excel weight labels.
+
+Measurements (generator output, UNIT: PIXEL SIZE) are indexed once by
+(study day, image file name), every label sheet is read in a single pass
+over the workbook, and each label row is matched with one dictionary lookup,
+so the build grows linearly with the number of study days.
+
+The result is written as a directory of typed .npy columns, which the
+training, XGBoost and summary scripts memory-map instead of parsing JSON:
+
+    image_path (str), study_day (str), width, height [cm], area [cm^2],
+    pixel_size [cm/pixel], weight [g], length [cm, 0 if not measured],
+    split (0 train, 1 test)
+
+Rows are stored as the training rows followed by the testing rows, both in
+the order of the seeded random split.
+
+    python fish_weight_table.py --input_path bbox_area_dataset.jsonl \\
+        --label_excel 'Growth Study Data 12-2024.xlsx' --output weight_dataset
+'''
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+
+# (date found in the image path, label sheet, pixel size [cm/pixel]);
+# add extended data sheets here if you have:
+STUDY_DAYS = [
+    ('12-11-24', 'D2 Growth Study 12-11', 0.0038845388570005477),
+    ('12-18-24', 'D3 Growth Study 12-18', 0.0039034090258904977),
+    ('12-30-24', 'D4 Growth Study 12-30', 0.003898025573224454),
+    ('Tk 4 - varied data', 'Tank4', 0.0038995183904531544),
+    ('Tk 5 - varied data', 'Tank5', 0.0039154904929156725),
+]
+
+FLOAT_COLUMNS = ('width', 'height', 'area', 'pixel_size', 'weight', 'length')
+TRAIN, TEST = 0, 1
+
+
+class WeightTable:
+    '''Column arrays of the weight dataset (see module docstring).'''
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return len(self.columns['weight'])
+
+    def split_indices(self, mode):
+        '''Row indices of the 'train' or 'test' split.'''
+        return np.flatnonzero(np.asarray(self.columns['split']) == (TRAIN if mode == 'train' else TEST))
+
+    def features(self, rows=slice(None)):
+        '''(N, 3) float32 [width, height, area] matrix.'''
+        return np.stack([self.columns['width'][rows], self.columns['height'][rows], self.columns['area'][rows]],
+                        axis=1).astype(np.float32)
+
+    def labels(self, rows=slice(None)):
+        return np.asarray(self.columns['weight'][rows], dtype=np.float32)
+
+    def save(self, dataset_path):
+        os.makedirs(dataset_path, exist_ok=True)
+        for name, values in self.columns.items():
+            np.save(os.path.join(dataset_path, f'{name}.npy'), values)
+        with open(os.path.join(dataset_path, 'columns.json'), 'w') as f:
+            json.dump({'columns': list(self.columns), 'rows': len(self)}, f)
+
+    @classmethod
+    def load(cls, dataset_path, mmap_mode='r'):
+        with open(os.path.join(dataset_path, 'columns.json'), 'r') as f:
+            names = json.load(f)['columns']
+        return cls({name: np.load(os.path.join(dataset_path, f'{name}.npy'), mmap_mode=mmap_mode)
+                    for name in names})
+
+
+def load_measurements(input_path):
+    '''
+    Pixel measurements as (image_paths, (N, 3) [width, height, area]) from
+    the generator's JSONL output or the legacy [image_path, w, h, area] list.
+    '''
+    image_paths, values = [], []
+    with open(input_path, 'r') as f:
+        if input_path.endswith('.jsonl'):
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                for fish in record['fish']:
+                    image_paths.append(record['image_path'])
+                    values.append((fish['width'], fish['height'], fish['area']))
+        else:
+            for image_path, width, height, area in json.load(f):
+                image_paths.append(image_path)
+                values.append((width, height, area))
+    return image_paths, np.array(values, dtype=np.float64).reshape(-1, 3)
+
+
+def index_measurements(image_paths, dates):
+    '''
+    {(study day, image file name): [measurement rows]}. The study days of a
+    path are found once per directory, not once per label.
+    '''
+    days_of_dir = {}
+    index = {}
+    for row, image_path in enumerate(image_paths):
+        directory, name = image_path.rsplit('/', 1) if '/' in image_path else ('', image_path)
+        days = days_of_dir.get(directory)
+        if days is None:
+            days = days_of_dir[directory] = [date for date in dates if date in directory]
+        for date in days:
+            index.setdefault((date, name), []).append(row)
+    return index
+
+
+def read_labels(label_path, sheets):
+    '''
+    {sheet: (image ids, weights, lengths)} of every sheet, read in one pass
+    over the workbook. Only the rows before the first missing weight count.
+    '''
+    import pandas as pd
+
+    labels = {}
+    for sheet, df in pd.read_excel(label_path, sheet_name=list(sheets)).items():
+        missing = np.flatnonzero(pd.isna(df.iloc[:, 1]).to_numpy())
+        valid = df.iloc[:missing[0] if len(missing) else len(df)]
+        lengths = valid.iloc[:, 3] if valid.shape[1] > 3 else pd.Series(np.nan, index=valid.index)
+        labels[sheet] = (valid.iloc[:, 0].tolist(), valid.iloc[:, 1].to_numpy(np.float64),
+                         lengths.fillna(0).to_numpy(np.float64))
+    return labels
+
+
+def seeded_split(n, seed=42, fractions=(0.9, 0.1)):
+    '''Train and test row indices, the same split torch random_split gives.'''
+    import torch
+    from torch.utils.data import random_split
+
+    train_list, test_list = random_split(range(n), list(fractions), generator=torch.Generator().manual_seed(seed))
+    return np.array(train_list.indices, dtype=np.int64), np.array(test_list.indices, dtype=np.int64)
+
+
+def build_table(input_path, label_path, study_days=STUDY_DAYS, seed=42):
+    '''Join measurements and labels into a WeightTable (train rows first).'''
+    image_paths, pixels = load_measurements(input_path)
+    index = index_measurements(image_paths, [date for date, _, _ in study_days])
+    labels = read_labels(label_path, [sheet for _, sheet, _ in study_days])
+
+    rows, days, pixel_sizes, weights, lengths = [], [], [], [], []
+    for date, sheet, pixel_size in study_days:
+        for image_id, weight, length in zip(*labels[sheet]):
+            matched = index.get((date, str(image_id) + '.JPG'), [])
+            if len(matched) != 1:
+                print('No exact file/Multiple files are found for a single image name!')
+                print(image_id, date, sheet)
+                continue
+            rows.append(matched[0])
+            days.append(date)
+            pixel_sizes.append(pixel_size)
+            weights.append(weight)
+            lengths.append(length)
+
+    rows = np.array(rows, dtype=np.int64)
+    pixel_sizes = np.array(pixel_sizes, dtype=np.float64)
+    train, test = seeded_split(len(rows), seed)
+    order = np.concatenate([train, test])
+
+    # pixel --> cm:
+    columns = {
+        'image_path': np.array(image_paths, dtype=str)[rows],
+        'study_day': np.array(days, dtype=str),
+        'width': pixels[rows, 0] * pixel_sizes,
+        'height': pixels[rows, 1] * pixel_sizes,
+        'area': pixels[rows, 2] * pixel_sizes ** 2,
+        'pixel_size': pixel_sizes,
+        'weight': np.array(weights, dtype=np.float64),
+        'length': np.array(lengths, dtype=np.float64),
+    }
+    columns = {name: values[order] for name, values in columns.items()}
+    columns['split'] = np.concatenate([np.full(len(train), TRAIN, np.int8), np.full(len(test), TEST, np.int8)])
+    return WeightTable(columns)
+
+
+def table_from_legacy(train_json, test_json, study_days=STUDY_DAYS):
+    '''
+    WeightTable of an existing weight_dataset_train/test.json pair
+    ([image_path, w, h, area, true_weight, true_length] rows), keeping its split.
+    '''
+    records = []
+    for path, split in ((train_json, TRAIN), (test_json, TEST)):
+        with open(path, 'r') as f:
+            records.extend((record, split) for record in json.load(f))
+
+    image_paths = [record[0] for record, _ in records]
+    days, pixel_sizes = [], []
+    for image_path in image_paths:
+        day = next(((date, size) for date, _, size in study_days if date in image_path), ('', np.nan))
+        days.append(day[0])
+        pixel_sizes.append(day[1])
+
+    values = np.array([record[1:6] for record, _ in records], dtype=np.float64).reshape(-1, 5)
+    return WeightTable({
+        'image_path': np.array(image_paths, dtype=str),
+        'study_day': np.array(days, dtype=str),
+        'width': values[:, 0],
+        'height': values[:, 1],
+        'area': values[:, 2],
+        'pixel_size': np.array(pixel_sizes, dtype=np.float64),
+        'weight': values[:, 3],
+        'length': values[:, 4],
+        'split': np.array([split for _, split in records], dtype=np.int8),
+    })
+
+
+def load_or_build(dataset_path, input_path, label_path):
+    '''
+    Memory-mapped WeightTable at dataset_path, built on first use: from the
+    legacy <dataset_path>_train/test.json files if a previous run left them
+    (same split), otherwise from the measurements and the label workbook.
+    '''
+    if not os.path.exists(os.path.join(dataset_path, 'columns.json')):
+        train_json, test_json = dataset_path + '_train.json', dataset_path + '_test.json'
+        if os.path.exists(train_json) and os.path.exists(test_json):
+            print(f'\n Converting {train_json}, {test_json} ...')
+            table = table_from_legacy(train_json, test_json)
+        else:
+            print('\n Generating the dataset...')
+            table = build_table(input_path, label_path)
+        table.save(dataset_path)
+    else:
+        print('\n Opening existing dataset ... ')
+    return WeightTable.load(dataset_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the columnar weight dataset.')
+    parser.add_argument('--input_path', type=str, default='bbox_area_dataset.json',
+                        help='generator output: JSONL, or legacy [image_path, w, h, area] JSON')
+    parser.add_argument('--label_excel', type=str, default='/media/anranli/DATA/data/fish/Growth Study Data 12-2024.xlsx',
+                        help='Ground Truth Weight Label')
+    parser.add_argument('--output', type=str, default='weight_dataset', help='directory of .npy columns')
+    parser.add_argument('--seed', type=int, default=42, help='train/test split seed')
+    args = parser.parse_args()
+
+    table = build_table(args.input_path, args.label_excel, seed=args.seed)
+    table.save(args.output)
+    print(f'{len(table)} labelled fish ({len(table.split_indices("train"))} train, '
+          f'{len(table.split_indices("test"))} test) written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,4 @@
 import torch
-from torch.utils.data import DataLoader
 import argparse
 import numpy as np
 import xgboost as xgb
@@ -91,17 +90,15 @@ data_train = WeightData(input_path=args.input_path,label_path=args.label_excel,m
 data_test = WeightData(input_path=args.input_path,label_path=args.label_excel,mode='test')
 
 
-train_loader = DataLoader(data_train,batch_size=args.batch_size,shuffle=True)
-test_loader = DataLoader(data_test,batch_size=args.batch_size,shuffle=False)
-
-for train_data, test_data in zip(train_loader,test_loader):
-    train_img_name, X_train ,y_train   = train_data
-    test_img_name,  X_test  ,y_test    = test_data
+# whole splits as arrays, straight from the memory-mapped dataset columns
+X_train, y_train = data_train.table.features(data_train.indices), data_train.table.labels(data_train.indices)
+X_test, y_test = data_test.table.features(data_test.indices), data_test.table.labels(data_test.indices)
+test_img_name = data_test.table['image_path'][data_test.indices]
 
 print(test_img_name)
 # Convert data to DMatrix format for XGBoost
-dtrain = xgb.DMatrix(X_train.numpy(), label=y_train.numpy())
-dtest = xgb.DMatrix(X_test.numpy(), label=y_test.numpy())
+dtrain = xgb.DMatrix(X_train, label=y_train)
+dtest = xgb.DMatrix(X_test, label=y_test)
 # Set XGBoost parameters for regression with GPU support
 params = {
     "objective": "reg:squarederror",  # Regression objective
@@ -164,7 +161,7 @@ print(f"RMSE of the best model: {rmse:.4f}")
 
 
 sort_mask = np.argsort(y_test)
-y_test = y_test[sort_mask].numpy()
+y_test = y_test[sort_mask]
 y_pred = y_pred[sort_mask]
 # Calculate error
 error = np.abs(y_test - y_pred)
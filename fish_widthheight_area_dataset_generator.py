@@ -4,256 +4,244 @@ Read images and use current YOLO and segment NN:
 
 genrate width, height, and area of detected fish. (UNIT: PIXEL SIZE)
 
-All data is saved in dataset.json for weight prediction NN training.
-
+Headless streaming CLI. Every directory tree given with --input_dirs is
+walked for JPEGs, which flow through a prefetching read -> decode -> detect
+-> segment -> measure pipeline with --workers measurement workers (each with
+its own models). One JSON line per image is appended to --output as soon as
+it is measured:
+
+    {"image_path": ..., "fish": [{"bounding_box": ..., "width": ..., "height": ..., "area": ...}]}
+
+Images already present in --output are skipped, so an interrupted run can be
+restarted with the same command. --export_json writes the legacy
+[image_path, w, h, area] list used by fish_weight_dataset.py. With
+--cache_dir, images whose bytes were already measured by the same models
+(here or by the API) are not run through the networks again. With --store,
+every image is also written to the pixel-space MeasurementStore, from which
+calibration and weights can be recomputed without the networks.
+
+    python fish_widthheight_area_dataset_generator.py \\
+        --input_dirs '/data/fish/Growth Study Day 2 [12-11-24]' '/data/fish/Tk 4 - varied data' \\
+        --output bbox_area_dataset.jsonl --export_json bbox_area_dataset.json --workers 4
 """
 
-# Commented out IPython magic to ensure Python compatibility.
 import os
-import copy
 import json
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
 from tqdm import tqdm
-import requests
-from   zipfile import ZipFile
-# %matplotlib inline
 import logging
 
+from fish_pipeline import FishPipeline, build_segmentator, segmentator_version
+from fish_result_cache import ResultCache, file_version
+from fish_measurement_store import MeasurementStore
+from fish_model_registry import download_model
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
-def download_and_unzip(url, save_path, extract_dir):
-    print("Downloading assets...")
-    file = requests.get(url)
-
-    open(save_path, "wb").write(file.content)
-    print("Download completed.")
-
-    try:
-        if save_path.endswith(".zip"):
-            with ZipFile(save_path, 'r') as zip_ref:
-                zip_ref.extractall(extract_dir)
-            print("Extraction Done")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
-def download_image(url):
-    filename = os.path.basename(url)
-
-    response = requests.get(url)
-    response.raise_for_status()
-
-    with open(filename, 'wb') as file:
-        file.write(response.content)
-
-    return os.path.abspath(filename)
-
-def get_basename(path):
-  return os.path.basename(path)
-
-def print_fish_data(fish_data):
-    for idx, fish in enumerate(fish_data, start=1):
-        print(f"ID: {idx}")
-        print(f"Name: {fish['name']}")
-        print(f"Species ID: {fish['species_id']}")
-        # print(f"Distance: {fish['distance']:.3f}")
-        print(f"Accuracy: {fish['accuracy']:.2%}")
-        print("-" * 40)
+IMAGE_EXTENSIONS = ('.JPG', '.jpg', '.jpeg', '.JPEG')
 
 # Links to models
 MODEL_URLS = {
-    'classification': 'https://storage.googleapis.com/fishial-ml-resources/classification_rectangle_v7-1.zip',
     'segmentation': 'https://storage.googleapis.com/fishial-ml-resources/segmentator_fpn_res18_416_1.zip',
     'detection': 'https://storage.googleapis.com/fishial-ml-resources/detector_v10_m3.zip',
-    'face': 'https://storage.googleapis.com/fishial-ml-resources/face_yolo.zip'
 }
 
 # Model directories
 MODEL_DIRS = {
-    'classification': "models/classification",
     'segmentation': "models/segmentation",
     'detection': "models/detection",
-    'face': "models/face_detector"
 }
 
-# Create directories and download models
-for model_name, url in MODEL_URLS.items():
-    model_dir = MODEL_DIRS[model_name]
-    zip_path = os.path.join(os.getcwd(), get_basename(url))
-    if not os.path.exists(model_dir):
-        os.makedirs(model_dir, exist_ok=True)  # Create directory if it doesn't exist
-        download_and_unzip(url, zip_path, model_dir)  # Download and unzip the model
-
-        # Remove the zip file after extraction
-        try:
-            os.remove(zip_path)
-            logging.info(f"Removed zip file {zip_path}")
-        except Exception as e:
-            logging.error(f"Failed to remove zip file {zip_path}: {e}")
-
-
-
-from models.classification.inference import EmbeddingClassifier
-from models.detection.inference import YOLOInference
-from models.segmentation.inference import Inference
-from models.face_detector.inference import YOLOInference as FaceInference
-
-
-# Model initialization
-classifier = EmbeddingClassifier(
-    os.path.join(MODEL_DIRS['classification'], 'model.ts'),
-    os.path.join(MODEL_DIRS['classification'], 'database.pt')
-)
-
-segmentator = Inference(
-    model_path=os.path.join(MODEL_DIRS['segmentation'], 'model.ts'),
-    image_size=416
-)
-
-detector = YOLOInference(
-    os.path.join(MODEL_DIRS['detection'], 'model.ts'),
-    imsz=(640, 640),
-    conf_threshold=0.65,
-    nms_threshold=0.3,
-    yolo_ver='v10'
-)
-
-# face_detector = FaceInference(
-#     os.path.join(MODEL_DIRS['face'], 'model.ts'),
-#     imsz=(640, 640),
-#     conf_threshold=0.69,
-#     nms_threshold=0.5,
-#     yolo_ver='v8'
-# )
-
-# If you extend your dataset, add the extended path below:
-fish_pathes = [
-               '/media/anranli/DATA/data/fish/Growth Study Day 2 [12-11-24]',
-               '/media/anranli/DATA/data/fish/Growth Study Day 3 [12-18-24]',
-               '/media/anranli/DATA/data/fish/Growth Study Day 4 [12-30-24]',
-               '/media/anranli/DATA/data/fish/Tk 4 - varied data',
-               '/media/anranli/DATA/data/fish/Tk 5 - varied data']
-save_path = 'bbox_area_dataset_no_bbox_optimization.json'
-res = []
-for fish_path in fish_pathes:
-    fish_list = os.listdir(fish_path)
-
-    # img_higherror_list =  ["/media/anranli/DATA/data/fish/Growth Study Day 3 [12-18-24]/57.JPG"]
-    
-    for fish_i in tqdm(fish_list):
-    # for fish_i in img_higherror_list:
-        if not fish_i.endswith(('.JPG','.jpeg')):
-            continue
-        
-        fish_bgr_np = cv2.imread(os.path.join(fish_path,fish_i))
-        # fish_bgr_np = cv2.imread(fish_i)
-        visulize_img_bgr = fish_bgr_np.copy()
-
-        visulize_img_rgb = cv2.cvtColor(fish_bgr_np, cv2.COLOR_BGR2RGB)
-        visulize_img = copy.deepcopy(visulize_img_rgb)
-
-
-        boxes = detector.predict(visulize_img_rgb)[0]
-        
-        # only save data having bbox:
-        for box in boxes:
-            cropped_fish_bgr = box.get_mask_BGR()
-            cropped_fish_rgb = box.get_mask_RGB()
-            segmented_polygons = segmentator.predict(cropped_fish_bgr)[0]
-
-            croped_fish_mask = segmented_polygons.mask_polygon(cropped_fish_rgb)
-
-            # # output_seg = cv2.cvtColor(croped_fish_mask, cv2.COLOR_RGB2BGR)
-            # cv2.imwrite('cropped_fish.png',croped_fish_mask)
-            # cv2.imshow('cropped fish mask',croped_fish_mask)
-            # cv2.waitKey(0)
-            # cv2.destroyAllWindows()
-
-
-            croped_fish_mask = np.zeros_like(cropped_fish_rgb)
-            # Fill the object inside the boundary with white
-            cv2.fillPoly(croped_fish_mask, [segmented_polygons.points], (255,255,255))  # 255 for white color
-
-
-            # =================ROTATION FISH EXP===============================
-
-            # Load the binary segmented mask
-            mask = croped_fish_mask.copy()
-
-            mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
-            # cv2.imshow('mask',mask)
-            # cv2.waitKey(0)
-            # cv2.destroyAllWindows()
-
-            # Ensure the mask is binary
-            # _, binary_mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
-
-            # Find contours
-            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            # Assuming the object is represented by the largest contour
-            contour = max(contours, key=cv2.contourArea)
-            
-            
-            # cv2.drawContours(mask, [contour], -1, (0, 255, 0), 2) 
-            # cv2.imshow('contour find',mask)
-            # cv2.waitKey(0)
-            # cv2.destroyAllWindows()
-
-            # Compute the minimum area rotated bounding rectangle
-            rect = cv2.minAreaRect(contour)
-
-            # Get the box points (corner points of the rotated rectangle)
-            boxx = cv2.boxPoints(rect)
-
-            # return location to origon image:
-            boxx[:,0] += box.x1
-            boxx[:,1] += box.y1
-            boxx = np.intp(boxx)  # Convert to integer
-
-            # ******Reculate width and height --> Directly applied as fish size *******
-            fish_height = np.sqrt((boxx[0,0]-boxx[1,0])**2 + (boxx[0,1]-boxx[1,1])**2 )
-            fish_width = np.sqrt((boxx[2,0]-boxx[1,0])**2 + (boxx[2,1]-boxx[1,1])**2 )
-            if fish_height > fish_width:
-                # swap height and width
-                tmp = fish_height
-                fish_height = fish_width
-                fish_width = tmp
-
-
-            # BBOX VERIFY:
-            # Draw the bounding box on the ori image (for visualization)
-            print(f'width: {fish_width}')
-            cv2.drawContours(visulize_img, [boxx], 0, (0, 255, 0), 4)
-            # Display the result
-            visulize_img = cv2.cvtColor(visulize_img,cv2.COLOR_RGB2BGR)
-            imS = cv2.resize(visulize_img, (visulize_img.shape[1]//4, visulize_img.shape[0]//4))                # Resize image
-            cv2.imwrite('final_visual.png',imS)
-            cv2.imshow("output", imS) 
-            # cv2.imshow('Rotated Bounding Box', visulize_img)
-            cv2.waitKey(0)
-            cv2.destroyAllWindows()
-
-            # =================================================================
-
-
-
-
-            # segmented_polygons.move_to(box.x1, box.y1)
-            # segmented_polygons.draw_polygon(visulize_img)
-
-            # classification_result = classifier.batch_inference([cropped_fish_bgr])[0]
-
-            # label = f"{classification_result[0]['name']} | {round(classification_result[0]['accuracy'], 3)}" if len(classification_result) else "Not Found"
-            # box.draw_label(visulize_img, label)
-            # box.draw_box(visulize_img)
-            res.append([os.path.join(fish_path,fish_i),fish_width,fish_height,segmented_polygons.to_dict()['area']])
-            # res.append([os.path.join(fish_path,fish_i),box.width,box.height,segmented_polygons.to_dict()['area']])
-
-
-
 
-with open(save_path,'w') as f:
-    json.dump(res,f)
-    # f.write(';\n')
+def download_models():
+    for model_name, url in MODEL_URLS.items():
+        download_model(url, MODEL_DIRS[model_name])
+
+
+def build_pipeline(conf_threshold=0.65, cache=None, batch_segmentation=False):
+    from models.detection.inference import YOLOInference
+
+    segmentator = build_segmentator(os.path.join(MODEL_DIRS['segmentation'], 'model.ts'), image_size=416,
+                                    batched=batch_segmentation)
+
+    detector = YOLOInference(
+        os.path.join(MODEL_DIRS['detection'], 'model.ts'),
+        imsz=(640, 640),
+        conf_threshold=conf_threshold,
+        nms_threshold=0.3,
+        yolo_ver='v10'
+    )
+
+    versions = {
+        'detector': file_version(os.path.join(MODEL_DIRS['detection'], 'model.ts')) + f'@{conf_threshold}',
+        'segmentator': segmentator_version(os.path.join(MODEL_DIRS['segmentation'], 'model.ts'), 416,
+                                           batch_segmentation),
+        'decoder': DECODE_BGR_VERSION,
+    }
+    return FishPipeline(detector, segmentator, cache=cache, versions=versions)
+
+
+def read_bytes(image_path):
+    with open(image_path, 'rb') as f:
+        return f.read()
+
+
+# cache version of decode_bgr: cv2 returns BGR with the EXIF orientation applied,
+# so its measurements differ from the API's (fish_pipeline.DECODE_IMAGE_VERSION)
+DECODE_BGR_VERSION = 'cv2-bgr-exif'
+
+
+def decode_bgr(contents):
+    image = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise IOError('Cannot decode image')
+    return image
+
+
+def list_images(input_dirs):
+    '''Walk every input directory tree and return sorted JPEG paths.'''
+    image_paths = []
+    for input_dir in input_dirs:
+        for root, _, files in os.walk(input_dir):
+            image_paths.extend(os.path.join(root, name) for name in files if name.endswith(IMAGE_EXTENSIONS))
+    return sorted(image_paths)
+
+
+def load_done(output_path):
+    '''Image paths already measured in a previous (maybe interrupted) run.'''
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+
+    with open(output_path, 'r') as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)['image_path'])
+            except (ValueError, KeyError):
+                # last line of a crashed run may be truncated
+                continue
+    return done
+
+
+def export_legacy_json(output_path, json_path):
+    '''Flatten the JSONL results into the [image_path, w, h, area] list.'''
+    res = []
+    with open(output_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            for fish in record['fish']:
+                res.append([record['image_path'], fish['width'], fish['height'], fish['area']])
+
+    with open(json_path, 'w') as f:
+        json.dump(res, f)
+    print(f'{len(res)} fish exported to {json_path}')
+
+
+class MeasureWorkers:
+    '''
+    Thread pool where every thread owns its own FishPipeline.
+    '''
+    def __init__(self, workers, conf_threshold, cache=None, batch_segmentation=False):
+        self.local = threading.local()
+        self.conf_threshold = conf_threshold
+        self.cache = cache
+        self.batch_segmentation = batch_segmentation
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _measure(self, image_path, read):
+        if not hasattr(self.local, 'pipeline'):
+            self.local.pipeline = build_pipeline(self.conf_threshold, self.cache, self.batch_segmentation)
+
+        fish = self.local.pipeline.measure_pixels_contents([read.result()], decode=decode_bgr)[0]
+        if isinstance(fish, Exception):
+            raise fish
+        # the pipeline lives in this worker thread: hand its model versions back with the fish
+        return fish, self.local.pipeline.versions
+
+    def submit(self, image_path, read):
+        return self.executor.submit(self._measure, image_path, read)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure fish width, height and area (pixel) for image folders.')
+    parser.add_argument('--input_dirs', type=str, nargs='+', required=True, help='image folders (searched recursively)')
+    parser.add_argument('--output', type=str, default='bbox_area_dataset.jsonl', help='JSONL results, appended and resumable')
+    parser.add_argument('--export_json', type=str, default='', help='also write legacy [path, w, h, area] JSON list')
+    parser.add_argument('--workers', type=int, default=2, help='measurement workers (one model set each)')
+    parser.add_argument('--read_workers', type=int, default=2, help='image file read threads')
+    parser.add_argument('--prefetch', type=int, default=4, help='images read ahead per measurement worker')
+    parser.add_argument('--conf_threshold', type=float, default=0.65, help='detector confidence threshold')
+    parser.add_argument('--cache_dir', type=str, default='', help='measurement cache (empty: off); may be the API cache directory, entries are keyed by decoder')
+    parser.add_argument('--cache_mb', type=int, default=2048, help='measurement cache size bound')
+    parser.add_argument('--batch_segmentation', action='store_true',
+                        help='segment all fish of an image in one forward pass (BatchSegmentator) instead of the shipped Inference')
+    parser.add_argument('--store', type=str, default='', help='also write into this pixel-space measurement store (SQLite)')
+    args = parser.parse_args()
+
+    download_models()
+
+    store = MeasurementStore(args.store) if len(args.store) else None
+
+    done = load_done(args.output)
+    if store is not None:
+        # (JSONL lines written before --store was used: `fish_measurement_store.py import`)
+        done |= store.measured_paths()
+    image_paths = [path for path in list_images(args.input_dirs) if path not in done]
+    print(f'{len(done)} images already measured, {len(image_paths)} to go')
+
+    cache = ResultCache(args.cache_dir, max_bytes=args.cache_mb * 1024 * 1024) if len(args.cache_dir) else None
+
+    reader = ThreadPoolExecutor(max_workers=args.read_workers)
+    workers = MeasureWorkers(args.workers, args.conf_threshold, cache, args.batch_segmentation)
+    max_in_flight = args.workers * args.prefetch
+
+    in_flight = deque()
+    paths = iter(image_paths)
+    with open(args.output, 'a') as f, tqdm(total=len(image_paths)) as progress:
+        while True:
+            # keep the pipeline full: read ahead of the measurement workers
+            while len(in_flight) < max_in_flight:
+                image_path = next(paths, None)
+                if image_path is None:
+                    break
+                read = reader.submit(read_bytes, image_path)
+                in_flight.append((image_path, workers.submit(image_path, read)))
+
+            if len(in_flight) == 0:
+                break
+
+            # write in input order, one line per image, flushed immediately
+            image_path, measured = in_flight.popleft()
+            try:
+                fish, versions = measured.result()
+            except Exception as e:
+                logging.error(f'Failed to measure {image_path}: {e}')
+            else:
+                f.write(json.dumps({'image_path': image_path, 'fish': fish}) + '\n')
+                f.flush()
+                if store is not None:
+                    store.add_image(image_path, fish, versions)
+            progress.update(1)
+
+    workers.shutdown()
+    reader.shutdown()
+
+    if len(args.export_json):
+        export_legacy_json(args.output, args.export_json)
+
+
+if __name__ == '__main__':
+    main()
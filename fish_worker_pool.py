@@ -0,0 +1,150 @@
+'''
+Worker pool for blocking inference work behind the FastAPI app.
+
+The detector -> segmentor -> WeightNet pipeline (OpenCV + TorchScript) is
+CPU bound and must not run on the event loop. InferencePool runs it on a
+thread or process pool where every worker owns its own model instances,
+built once by a factory function when the worker starts.
+
+Workers are started by InferencePool.start(), which returns once every
+worker has built (and warmed up) its models; ready_workers / is_ready back
+the API readiness probe.
+
+Queue depth is bounded: once `workers + max_queue` jobs are in flight new
+submissions raise PoolFull, which the API turns into HTTP 429.
+
+Configuration (environment variables read by pool_from_env):
+
+    FISH_WORKERS        number of workers                 (default 2)
+    FISH_WORKER_MODE    'thread' or 'process'             (default thread)
+    FISH_QUEUE_DEPTH    jobs allowed to wait for a worker (default 8)
+    FISH_TORCH_THREADS  torch threads per worker          (default torch's)
+'''
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+
+
+# models of the current worker (thread local also works for the process
+# pool: each worker process runs its tasks on a single thread)
+_worker_state = threading.local()
+
+
+class PoolFull(Exception):
+    '''Raised when the pool already holds the maximum number of jobs.'''
+
+
+def _init_worker(factory, torch_threads, ready):
+    if torch_threads:
+        import torch
+        torch.set_num_threads(torch_threads)
+    _worker_state.models = factory()
+    with ready.get_lock():
+        ready.value += 1
+
+
+def _run_in_worker(fn, args):
+    return fn(_worker_state.models, *args)
+
+
+def _worker_started(models, barrier, fn):
+    # hold this thread until every thread took one job, so none takes two
+    if barrier is not None:
+        barrier.wait()
+    return None if fn is None else fn(models)
+
+
+class InferencePool:
+    '''
+    Bounded pool of inference workers.
+
+        factory       : picklable callable returning the per-worker models
+                        object, passed as first argument to every job
+        workers       : number of worker threads/processes
+        mode          : 'thread' or 'process'
+        max_queue     : jobs allowed to wait when every worker is busy
+        torch_threads : torch intra-op threads per worker (0 keeps default)
+    '''
+    def __init__(self, factory, workers=2, mode='thread', max_queue=8, torch_threads=0):
+        if mode not in ('thread', 'process'):
+            raise ValueError(f'Unknown worker mode: {mode}')
+
+        self.workers = workers
+        self.mode = mode
+        self.max_pending = workers + max_queue
+        self.pending = 0
+
+        context = multiprocessing.get_context('fork')
+        # workers whose models are loaded, shared with worker processes
+        self.ready = context.Value('i', 0)
+
+        if mode == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                               initargs=(factory, torch_threads, self.ready))
+        else:
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                initargs=(factory, torch_threads, self.ready),
+                                                mp_context=context)
+
+    async def start(self, fn=None):
+        '''
+        Start all workers and wait until each one has built its models.
+
+        A fork process pool starts all processes on the first job; threads
+        are started one per job, so every thread is given one job. With fn,
+        return the list of fn(models) of these first jobs.
+        '''
+        loop = asyncio.get_running_loop()
+        barrier = threading.Barrier(self.workers) if self.mode == 'thread' else None
+        results = await asyncio.gather(*[loop.run_in_executor(self.executor, _run_in_worker, _worker_started,
+                                                              (barrier, fn))
+                                         for _ in range(self.workers)])
+        while not self.is_ready:
+            await asyncio.sleep(0.05)
+        return results
+
+    @property
+    def ready_workers(self):
+        return self.ready.value
+
+    @property
+    def is_ready(self):
+        return self.ready.value >= self.workers
+
+    @property
+    def queue_depth(self):
+        '''Jobs submitted but not yet picked up by a worker.'''
+        return max(0, self.pending - self.workers)
+
+    async def run(self, fn, *args):
+        '''
+        Run fn(models, *args) on a worker and await the result.
+
+        Raise PoolFull immediately instead of queueing without bound.
+        '''
+        if self.pending >= self.max_pending:
+            raise PoolFull(f'{self.pending} inference jobs in flight')
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, _run_in_worker, fn, args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def pool_from_env(factory):
+    '''Build an InferencePool configured by the FISH_* environment variables.'''
+    return InferencePool(
+        factory,
+        workers=int(os.environ.get('FISH_WORKERS', 2)),
+        mode=os.environ.get('FISH_WORKER_MODE', 'thread'),
+        max_queue=int(os.environ.get('FISH_QUEUE_DEPTH', 8)),
+        torch_threads=int(os.environ.get('FISH_TORCH_THREADS', 0)),
+    )
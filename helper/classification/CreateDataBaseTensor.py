@@ -12,6 +12,7 @@ import yaml
 import torch
 import random
 import argparse
+import numpy as np
 
 from pathlib import Path
 from PIL import Image
@@ -19,6 +20,7 @@ from torchvision import transforms
 
 from module.classification_package.src.utils import read_json, save_json
 from module.classification_package.src.model import init_model
+from module.classification_package.src.compact_database import save_compact
 
 
 def get_config(path):
@@ -40,6 +42,12 @@ def main():
     
     parser.add_argument("--annotation", "-a", required=True,
                         help="Path to annotation file", nargs='+', default=[])
+
+    parser.add_argument("--format", "-f", default='padded', choices=['padded', 'compact'],
+                        help="padded: legacy (classes x max_val x emb) tensor, compact: ragged memory-mapped database")
+
+    parser.add_argument("--dtype", "-d", default='float16', choices=['float16', 'int8'],
+                        help="Vector storage type of the compact database")
     
     args = parser.parse_args()
     
@@ -93,6 +101,20 @@ def main():
 
         dict_info = {idx: label for idx, label in enumerate(set(data_train['label']))}
 
+        if args.format == 'compact':
+            # no filler rows: classes are stored back to back with a ragged offset index
+            save_compact(os.path.join(absolute_path, name_ann + '_embedding_compact'),
+                         [torch.stack(i).numpy() if len(i) else np.zeros((0, config['model']['embeddings']), np.float32)
+                          for i in data_set],
+                         dtype=args.dtype)
+            list_of_ids = [[class_idx, image_id, annotation_id, None]
+                           for class_idx in range(len(data_set))
+                           for image_id, annotation_id in zip(data_set_ids[class_idx]['image_id'],
+                                                              data_set_ids[class_idx]['annotation_id'])]
+            save_json(dict_info, os.path.join(absolute_path, name_ann + '_labels_compact.json'))
+            save_json(list_of_ids, os.path.join(absolute_path, name_ann + '_list_of_ids_compact.json'))
+            continue
+
         max_val = max(len(i) for i in data_set)
         for i in range(len(data_set)):
             if len(data_set[i]) < max_val:
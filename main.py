@@ -1,224 +1,231 @@
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-import cv2
+from fastapi.responses import StreamingResponse
 import numpy as np
-import pandas as pd
 from PIL import Image
 import io
 import os
-import copy
+import asyncio
+import time
 import json
-import matplotlib.pyplot as plt
-import requests
-from   zipfile import ZipFile
 # %matplotlib inline
 import logging
 import torch
 
 from fish_weight_model import WeightNet
-from models.classification.inference import EmbeddingClassifier
-from models.detection.inference import YOLOInference
-from models.segmentation.inference import Inference
-from models.face_detector.inference import YOLOInference as FaceInference
+from fish_weight_numpy import load_evaluator
+from fish_pipeline import DECODE_IMAGE_VERSION, FishPipeline, ImageDecodeError, build_segmentator, segmentator_version
+from fish_worker_pool import PoolFull, pool_from_env
+from fish_batcher import batcher_from_env
+from fish_result_cache import cache_from_env, file_version
+from fish_model_registry import ModelRegistry
+from fish_calibration import find_calibration_dot
+from fish_calibration_store import store_from_env as calibration_store_from_env
+from fish_metrics import Metrics, StageTimer
+from fish_results_store import EXPORT_MEDIA_TYPES, store_from_env as results_store_from_env
+from fish_bulk_upload import measure_stream, upload_images
+from fish_cpu_optimize import optimize_classifier, optimize_pipeline, mode_from_env as optimize_mode_from_env
 
 
 app = FastAPI()
 
-# calibration process
+# Set up logging
+logging.basicConfig(level=logging.INFO)
 
-def crop_selected_img(image):
-    '''
-    Select image and crop via opencv roi toolbox
-    '''
-    image_copy = image.copy()
-    ref_point = []
-    cropping = False
-    resize_idx = 4
-    image_resize = cv2.resize(image,(image.shape[1]//resize_idx,image.shape[0]//resize_idx))
+def print_fish_data(fish_data):
+    for idx, fish in enumerate(fish_data, start=1):
+        print(f"ID: {idx}")
+        print(f"Name: {fish['name']}")
+        print(f"Species ID: {fish['species_id']}")
+        # print(f"Distance: {fish['distance']:.3f}")
+        print(f"Accuracy: {fish['accuracy']:.2%}")
+        print("-" * 40)
 
 
-    while True:
-        # Display the image and let the user select a region
-        r = cv2.selectROI("Image", image_resize)
-        x1, y1, w, h = int(r[0]), int(r[1]), int(r[2]), int(r[3])
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-        # reproject to origional size:
-        x2, y2 = x1 + w, y1 + h
-        x1,y1,x2,y2 = int(x1*resize_idx),int(y1*resize_idx),int(x2*resize_idx),int(y2*resize_idx)
+# a .npz evaluator exported by fish_weight_numpy.py runs the weight
+# regression without torch
+WEIGHT_MODEL_PATH = os.environ.get('FISH_WEIGHT_MODEL', 'fish_saved_weights/model_epoch80_0.15009590983390808.pth')
 
-        if w > 0 and h > 0:
-            
-            roi = image[y1:y2, x1:x2]
-            # cv2.imwrite('paper_image/cropped_dot.png',roi)
-            # cv2.imshow("Processed ROI", roi)
-            # cv2.waitKey(0)
-            # cv2.destroyAllWindows()
-            break
+# models are downloaded and loaded on first use (or by the startup warm-up),
+# never at import time
+registry = ModelRegistry()
 
 
-    
-    return roi
+# FISH_BATCH_SEGMENTATION=1: segment all crops of an image in one forward
+# pass (BatchSegmentator) instead of the shipped Inference, once
+# fish_segmentation_parity.py agrees on the real weights
+BATCH_SEGMENTATION = os.environ.get('FISH_BATCH_SEGMENTATION', '0') != '0'
 
-def find_coin_diameter(image):
 
-    # denoise image
-    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+def load_segmentator(registry):
+    return build_segmentator(registry.path('segmentation'), image_size=416, batched=BATCH_SEGMENTATION)
 
-    # # Gaussian Blur
-    # gaussian_blur = cv2.GaussianBlur(image, (5, 5), 0)
 
-    # # Median Blur
-    # median_blur = cv2.medianBlur(image, 5)
+def load_detector(registry):
+    from models.detection.inference import YOLOInference
 
+    return YOLOInference(
+        registry.path('detection'),
+        imsz=(640, 640),
+        conf_threshold=0.9,
+        nms_threshold=0.3,
+        yolo_ver='v10'
+    )
 
-    image = crop_selected_img(image)
 
-    # Brighten the image
-    image = cv2.convertScaleAbs(image, alpha=1.5, beta=30)  # Increase alpha and beta for brightness
-    # Non-Local Means Denoising
-    image = cv2.fastNlMeansDenoisingColored(image, None, 10, 10, 7, 21)
-    # Convert to grayscale
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    # Blur the image to reduce noise
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+def load_weight_model(registry):
+    if WEIGHT_MODEL_PATH.endswith('.npz'):
+        return load_evaluator(WEIGHT_MODEL_PATH)
 
-    # ================PREVIOUS METHOD: Find edges using edge detection ===============
-    edges = cv2.Canny(blurred, 20, 250)
-    # Find the contours in the image
-    contours, hierarchy = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    
-    # ================OTHER METHOD: FIND CIRCLE WITH BLUE COLOR======================
-    # # Convert the image to HSV for better color segmentation
-    # hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    # # Define the blue color range in HSV
-    # lower_blue = np.array([100, 150, 50])  # Adjust these values if necessary
-    # upper_blue = np.array([140, 255, 255])
-    # # Create a binary mask where blue is white and other colors are black
-    # mask = cv2.inRange(hsv_image, lower_blue, upper_blue)
-    # # Find contours in the mask
-    # contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    weight_model = WeightNet().to(device)
+    weight_model.load_state_dict(torch.load(WEIGHT_MODEL_PATH, map_location=device))
+    weight_model.eval()
+    return weight_model
 
 
-    
-    
-    contours_cnt = [len(x) for x in contours]
-    perimeter = cv2.arcLength(contours[np.argmax(contours_cnt)], True)
-    # Draw contours
-    output_image = image.copy()
-    cv2.drawContours(output_image, [contours[np.argmax(contours_cnt)]], -1, (0, 255, 0), 2)  # Draw in green with thickness 2
+def load_classifier(registry):
+    # species classification is not used by any route yet
+    from models.classification.inference import EmbeddingClassifier
 
-    # Find the largest contour (which should be the coin)
-    largest_contour = max(contours, key=cv2.contourArea)
+    classifier = EmbeddingClassifier(
+        registry.path('classification'),
+        registry.path('classification', 'database.pt')
+    )
+    return optimize_classifier(classifier, optimize_mode_from_env())
 
-    # Find the minimum enclosing circle of the largest contour
-    (x, y), radius = cv2.minEnclosingCircle(largest_contour)
 
-    # Calculate the diameter of the coin
-    diameter = 2 * radius
+registry.register('segmentation', load_segmentator)
+registry.register('detection', load_detector)
+registry.register('weight', load_weight_model)
+registry.register('classification', load_classifier)
 
-    return 1.27/diameter, output_image # Convert to cm/pixel
+# models the /detect/ pipeline needs (face detector is never used)
+PIPELINE_MODELS = ('detection', 'segmentation')
 
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+def build_pipeline():
+    '''
+    Load detector, segmentator and weight model and warm them up. Called once
+    in every inference worker so workers never share model instances.
+    '''
+    pipeline = FishPipeline(
+        registry.load('detection'),
+        registry.load('segmentation'),
+        registry.load('weight'),
+        device,
+        cache=cache_from_env(),
+        # detections of an already seen image are reused, whatever the calibration
+        versions={
+            'detector': file_version(registry.path('detection')) + '@0.9',
+            'segmentator': segmentator_version(registry.path('segmentation'), 416, BATCH_SEGMENTATION),
+            'decoder': DECODE_IMAGE_VERSION,
+        },
+        # stage latencies, shipped back to the API process with every job
+        timer=StageTimer(),
+    )
+    for name in ('detection', 'segmentation', 'weight'):
+        pipeline.timer.model_loaded(name, registry.load_times.get(name, 0.0))
 
-def download_and_unzip(url, save_path, extract_dir):
-    print("Downloading assets...")
-    file = requests.get(url)
+    # opt-in frozen graphs for CPU-only stations
+    optimize_pipeline(pipeline, optimize_mode_from_env())
+    if os.environ.get('FISH_WARMUP', '1') != '0':
+        start = time.perf_counter()
+        pipeline.warm_up()
+        pipeline.timer.model_loaded('warm_up', time.perf_counter() - start)
+    return pipeline
 
-    open(save_path, "wb").write(file.content)
-    print("Download completed.")
 
-    try:
-        if save_path.endswith(".zip"):
-            with ZipFile(save_path, 'r') as zip_ref:
-                zip_ref.extractall(extract_dir)
-            print("Extraction Done")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+def measure_uploads(pipeline, uploads):
+    return pipeline.measure_uploads(uploads), pipeline.timer.drain()
 
-def get_basename(path):
-  return os.path.basename(path)
 
-def print_fish_data(fish_data):
-    for idx, fish in enumerate(fish_data, start=1):
-        print(f"ID: {idx}")
-        print(f"Name: {fish['name']}")
-        print(f"Species ID: {fish['species_id']}")
-        # print(f"Distance: {fish['distance']:.3f}")
-        print(f"Accuracy: {fish['accuracy']:.2%}")
-        print("-" * 40)
+def worker_timings(pipeline):
+    return pipeline.timer.drain()
 
 
-# Links to models
-MODEL_URLS = {
-    'classification': 'https://storage.googleapis.com/fishial-ml-resources/classification_rectangle_v7-1.zip',
-    'segmentation': 'https://storage.googleapis.com/fishial-ml-resources/segmentator_fpn_res18_416_1.zip',
-    'detection': 'https://storage.googleapis.com/fishial-ml-resources/detector_v10_m3.zip',
-    'face': 'https://storage.googleapis.com/fishial-ml-resources/face_yolo.zip'
-}
+async def measure_batch(uploads):
+    results, timings = await inference_pool.run(measure_uploads, uploads)
+    metrics.record_batch(timings, [len(fish) for fish in results if not isinstance(fish, Exception)])
+    return results
 
 
-# Model directories
-MODEL_DIRS = {
-    'classification': "models/classification",
-    'segmentation': "models/segmentation",
-    'detection': "models/detection",
-    'face': "models/face_detector"
-}
+metrics = Metrics(log=os.environ.get('FISH_METRICS_LOG', '0') != '0')
 
 
-# Create directories and download models
-for model_name, url in MODEL_URLS.items():
-    model_dir = MODEL_DIRS[model_name]
-    zip_path = os.path.join(os.getcwd(), get_basename(url))
-    if not os.path.exists(model_dir):
-        os.makedirs(model_dir, exist_ok=True)  # Create directory if it doesn't exist
-        download_and_unzip(url, zip_path, model_dir)  # Download and unzip the model
+# detector -> segmentor -> WeightNet work runs on this pool, never on the event loop
+inference_pool = None
+# concurrent /detect/ uploads are coalesced into one batched pool job
+detect_batcher = None
 
-        # Remove the zip file after extraction
-        try:
-            os.remove(zip_path)
-            logging.info(f"Removed zip file {zip_path}")
-        except Exception as e:
-            logging.error(f"Failed to remove zip file {zip_path}: {e}")
 
+# background task starting and warming up the workers
+warm_up_task = None
 
 
+async def warm_up_workers():
+    '''
+    Download the pipeline models once, then start every worker (models built
+    and warmed up in build_pipeline). /readyz reports ready afterwards.
+    '''
+    loop = asyncio.get_running_loop()
+    try:
+        for name in PIPELINE_MODELS:
+            await loop.run_in_executor(None, registry.ensure_files, name)
+        for timings in await inference_pool.start(worker_timings):
+            metrics.apply(timings)
+        logging.info(f"[INIT] {inference_pool.ready_workers} inference workers ready")
+    except Exception as e:
+        logging.error(f"[INIT] Failed to start inference workers: {e}")
 
 
-# Model initialization
-classifier = EmbeddingClassifier(
-    os.path.join(MODEL_DIRS['classification'], 'model.ts'),
-    os.path.join(MODEL_DIRS['classification'], 'database.pt')
-)
+@app.on_event("startup")
+async def start_inference_pool():
+    global inference_pool, detect_batcher, warm_up_task, calibration_store, results_store
+    calibration_store = calibration_store_from_env()
+    results_store = results_store_from_env()
+    inference_pool = pool_from_env(build_pipeline)
+    detect_batcher = batcher_from_env(measure_batch)
+    detect_batcher.start()
+    metrics.gauge('fish_inference_pending', 'Inference jobs submitted and not finished.',
+                  lambda: inference_pool.pending)
+    metrics.gauge('fish_inference_queue_depth', 'Inference jobs waiting for a worker.',
+                  lambda: inference_pool.queue_depth)
+    metrics.gauge('fish_batcher_queue_depth', 'Images waiting to be batched.', lambda: detect_batcher.queue_depth)
+    metrics.gauge('fish_workers_ready', 'Inference workers with warm models.', lambda: inference_pool.ready_workers)
+    # the server accepts connections right away, load balancers wait for /readyz
+    warm_up_task = asyncio.get_running_loop().create_task(warm_up_workers())
 
-segmentator = Inference(
-    model_path=os.path.join(MODEL_DIRS['segmentation'], 'model.ts'),
-    image_size=416
-)
 
-detector = YOLOInference(
-    os.path.join(MODEL_DIRS['detection'], 'model.ts'),
-    imsz=(640, 640),
-    conf_threshold=0.9,
-    nms_threshold=0.3,
-    yolo_ver='v10'
-)
+@app.on_event("shutdown")
+async def stop_inference_pool():
+    warm_up_task.cancel()
+    await detect_batcher.stop()
+    inference_pool.shutdown(wait=False)
+    calibration_store.close()
+    results_store.close()
+
+
+@app.get("/healthz")
+async def healthz():
+    '''Liveness: the process is up and serving the event loop.'''
+    return {"status": "ok"}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    '''Stage latency histograms, fish counts, queue depth and model load times.'''
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
 
-# face_detector = FaceInference(
-#     os.path.join(MODEL_DIRS['face'], 'model.ts'),
-#     imsz=(640, 640),
-#     conf_threshold=0.69,
-#     nms_threshold=0.5,
-#     yolo_ver='v8'
-# )
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-weight_model = WeightNet().to(device)
 
-weight_model.load_state_dict(torch.load('fish_saved_weights/model_epoch80_0.15009590983390808.pth'))
-weight_model.eval()
-print('model loaded')
+@app.get("/readyz")
+async def readyz():
+    '''Readiness: every inference worker has loaded and warmed up its models.'''
+    if inference_pool is None or not inference_pool.is_ready:
+        ready = 0 if inference_pool is None else inference_pool.ready_workers
+        raise HTTPException(status_code=503, detail=f"Warming up: {ready} inference workers ready")
+    return {"status": "ready", "workers": inference_pool.ready_workers}
 
 
 # Enable CORS
@@ -229,176 +236,139 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-# Global variable to store calibration factor
-calibration_factor = None
+# calibration (cm/pixel) of every station, shared by all workers
+calibration_store = None
+# saved results, appended (exported to Excel/CSV on demand)
+results_store = None
+# calibrations below this confidence are rejected (HTTP 422)
+CALIBRATION_MIN_CONFIDENCE = float(os.environ.get('FISH_CALIBRATION_MIN_CONFIDENCE', 0.5))
+# station of clients that do not send one
+DEFAULT_STATION = 'default'
 
 @app.post("/calibrate/")
-async def calibrate(file: UploadFile = File(...)):
-    global calibration_factor
-    
+async def calibrate(file: UploadFile = File(...), station: str = Form(DEFAULT_STATION), session: str = Form('')):
     # Read the image
     contents = await file.read()
-    image = Image.open(io.BytesIO(contents))
-    image = np.array(image)
 
-    calibration_factor,out_img = find_coin_diameter(image)
+    # automatic reference dot detection, headless and off the event loop
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(None, calibrate_bytes, contents)
+    if result is None or result['confidence'] < CALIBRATION_MIN_CONFIDENCE:
+        raise HTTPException(status_code=422, detail={"message": "Calibration dot not found", "calibration": result})
 
-    cv2.imshow("Calibration Circle", out_img)
-    # Wait and close the windows
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
-    # Fake calibration logic (Replace with actual calibration process)
-    # reference_object_real_length = 10.0  # cm (example)
-    # reference_object_pixel_length = image.shape[1] // 4  # Assume detected object width
-    
-    # calibration_factor = reference_object_real_length / reference_object_pixel_length
-    
-    return {"scale_factor": calibration_factor}
+    # a committed SQLite write (may wait on another worker's lock): off the loop too
+    calibration = await loop.run_in_executor(None, calibration_store.add, station, result['pixel_size'], session,
+                                             result['diameter'], result['confidence'], file.filename)
+    return {"scale_factor": calibration['pixel_size'], "diameter": result['diameter'],
+            "confidence": result['confidence'], "station": station, "session": calibration['session'],
+            "calibrated_at": calibration['calibrated_at']}
+
+
+@app.get("/calibration/")
+async def calibration(station: str = DEFAULT_STATION, at: float = None):
+    '''Calibration of a station now, or in effect at time `at` (epoch seconds).'''
+    record = calibration_store.lookup(station) if at is None else calibration_store.at(station, at)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Station {station} is not calibrated")
+    return record
+
+
+def calibrate_bytes(contents):
+    image = np.array(Image.open(io.BytesIO(contents)))
+    return find_calibration_dot(image)
 
 
 @app.post("/detect/")
-async def detect(file: UploadFile = File(...)):
+async def detect(file: UploadFile = File(...), station: str = Form(DEFAULT_STATION)):
+    start = time.perf_counter()
     # Read the image
-    res = []
-    global calibration_factor
-
     contents = await file.read()
-    image = Image.open(io.BytesIO(contents))
-    image = np.array(image)
 
-    # Fake object detection logic (Replace with real detection)
-    h, w, _ = image.shape
+    calibration = calibration_store.lookup(station)
+    if calibration is None:
+        raise HTTPException(status_code=409, detail=f"Station {station} is not calibrated, call /calibrate/ first")
 
-    fish_bgr_np = image.copy()
+    # decode, detect, segment and weigh on an inference worker, batched
+    # together with other uploads arriving at the same time
+    try:
+        fish = await detect_batcher.submit((contents, calibration['pixel_size']))
+    except PoolFull:
+        raise HTTPException(status_code=429, detail="Inference queue is full, retry later")
+    except ImageDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"{file.filename}: {e}")
 
-    visulize_img_rgb = cv2.cvtColor(fish_bgr_np, cv2.COLOR_BGR2RGB)
-    visulize_img = copy.deepcopy(visulize_img_rgb)
+    metrics.observe_stage('request', time.perf_counter() - start)
+    return detection_response(fish)
 
 
-    boxes = detector.predict(visulize_img_rgb)[0]
-    
-    # only save data having bbox:
-    for box in boxes:
-        cropped_fish_bgr = box.get_mask_BGR()
-        cropped_fish_rgb = box.get_mask_RGB()
-        segmented_polygons = segmentator.predict(cropped_fish_bgr)[0]
-
-        croped_fish_mask = segmented_polygons.mask_polygon(cropped_fish_rgb)
-
-        # # output_seg = cv2.cvtColor(croped_fish_mask, cv2.COLOR_RGB2BGR)
-        # cv2.imwrite('cropped_fish.png',croped_fish_mask)
-        # cv2.imshow('cropped fish mask',croped_fish_mask)
-        # cv2.waitKey(0)
-        # cv2.destroyAllWindows()
-
-
-        croped_fish_mask = np.zeros_like(cropped_fish_rgb)
-        # Fill the object inside the boundary with white
-        cv2.fillPoly(croped_fish_mask, [segmented_polygons.points], (255,255,255))  # 255 for white color
-
-
-        # =================ROTATION FISH EXP===============================
-
-        # Load the binary segmented mask
-        mask = croped_fish_mask.copy()
-
-        mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
-
-        # Find contours
-        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        # Assuming the object is represented by the largest contour
-        contour = max(contours, key=cv2.contourArea)
-        
-        
-        # cv2.drawContours(mask, [contour], -1, (0, 255, 0), 2) 
-        # cv2.imshow('contour find',mask)
-        # cv2.waitKey(0)
-        # cv2.destroyAllWindows()
-
-        # Compute the minimum area rotated bounding rectangle
-        rect = cv2.minAreaRect(contour)
-
-        # Get the box points (corner points of the rotated rectangle)
-        boxx = cv2.boxPoints(rect)
-
-        # return location to origon image:
-        boxx[:,0] += box.x1
-        boxx[:,1] += box.y1
-        boxx = np.intp(boxx)  # Convert to integer
-
-        # ******Reculate width and height --> Directly applied as fish size *******
-        fish_height = np.sqrt((boxx[0,0]-boxx[1,0])**2 + (boxx[0,1]-boxx[1,1])**2 )
-        fish_width = np.sqrt((boxx[2,0]-boxx[1,0])**2 + (boxx[2,1]-boxx[1,1])**2 )
-        if fish_height > fish_width:
-            # swap height and width
-            tmp = fish_height
-            fish_height = fish_width
-            fish_width = tmp        
-        
-        # Display the result
-        # visulize_img = cv2.cvtColor(visulize_img,cv2.COLOR_RGB2BGR)
-        # imS = cv2.resize(visulize_img, (visulize_img.shape[1]//4, visulize_img.shape[0]//4))                # Resize image
-        # # cv2.imwrite('final_visual.png',imS)
-        # cv2.imshow("output", imS) 
-        # # cv2.imshow('Rotated Bounding Box', visulize_img)
-        # cv2.waitKey(0)
-        # cv2.destroyAllWindows()
-
-        # =================================================================
-
-        # get result: [width, height, area]
-        # res.append([box.width,box.height,segmented_polygons.to_dict()['area']])
-
-
-    # convert to real size:
-    if len(boxes) != 0:
-        fish_width = fish_width * calibration_factor
-        fish_height = fish_height * calibration_factor
-        fish_area = segmented_polygons.to_dict()['area'] * calibration_factor * calibration_factor
-
-        # predict weight:
-        with torch.no_grad():
-            input_data = torch.tensor([fish_width, fish_height, fish_area]).to(device).float().unsqueeze(0)
-            # input_data = torch.tensor([6.642561445470936, 1.5305083096582157, 6.966261551986847]).to(device).float().unsqueeze(0)
-            fish_weight = weight_model(input_data).item()
-        # print(h,w)
-        # print(input_data.shape)
-        # print(fish_width,fish_height,fish_area,fish_weight)
-
-
-        # Convert to list of lists
-        bbox = boxx.tolist()
-
-        return {
-            "bounding_box": bbox,  # List of 4 (x, y) points
-            "fish_width": fish_width,
-            "fish_height": fish_height,
-            "fish_area": fish_area,  
-            "fish_mass": fish_weight
-        }
+# images of one /detect/batch request submitted to the batcher at once
+BULK_IN_FLIGHT = int(os.environ.get('FISH_BULK_IN_FLIGHT', 16))
 
+
+@app.post("/detect/batch")
+async def detect_batch(files: list[UploadFile] = File(...), station: str = Form(DEFAULT_STATION)):
+    '''
+    Measure many images (files and/or zip archives) in one request. One
+    NDJSON line per image is streamed as soon as that image is measured.
+    '''
+    calibration = calibration_store.lookup(station)
+    if calibration is None:
+        raise HTTPException(status_code=409, detail=f"Station {station} is not calibrated, call /calibrate/ first")
+    # the whole upload is measured with the calibration in effect when it arrived
+    pixel_size = calibration['pixel_size']
+
+    async def measure(contents):
+        return await detect_batcher.submit((contents, pixel_size))
+
+    async def result_lines():
+        async for index, image_name, fish in measure_stream(upload_images(files), measure, BULK_IN_FLIGHT):
+            if isinstance(fish, Exception):
+                result = {"index": index, "image_name": image_name, "error": str(fish)}
+            else:
+                result = {"index": index, "image_name": image_name, **detection_response(fish)}
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(result_lines(), media_type="application/x-ndjson")
+
+
+def detection_response(fish):
+    '''
+    Build /detect/ response: all fish in 'fish', plus the first fish at top
+    level so single-fish clients keep working.
+    '''
+    if len(fish) != 0:
+        first = fish[0]
     else:
-        return {
+        first = {
             "bounding_box": [[0,0],[0,0],[0,0],[0,0]],  # List of 4 (x, y) points
             "fish_width": 0,
             "fish_height": 0,
-            "fish_area": 0, 
+            "fish_area": 0,
             "fish_mass": 0
         }
-    
 
-@app.post("/save_results/")
-async def save_results(data: list[dict]):
-    df = pd.DataFrame(data)
+    return {
+        **first,
+        "fish_count": len(fish),
+        "fish": fish
+    }
 
-    # Save to Excel (append if file exists)
-    file_name = "detection_results.xlsx"
-    try:
-        existing_df = pd.read_excel(file_name)
-        df = pd.concat([existing_df, df], ignore_index=True)
-    except FileNotFoundError:
-        pass  # No existing file, create a new one
 
-    df.to_excel(file_name, index=False)
-    return {"message": "Results saved successfully"}
\ No newline at end of file
+@app.post("/save_results/")
+async def save_results(data: list[dict]):
+    # one appended transaction per call, whatever the size of the study
+    loop = asyncio.get_running_loop()
+    batch_id, count = await loop.run_in_executor(None, results_store.append, data)
+    return {"message": "Results saved successfully", "batch_id": batch_id, "saved": count}
+
+
+@app.get("/export_results/")
+async def export_results(format: str = 'xlsx', image_name: str = None):
+    '''Download all saved results as an Excel workbook or CSV.'''
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown export format: {format}")
+
+    loop = asyncio.get_running_loop()
+    contents = await loop.run_in_executor(None, results_store.export, format, image_name)
+    return Response(content=contents, media_type=EXPORT_MEDIA_TYPES[format],
+                    headers={"Content-Disposition": f'attachment; filename="detection_results.{format}"'})
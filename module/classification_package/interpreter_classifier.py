@@ -2,12 +2,24 @@ import torch.nn as nn
 import numpy as np
 import logging
 import torch
+import os
 
 from PIL import Image
 from torchvision import transforms
 
+from module.classification_package.src.embedding_index import load_or_build_index
+from module.classification_package.src.compact_database import CompactDatabase, is_compact
+
 class EmbeddingClassifier:
-    def __init__(self, model_path, data_set_path, indexes_of_elements, device='cpu', THRESHOLD = 6.84):
+    def __init__(self, model_path, data_set_path, indexes_of_elements, device='cpu', THRESHOLD = 6.84,
+                 index_type='flat', nlist=1024, nprobe=16):
+        '''
+        data_set_path : database.pt tensor, or a compact database directory
+                        (src/compact_database.py)
+        index_type    : 'flat' (exact), 'ivf' or 'hnsw' search over the database,
+                        see src/embedding_index.py. Approximate indexes are built
+                        once and saved next to data_set_path.
+        '''
         self.device = device
         self.THRESHOLD = THRESHOLD
         self.map_of_items = indexes_of_elements['list_of_ids']
@@ -24,7 +36,30 @@ class EmbeddingClassifier:
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         ])
         
-        self.data_base = torch.load(data_set_path).to(device)
+        if is_compact(data_set_path):
+            # memory-mapped float16/int8 database without padding rows, shared by all processes
+            self.data_base = CompactDatabase(data_set_path)
+            if index_type == 'flat':
+                self.index = self.data_base
+            else:
+                # dequantized only when the index has to be built; IVF lists
+                # read their rows from the memory-mapped compact vectors
+                self.index = load_or_build_index(lambda: torch.from_numpy(self.data_base.dequantize()),
+                                                 os.path.join(data_set_path, 'vectors.npy'),
+                                                 index_type, nlist=nlist, nprobe=nprobe, rows=self.data_base)
+        else:
+            # an approximate index only needs the tensor (and loads it) when it is built
+            self.index = load_or_build_index(lambda: torch.load(data_set_path).to(device), data_set_path, index_type,
+                                             nlist=nlist, nprobe=nprobe)
+            self.data_base = self.index.data_base if index_type == 'flat' else None
+
+        # per database row metadata as arrays, so top-k rows resolve by fancy indexing
+        items = np.array(self.map_of_items, dtype=object).reshape(len(self.map_of_items), -1)
+        self.item_image_ids = items[:, 1]
+        self.item_annotation_ids = items[:, 2]
+        self.item_drawn_fish_ids = items[:, 3]
+        self.item_names = np.array([self.categories[str(i)]['name'] for i in items[:, 0]], dtype=object)
+        self.item_species_ids = np.array([self.categories[str(i)]['species_id'] for i in items[:, 0]], dtype=object)
         logging.info("[INIT][CLASSIFICATION] Initialization of classifier was finished")
                 
     def __inference(self, image, top_k = 15): 
@@ -72,10 +107,11 @@ class EmbeddingClassifier:
         return dict_results
     
     def __get_confidence(self, dist):
+        # dist: a distance or an array of distances
         min_dist = 3.5
         max_dist = self.THRESHOLD
         delta = max_dist - min_dist
-        return 1.0 - (max(min(max_dist, dist), min_dist) - min_dist) / delta
+        return 1.0 - (np.clip(dist, min_dist, max_dist) - min_dist) / delta
     
     def inference_numpy(self, img, top_k=10):
         image = Image.fromarray(img)
@@ -95,13 +131,13 @@ class EmbeddingClassifier:
         
         logging.info("[PROCESSING][CLASSIFICATION] Classification by Full Connected layer for a single detection mask")  
         classes, scores = self.__classify_fc(class_ids)
-       
+
+        logging.info("[PROCESSING][CLASSIFICATION] Classification by embedding for the whole batch")
+        outputs_by_embeddings = self.__classify_embeddings(dump_embeds)
+
         outputs = []
         for output_id in range(len(classes)):
-
-            logging.info("[PROCESSING][CLASSIFICATION] Classification by embedding for a single detection mask")
-            output_by_embeddings = self.__classify_embedding(dump_embeds[output_id])
-            result = self.__beautifier_output(output_by_embeddings, self.categories[str(classes[output_id].item())])
+            result = self.__beautifier_output(outputs_by_embeddings[output_id], self.categories[str(classes[output_id].item())])
             outputs.append(result)
         return outputs
     
@@ -112,24 +148,32 @@ class EmbeddingClassifier:
         return class_id, acc_values
 
     def __classify_embedding(self, embedding, top_k = 15):
-        diff = (self.data_base - embedding).pow(2).sum(dim=1).sqrt()
-        val, indi = torch.sort(diff)
-        
+        return self.__classify_embeddings(embedding.unsqueeze(0), top_k)[0]
+
+    def __classify_embeddings(self, embeddings, top_k = 15):
+        # whole batch searched at once (exact: one distance matrix + top-k)
+        val, indi = self.index.search(embeddings.detach(), top_k)
+        accuracy = np.round(self.__get_confidence(val), 3)
+
+        names = self.item_names[indi]
+        species_ids = self.item_species_ids[indi]
+        image_ids = self.item_image_ids[indi]
+        annotation_ids = self.item_annotation_ids[indi]
+        drawn_fish_ids = self.item_drawn_fish_ids[indi]
+
         embedding_classification_output = []
-        for indiece in indi[:top_k]:
-            internal_id, image_id, annotation_id, drawn_fish_id = \
-            self.map_of_items[indiece]
-                   
-            class_info_map  = {
-                'name': self.categories[str(internal_id)]['name'],
-                'species_id': self.categories[str(internal_id)]['species_id'],
-                'distance': diff[indiece].item(),
-                'accuracy': round(self.__get_confidence(diff[indiece].item()), 3),
-                'image_id': image_id,
-                'annotation_id': annotation_id,
-                'drawn_fish_id': drawn_fish_id,
-            }
-            embedding_classification_output.append(class_info_map)
+        for row in range(indi.shape[0]):
+            # approximate indexes mark missing neighbours with -1
+            found = [col for col in range(indi.shape[1]) if indi[row, col] >= 0]
+            embedding_classification_output.append([{
+                'name': names[row, col],
+                'species_id': species_ids[row, col],
+                'distance': float(val[row, col]),
+                'accuracy': float(accuracy[row, col]),
+                'image_id': image_ids[row, col],
+                'annotation_id': annotation_ids[row, col],
+                'drawn_fish_id': drawn_fish_ids[row, col],
+            } for col in found])
         return embedding_classification_output
 
     
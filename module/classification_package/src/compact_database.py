@@ -0,0 +1,149 @@
+'''
+Compact storage of the embedding database.
+
+The padded database.pt stacks every class to the size of the largest class
+with filler rows, in float32, and every process loads its own copy. The
+compact format keeps only real rows, ordered by class:
+
+    <path>/vectors.npy        (N, D) float16, or int8 quantized
+    <path>/scales.npy         (N,) float32 per-row scale (int8 only)
+    <path>/norms.npy          (N,) float32 squared L2 norm of every row
+    <path>/class_offsets.npy  (C + 1,) int64, rows of class c are
+                              [class_offsets[c], class_offsets[c + 1])
+    <path>/meta.json          dtype, dim, count
+
+All arrays are opened memory-mapped, so worker processes share one copy in
+the page cache. CompactDatabase.search scans the rows in chunks and keeps a
+running top-k, never materializing the full float32 matrix.
+'''
+
+import json
+import os
+
+import numpy as np
+import torch
+
+
+def quantize(vectors, dtype='float16'):
+    '''
+    Encode float vectors as float16, or int8 with a symmetric per-row scale.
+    Return (encoded, scales); scales is None for float16.
+    '''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == 'float16':
+        return vectors.astype(np.float16), None
+    if dtype == 'int8':
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        encoded = np.clip(np.round(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return encoded, scales.astype(np.float32)
+    raise ValueError(f'Unknown database dtype: {dtype}')
+
+
+def save_compact(path, class_vectors, dtype='float16'):
+    '''
+    Write a compact database.
+
+        class_vectors : list (one entry per class) of (n_c, D) float arrays
+    '''
+    os.makedirs(path, exist_ok=True)
+    vectors = np.concatenate([np.asarray(v, dtype=np.float32).reshape(-1, np.shape(v)[-1])
+                              for v in class_vectors if len(v)], axis=0)
+    class_offsets = np.concatenate([[0], np.cumsum([len(v) for v in class_vectors])]).astype(np.int64)
+
+    encoded, scales = quantize(vectors, dtype)
+    decoded = dequantize(encoded, scales)
+
+    np.save(os.path.join(path, 'vectors.npy'), encoded)
+    if scales is not None:
+        np.save(os.path.join(path, 'scales.npy'), scales)
+    # norms of the stored (decoded) vectors keep distances consistent
+    np.save(os.path.join(path, 'norms.npy'), (decoded ** 2).sum(axis=1).astype(np.float32))
+    np.save(os.path.join(path, 'class_offsets.npy'), class_offsets)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'dtype': dtype, 'dim': int(vectors.shape[1]), 'count': int(vectors.shape[0])}, f)
+
+
+def dequantize(encoded, scales=None):
+    decoded = np.asarray(encoded, dtype=np.float32)
+    if scales is not None:
+        decoded = decoded * np.asarray(scales, dtype=np.float32)[:, None]
+    return decoded
+
+
+def is_compact(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+
+class CompactDatabase:
+    '''
+    Memory-mapped compact database with exact chunked L2 search.
+    '''
+    name = 'flat'
+
+    def __init__(self, path, chunk_size=65536):
+        self.path = path
+        self.chunk_size = chunk_size
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.norms = np.load(os.path.join(path, 'norms.npy'), mmap_mode='r')
+        self.class_offsets = np.load(os.path.join(path, 'class_offsets.npy'))
+        scales_path = os.path.join(path, 'scales.npy')
+        self.scales = np.load(scales_path, mmap_mode='r') if os.path.exists(scales_path) else None
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @property
+    def shape(self):
+        return self.vectors.shape
+
+    def class_of_rows(self):
+        '''Class index of every row, from the ragged class offsets.'''
+        return np.repeat(np.arange(len(self.class_offsets) - 1), np.diff(self.class_offsets))
+
+    def dequantize(self, start=0, stop=None):
+        stop = len(self) if stop is None else stop
+        scales = None if self.scales is None else self.scales[start:stop]
+        return dequantize(self.vectors[start:stop], scales)
+
+    def take(self, rows):
+        '''float32 vectors of the given rows (e.g. one IVF list).'''
+        rows = np.asarray(rows)
+        scales = None if self.scales is None else self.scales[rows]
+        return dequantize(self.vectors[rows], scales)
+
+    def search(self, queries, k):
+        '''
+        Exact L2 search. Return (distances, indices) as (B, k) numpy arrays.
+
+        For int8 rows x = s * q the inner product is s * (q . y), so only the
+        chunk's int8 codes are widened, never a full float32 copy.
+        '''
+        queries = torch.as_tensor(queries).detach().float().cpu()
+        query_norms = (queries ** 2).sum(dim=1, keepdim=True)
+        k = min(k, len(self))
+
+        best_val = torch.full((len(queries), 0), float('inf'))
+        best_idx = torch.zeros((len(queries), 0), dtype=torch.int64)
+        for start in range(0, len(self), self.chunk_size):
+            stop = min(start + self.chunk_size, len(self))
+            # np.array copies the read-only memmap slices (torch.from_numpy
+            # warns on non-writable arrays); one chunk at a time
+            codes = torch.from_numpy(np.array(self.vectors[start:stop], dtype=np.float32))
+            inner = queries @ codes.t()
+            if self.scales is not None:
+                inner = inner * torch.from_numpy(np.array(self.scales[start:stop], dtype=np.float32))[None, :]
+
+            norms = torch.from_numpy(np.array(self.norms[start:stop], dtype=np.float32))[None, :]
+            distances = torch.sqrt(torch.clamp(query_norms + norms - 2 * inner, min=0.0))
+
+            # merge the chunk into the running top-k
+            val = torch.cat([best_val, distances], dim=1)
+            idx = torch.cat([best_idx, torch.arange(start, stop).expand(len(queries), -1)], dim=1)
+            best_val, order = torch.topk(val, min(k, val.shape[1]), dim=1, largest=False, sorted=True)
+            best_idx = torch.gather(idx, 1, order)
+
+        return best_val.numpy(), best_idx.numpy()
@@ -0,0 +1,315 @@
+'''
+Nearest-neighbour indexes over the species embedding database.
+
+EmbeddingClassifier searches the reference embeddings through one of:
+
+    flat : exact L2 scan (pairwise distance matrix + top-k)
+    ivf  : inverted file, k-means coarse quantizer; only the nprobe closest
+           lists are scanned. Saved as .npy files next to database.pt and
+           memory-mapped on load, so worker processes share the pages. Over
+           a compact database the lists keep only row ids and read their
+           vectors from the compact (float16/int8) arrays.
+    hnsw : graph index from the optional hnswlib package
+
+Every index returns (distances, indices) as (B, k) numpy arrays, indices
+being rows of the original database tensor (-1 where an approximate index
+found fewer than k neighbours).
+
+Recall/latency of an approximate index against the exact scan:
+
+    python -m module.classification_package.src.embedding_index \\
+        --database models/classification/database.pt --index ivf --nlist 1024 --nprobe 16
+'''
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+
+from module.classification_package.src.utils import pairwise_distance
+
+
+class FlatIndex:
+    '''Exact search: one (batch x database) distance matrix and top-k.'''
+    name = 'flat'
+
+    def __init__(self, data_base):
+        self.data_base = torch.as_tensor(data_base)
+
+    def search(self, queries, k):
+        queries = torch.as_tensor(queries, dtype=self.data_base.dtype).to(self.data_base.device)
+        distances = pairwise_distance(queries, self.data_base)
+        val, indi = torch.topk(distances, min(k, distances.shape[1]), dim=1, largest=False, sorted=True)
+        return val.cpu().numpy(), indi.cpu().numpy()
+
+    def save(self, path):
+        # the database itself is the index
+        pass
+
+
+def kmeans(vectors, n_clusters, n_iter=20, sample=256, seed=0):
+    '''Lloyd k-means on at most sample * n_clusters random vectors.'''
+    generator = torch.Generator().manual_seed(seed)
+    vectors = torch.as_tensor(vectors, dtype=torch.float32)
+    if len(vectors) > sample * n_clusters:
+        vectors = vectors[torch.randperm(len(vectors), generator=generator)[:sample * n_clusters]]
+
+    centroids = vectors[torch.randperm(len(vectors), generator=generator)[:n_clusters]].clone()
+    for _ in range(n_iter):
+        assign = pairwise_distance(vectors, centroids).argmin(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, vectors)
+        counts = torch.bincount(assign, minlength=len(centroids)).unsqueeze(1)
+        # keep empty clusters where they are
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+    return centroids
+
+
+class IVFIndex:
+    '''
+    Inverted file index: database rows are grouped by their closest k-means
+    centroid and stored contiguously (list_offsets gives each list's slice).
+
+        nlist  : number of lists (centroids)
+        nprobe : lists scanned per query
+        rows   : object whose take(ids) returns float32 database rows (e.g. a
+                 CompactDatabase); the index then stores no vectors itself
+    '''
+    name = 'ivf'
+
+    def __init__(self, centroids, vectors, ids, list_offsets, nprobe=16, rows=None):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.list_offsets = list_offsets
+        self.nprobe = nprobe
+        self.rows = rows
+
+    @classmethod
+    def build(cls, data_base, nlist=1024, nprobe=16, rows=None):
+        data_base = torch.as_tensor(data_base, dtype=torch.float32).cpu()
+        nlist = max(1, min(nlist, len(data_base)))
+        centroids = kmeans(data_base, nlist)
+
+        assign = torch.cat([pairwise_distance(chunk, centroids).argmin(dim=1)
+                            for chunk in torch.split(data_base, 65536)])
+        order = torch.argsort(assign, stable=True)
+        counts = torch.bincount(assign, minlength=nlist)
+        list_offsets = np.concatenate([[0], np.cumsum(counts.numpy())]).astype(np.int64)
+
+        vectors = data_base[order].numpy() if rows is None else None
+        return cls(centroids.numpy(), vectors, order.numpy().astype(np.int64), list_offsets, nprobe, rows)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+        if self.vectors is not None:
+            np.save(os.path.join(path, 'vectors.npy'), self.vectors)
+        np.save(os.path.join(path, 'ids.npy'), self.ids)
+        np.save(os.path.join(path, 'list_offsets.npy'), self.list_offsets)
+
+    @classmethod
+    def load(cls, path, nprobe=16, rows=None):
+        return cls(np.load(os.path.join(path, 'centroids.npy')),
+                   np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r') if rows is None else None,
+                   np.load(os.path.join(path, 'ids.npy'), mmap_mode='r'),
+                   np.load(os.path.join(path, 'list_offsets.npy')),
+                   nprobe, rows)
+
+    def list_vectors(self, start, stop):
+        '''float32 vectors of the list positions [start, stop).'''
+        if self.rows is None:
+            return np.asarray(self.vectors[start:stop], dtype=np.float32)
+        return self.rows.take(self.ids[start:stop])
+
+    def search(self, queries, k):
+        queries = np.asarray(torch.as_tensor(queries).detach().cpu(), dtype=np.float32)
+        nprobe = min(self.nprobe, len(self.centroids))
+        query_norms = (queries ** 2).sum(axis=1)
+
+        # squared distances to all centroids: ||q||^2 + ||c||^2 - 2 q.c
+        coarse = query_norms[:, None] + (self.centroids ** 2).sum(axis=1)[None, :] - 2 * queries @ self.centroids.T
+        probes = np.argpartition(coarse, nprobe - 1, axis=1)[:, :nprobe]
+
+        # every probed list is read once and scanned against all queries probing it
+        probe_queries = np.repeat(np.arange(len(queries)), nprobe)
+        order = np.argsort(probes.ravel(), kind='stable')
+        lists, starts = np.unique(probes.ravel()[order], return_index=True)
+
+        cand_query, cand_dist, cand_pos = [], [], []
+        for lst, members in zip(lists, np.split(probe_queries[order], starts[1:])):
+            start, stop = self.list_offsets[lst], self.list_offsets[lst + 1]
+            if stop == start:
+                continue
+            vectors = self.list_vectors(start, stop)
+            dist = query_norms[members, None] + (vectors ** 2).sum(axis=1)[None, :] - 2 * queries[members] @ vectors.T
+            # only the k nearest of a list can be among the k nearest overall
+            if dist.shape[1] > k:
+                best = np.argpartition(dist, k - 1, axis=1)[:, :k]
+                dist = np.take_along_axis(dist, best, axis=1)
+            else:
+                best = np.broadcast_to(np.arange(dist.shape[1]), dist.shape)
+            cand_query.append(np.repeat(members, dist.shape[1]))
+            cand_dist.append(dist.ravel())
+            cand_pos.append((start + best).ravel())
+
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        if len(cand_query) == 0:
+            return distances, indices
+
+        # k nearest candidates of every query: sort by (query, distance), keep the first k of each query
+        cand_query, cand_dist, cand_pos = np.concatenate(cand_query), np.concatenate(cand_dist), np.concatenate(cand_pos)
+        order = np.lexsort((cand_dist, cand_query))
+        cand_query = cand_query[order]
+        rank = np.arange(len(order)) - np.searchsorted(cand_query, cand_query, side='left')
+        keep = rank < k
+        distances[cand_query[keep], rank[keep]] = np.sqrt(np.maximum(cand_dist[order][keep], 0))
+        indices[cand_query[keep], rank[keep]] = self.ids[cand_pos[order][keep]]
+        return distances, indices
+
+
+class HNSWIndex:
+    '''Graph index backed by hnswlib (pip install hnswlib).'''
+    name = 'hnsw'
+
+    def __init__(self, index, ef=64):
+        self.index = index
+        self.index.set_ef(ef)
+
+    @staticmethod
+    def _hnswlib():
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError('hnsw index needs the hnswlib package: pip install hnswlib')
+        return hnswlib
+
+    @classmethod
+    def build(cls, data_base, M=32, ef_construction=200, ef=64):
+        hnswlib = cls._hnswlib()
+        data_base = np.asarray(torch.as_tensor(data_base).detach().cpu(), dtype=np.float32)
+        index = hnswlib.Index(space='l2', dim=data_base.shape[1])
+        index.init_index(max_elements=len(data_base), M=M, ef_construction=ef_construction)
+        index.add_items(data_base, np.arange(len(data_base)))
+        return cls(index, ef)
+
+    def save(self, path):
+        self.index.save_index(path)
+
+    @classmethod
+    def load(cls, path, dim, ef=64):
+        hnswlib = cls._hnswlib()
+        index = hnswlib.Index(space='l2', dim=dim)
+        index.load_index(path)
+        return cls(index, ef)
+
+    def search(self, queries, k):
+        queries = np.asarray(torch.as_tensor(queries).detach().cpu(), dtype=np.float32)
+        indices, distances = self.index.knn_query(queries, k=min(k, self.index.get_current_count()))
+        # hnswlib returns squared L2
+        return np.sqrt(distances), indices.astype(np.int64)
+
+
+def index_path(data_set_path, index_type):
+    return f'{data_set_path}.{index_type}'
+
+
+def load_or_build_index(data_base, data_set_path, index_type='flat', nlist=1024, nprobe=16, ef=64, rows=None):
+    '''
+    Load the index saved next to data_set_path, or build and save it. A saved
+    index is rebuilt when database.pt changed since it was built.
+
+        data_base : (N, D) database tensor, or a function returning it, which
+                    is only called when the index has to be built
+        rows      : row source of the IVF lists (see IVFIndex)
+    '''
+    if index_type == 'flat':
+        return FlatIndex(data_base() if callable(data_base) else data_base)
+
+    path = index_path(data_set_path, index_type)
+    meta_path = path + '.json'
+    stat = os.stat(data_set_path)
+    meta = {'database_size': stat.st_size, 'database_mtime': stat.st_mtime, 'nlist': nlist}
+
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            saved = json.load(f)
+        # (indexes saved without 'dim' are rebuilt once)
+        if {key: saved.get(key) for key in meta} == meta and 'dim' in saved:
+            logging.info(f"[INIT][CLASSIFICATION] Loading {index_type} index from {path}")
+            if index_type == 'ivf':
+                return IVFIndex.load(path, nprobe, rows)
+            return HNSWIndex.load(path, saved['dim'], ef)
+
+    logging.info(f"[INIT][CLASSIFICATION] Building {index_type} index for {data_set_path}")
+    data_base = data_base() if callable(data_base) else data_base
+    if index_type == 'ivf':
+        index = IVFIndex.build(data_base, nlist, nprobe, rows)
+    elif index_type == 'hnsw':
+        index = HNSWIndex.build(data_base, ef=ef)
+    else:
+        raise ValueError(f'Unknown index type: {index_type}')
+
+    index.save(path)
+    with open(meta_path, 'w') as f:
+        json.dump(dict(meta, dim=int(data_base.shape[1])), f)
+    if index_type == 'ivf':
+        # reopen memory-mapped
+        return IVFIndex.load(path, nprobe, rows)
+    return index
+
+
+def recall_report(data_base, index, queries, k=15, exact=None):
+    '''
+    Recall@k and mean per-query latency of index against the exact scan.
+    '''
+    exact = exact if exact is not None else FlatIndex(data_base)
+
+    start = time.perf_counter()
+    _, exact_indices = exact.search(queries, k)
+    exact_time = (time.perf_counter() - start) / len(queries)
+
+    start = time.perf_counter()
+    _, approx_indices = index.search(queries, k)
+    approx_time = (time.perf_counter() - start) / len(queries)
+
+    hits = sum(len(set(e) & set(a)) for e, a in zip(exact_indices.tolist(), approx_indices.tolist()))
+    return {
+        'index': index.name,
+        'k': k,
+        'queries': len(queries),
+        'recall': hits / float(exact_indices.size),
+        'exact_ms_per_query': exact_time * 1000,
+        'index_ms_per_query': approx_time * 1000,
+        'speedup': exact_time / approx_time if approx_time > 0 else float('inf'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build an embedding index and report recall vs the exact scan.')
+    parser.add_argument('--database', type=str, required=True, help='database.pt embedding tensor')
+    parser.add_argument('--index', type=str, default='ivf', choices=['ivf', 'hnsw'])
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--nprobe', type=int, default=16)
+    parser.add_argument('--ef', type=int, default=64)
+    parser.add_argument('--queries', type=int, default=1000, help='database rows (+ noise) used as queries')
+    parser.add_argument('--noise', type=float, default=0.05)
+    parser.add_argument('--top_k', type=int, default=15)
+    args = parser.parse_args()
+
+    data_base = torch.load(args.database, map_location='cpu').float()
+    index = load_or_build_index(data_base, args.database, args.index, args.nlist, args.nprobe, args.ef)
+
+    generator = torch.Generator().manual_seed(0)
+    rows = torch.randperm(len(data_base), generator=generator)[:args.queries]
+    queries = data_base[rows] + args.noise * torch.randn(len(rows), data_base.shape[1], generator=generator)
+
+    print(json.dumps(recall_report(data_base, index, queries, args.top_k), indent=2))
+
+
+if __name__ == '__main__':
+    main()
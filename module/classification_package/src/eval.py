@@ -6,29 +6,13 @@ import os
 from torch import nn
 from torch.utils.data import DataLoader
 from module.classification_package.src.dataset import FishialDataset
-from module.classification_package.src.utils import save_json, read_json
+from module.classification_package.src.utils import save_json, read_json, pairwise_distance
 
 from sklearn.metrics import accuracy_score
 from sklearn.neighbors import KDTree
 
 from tqdm import tqdm
 
-def pairwise_distance(x, y):
-
-    x_square = torch.sum(x**2, dim=1, keepdim=True)  # (n, 1)
-    y_square = torch.sum(y**2, dim=1, keepdim=True).t()  # (1, m)
-    
-    xy_inner_product = torch.matmul(x, y.t())  # (n, m)
-    
-    # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 * (a . b)
-    distances = x_square + y_square - 2 * xy_inner_product
-    
-    distances = torch.clamp(distances, min=0.0)
-    
-    distances = torch.sqrt(distances)
-    
-    return distances
-
 def get_embeddings(model, dataset, device = 'cuda', metrics = ['acc'] , batch_size = 128):
     data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
     dump = dump_embeddings(data_loader, model, device = device, metrics = metrics)
@@ -105,6 +105,23 @@ def get_padding(image):
     return padding
 
 
+def pairwise_distance(x, y):
+
+    x_square = torch.sum(x**2, dim=1, keepdim=True)  # (n, 1)
+    y_square = torch.sum(y**2, dim=1, keepdim=True).t()  # (1, m)
+    
+    xy_inner_product = torch.matmul(x, y.t())  # (n, m)
+    
+    # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 * (a . b)
+    distances = x_square + y_square - 2 * xy_inner_product
+    
+    distances = torch.clamp(distances, min=0.0)
+    
+    distances = torch.sqrt(distances)
+    
+    return distances
+
+
 def classify_by_database(data_base, embedding):
         diff = (data_base - embedding).pow(2).sum(dim=2).sqrt()
         val, indi = torch.sort(diff)